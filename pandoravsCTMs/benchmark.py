@@ -0,0 +1,784 @@
+import os
+import sys
+import json
+import time
+import datetime
+import tempfile
+import argparse
+import subprocess
+import functools
+import threading
+import contextlib
+import http.server
+import email.utils
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pyproj import Geod
+from netCDF4 import Dataset
+from config import pandora, ctm_model
+from collocate import collocate, collocate_all, station_position, match_ctm_time, _to_datetime64
+from spatial import GridIndex, grid_index
+from reader import pandora_reader, CMAQ_reader, RNVS3_COLUMNS, _cmaq_time
+from driver import pandoravsCTMs
+from los_cache import LOSCache
+
+
+def synthetic_ctm(nx=60, ny=50, nz=35, ndays=2, nhours=25, dx_deg=0.11, lon_c=-77.0, lat_c=39.0,
+                  start=datetime.datetime(2024, 1, 1), seed=0):
+    '''
+        builds a list of CMAQ-like ctm_model granules on a slightly skewed grid
+             nx, ny, nz [int]: grid size and number of layers
+             ndays [int]: number of daily granules
+             nhours [int]: number of time steps in each granule
+             dx_deg [float]: grid spacing in degrees (~12 km for 0.11)
+        Output [list]: list of ctm_model granules
+    '''
+    rng = np.random.default_rng(seed)
+    jj, ii = np.meshgrid(np.arange(nx), np.arange(ny))
+    lon = (lon_c + (jj - nx/2)*dx_deg + 0.01*(ii - ny/2)*dx_deg).astype('float32')
+    lat = (lat_c + (ii - ny/2)*dx_deg*0.8).astype('float32')
+    # layer interfaces stretched from the surface to ~18 km
+    zf = 18000.0*(np.linspace(0, 1, nz + 1)[1:]**1.8)
+    zh = np.concatenate(([zf[0]/2.0], (zf[1:] + zf[:-1])/2.0))
+    outputs = []
+    for d in range(ndays):
+        times = [start + datetime.timedelta(days=d, hours=h) for h in range(nhours)]
+        Z = np.broadcast_to(zh[np.newaxis, :, np.newaxis, np.newaxis],
+                            (nhours, nz, ny, nx)).astype('float32').copy()
+        DZ = ((np.broadcast_to(zf[np.newaxis, :, np.newaxis, np.newaxis],
+                               (nhours, nz, ny, nx)) - Z)*2.0).astype('float32')
+        profile = np.exp(-zh/1500.0)[np.newaxis, :, np.newaxis, np.newaxis]
+        gas = (1e10*profile*(1.0 + rng.random((nhours, nz, ny, nx)))).astype('float32')
+        outputs.append(ctm_model(lat, lon, times, gas, Z, DZ, 'CMAQ'))
+    return outputs
+
+
+def synthetic_pandora(nsamples=50, lon=-77.0, lat=39.0, start='2024-01-01 12:00', freq='10min', seed=0):
+    '''
+        builds a pandora record with random sun geometry
+    '''
+    rng = np.random.default_rng(seed)
+    t = pd.Series(pd.date_range(start, periods=nsamples, freq=freq, tz='UTC'))
+    return pandora(t, lat, lon, rng.random(nsamples)*10.0, rng.random(nsamples),
+                   1.0 + rng.random(nsamples)*2.0, 10.0 + rng.random(nsamples)*60.0,
+                   rng.random(nsamples)*360.0)
+
+
+def solar_angles(times, lon: float, lat: float):
+    '''
+        approximate solar zenith/azimuth angles (deg, azimuth clockwise from north) of UTC times
+    '''
+    t = pd.DatetimeIndex(times)
+    gamma = 2.0*np.pi/365.0*(t.dayofyear - 1 + (t.hour - 12)/24.0)
+    decl = (0.006918 - 0.399912*np.cos(gamma) + 0.070257*np.sin(gamma) - 0.006758*np.cos(2*gamma) +
+            0.000907*np.sin(2*gamma))
+    eqtime = 229.18*(0.000075 + 0.001868*np.cos(gamma) - 0.032077*np.sin(gamma) -
+                     0.014615*np.cos(2*gamma) - 0.040849*np.sin(2*gamma))
+    hour_angle = np.radians((t.hour*60 + t.minute + t.second/60.0 + eqtime + 4.0*lon)/4.0 - 180.0)
+    phi = np.radians(lat)
+    cos_zen = np.sin(phi)*np.sin(decl) + np.cos(phi)*np.cos(decl)*np.cos(hour_angle)
+    zen = np.arccos(np.clip(cos_zen, -1.0, 1.0))
+    azi = np.degrees(np.arctan2(np.sin(hour_angle),
+                                np.cos(hour_angle)*np.sin(phi) - np.tan(decl)*np.cos(phi))) + 180.0
+    return np.degrees(np.asarray(zen)), np.asarray(azi) % 360.0
+
+
+def synthetic_pandora_file(filename: str, nrows=100000, lon=-77.0, lat=39.0, start='2024-01-01',
+                           cadence_s=80.0, seed=0):
+    '''
+        writes a PGN rnvs3-like L2 text file (header, column descriptions and 54 data columns)
+             nrows [int]: number of measurements
+             cadence_s [float]: seconds between measurements (daytime and nighttime alike)
+    '''
+    rng = np.random.default_rng(seed)
+    t = pd.Timestamp(start) + pd.to_timedelta(np.arange(nrows)*cadence_s, unit='s')
+    with open(filename, 'w', encoding='latin1') as f:
+        f.write(f"File name: {os.path.basename(filename)}\n")
+        f.write("Short location name: Synthetic\n")
+        f.write(f"Location latitude [deg]: {lat}\n")
+        f.write(f"Location longitude [deg]: {lon}\n")
+        f.write("Location altitude [m]: 50\n")
+        f.write("-" * 86 + "\n")
+        for c in range(1, 55):
+            f.write(f"Column {c}: synthetic column description\n")
+        f.write("-" * 86 + "\n")
+        cols = [t.strftime('%Y%m%dT%H%M%S.0Z'), np.round(rng.random(nrows)*9000, 6),
+                np.full(nrows, 20.0), np.round(rng.random(nrows)*80.0, 3), np.round(rng.random(nrows)*360.0, 3)]
+        cols += [np.round(rng.random(nrows)*10, 4) for _ in range(6, 36)]
+        cols += [rng.integers(0, 3, nrows), rng.integers(0, 10, nrows), rng.integers(0, 10, nrows)]
+        cols += [np.round(rng.random(nrows)*1e-4, 8) for _ in range(39, 55)]
+        lines = [' '.join(map(str, row)) for row in zip(*cols)]
+        f.write('\n'.join(lines) + '\n')
+
+
+def _write_ioapi(filename: str, day: datetime.date, variables: dict, first=datetime.timedelta(0),
+                 step=datetime.timedelta(hours=1)):
+    # writes (TSTEP, LAY, ROW, COL) float32 variables and the matching TFLAG of one day
+    # whose steps start at first after midnight, step apart
+    nsteps, nlevels, ny, nx = np.shape(next(iter(variables.values())))
+    nc = Dataset(filename, 'w')
+    nc.createDimension('TSTEP', None)
+    nc.createDimension('DATE-TIME', 2)
+    nc.createDimension('LAY', nlevels)
+    nc.createDimension('VAR', len(variables))
+    nc.createDimension('ROW', ny)
+    nc.createDimension('COL', nx)
+    tflag = nc.createVariable('TFLAG', 'i4', ('TSTEP', 'VAR', 'DATE-TIME'))
+    for t in range(nsteps):
+        step_time = datetime.datetime.combine(day, datetime.time()) + first + t*step
+        tflag[t, :, 0] = int(step_time.strftime('%Y%j'))
+        tflag[t, :, 1] = int(step_time.strftime('%H%M%S'))
+    for name, values in variables.items():
+        nc.createVariable(name, 'f4', ('TSTEP', 'LAY', 'ROW', 'COL'))[:] = values
+    nc.close()
+
+
+def synthetic_cmaq_files(folder: str, nx=60, ny=50, nz=35, ndays=2, nsteps=25, dx_deg=0.11, lon_c=-77.0,
+                         lat_c=39.0, start=datetime.date(2024, 1, 1), seed=0):
+    '''
+        writes CMAQ/MCIP-like day files on the grid of synthetic_ctm: CCTM_CONC (NO2, FORM in ppmv),
+        METCRO3D (PRES, TA, ZH, ZF), METCRO2D (PBL) and GRIDCRO2D (LAT, LON)
+             folder [str]: the folder of the files (serves as both dir_cmaq and dir_mcip)
+             nx, ny, nz [int]: grid size and number of layers
+             ndays [int]: number of day files
+             nsteps [int]: number of hourly time steps in each file
+        Output [list]: the YYYYMMDD days written
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    jj, ii = np.meshgrid(np.arange(nx), np.arange(ny))
+    lon = lon_c + (jj - nx/2)*dx_deg + 0.01*(ii - ny/2)*dx_deg
+    lat = lat_c + (ii - ny/2)*dx_deg*0.8
+    # layer interfaces stretched from the surface to ~18 km
+    zf = 18000.0*(np.linspace(0, 1, nz + 1)[1:]**1.8)
+    zh = np.concatenate(([zf[0]/2.0], (zf[1:] + zf[:-1])/2.0))
+    shape = (nsteps, nz, ny, nx)
+    ZH = np.broadcast_to(zh[np.newaxis, :, np.newaxis, np.newaxis], shape)
+    ZF = np.broadcast_to(zf[np.newaxis, :, np.newaxis, np.newaxis], shape)
+    days = []
+    for d in range(ndays):
+        day = start + datetime.timedelta(days=d)
+        tag = day.strftime('%Y%m%d')
+        _write_ioapi(os.path.join(folder, f"CCTM_CONC_v54_{tag}.nc"), day, {
+            'NO2': 0.01*np.exp(-ZH/1500.0)*(1.0 + rng.random(shape)),
+            'FORM': 0.002*np.exp(-ZH/3000.0)*(1.0 + rng.random(shape))})
+        _write_ioapi(os.path.join(folder, f"METCRO3D_{tag}.nc"), day, {
+            'PRES': 101325.0*np.exp(-ZH/8000.0), 'TA': 288.0 - 0.0065*ZH, 'ZH': ZH, 'ZF': ZF})
+        _write_ioapi(os.path.join(folder, f"METCRO2D_{tag}.nc"), day, {
+            'PBL': 500.0 + 1500.0*rng.random((nsteps, 1, ny, nx))})
+        _write_ioapi(os.path.join(folder, f"GRIDCRO2D_{tag}.nc"), day, {
+            'LAT': lat[np.newaxis, np.newaxis], 'LON': lon[np.newaxis, np.newaxis]})
+        days.append(tag)
+    return days
+
+
+def synthetic_pgn_files(folder: str, nstations=5, nrows=20000, ndays=2, nx=60, ny=50, dx_deg=0.11, lon_c=-77.0,
+                        lat_c=39.0, start='2024-01-01', seed=0):
+    '''
+        writes one PGN rnvs3-like L2 file per station (see synthetic_pandora_file) with the
+        stations spread over the inner part of the synthetic_cmaq_files grid
+             nstations [int]: number of stations
+             nrows [int]: number of measurements of each station, spread over ndays
+        Output [list]: the files written
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for k in range(nstations):
+        lon = lon_c + (rng.random() - 0.5)*0.6*nx*dx_deg
+        lat = lat_c + (rng.random() - 0.5)*0.6*ny*dx_deg*0.8
+        filename = os.path.join(folder, f"Synthetic{k}_Pandora{k + 1}s1_L2_rnvs3p1-8.txt")
+        synthetic_pandora_file(filename, nrows=nrows, lon=round(lon, 4), lat=round(lat, 4), start=start,
+                               cadence_s=ndays*86400.0/nrows, seed=seed + k)
+        files.append(filename)
+    return files
+
+
+def synthetic_pgn_tree(folder: str, nstations=3, nrows=2000, product='rnvs3', seed=0):
+    '''
+        writes a local copy of the PGN data tree (station/instrument/L2/ folders) with one
+        L2 file of the product per station (see synthetic_pandora_file)
+        Output [list]: the files written
+    '''
+    files = []
+    for k in range(nstations):
+        station, instrument = f"Synthetic{k}", f"Pandora{k + 1}s1"
+        l2_dir = os.path.join(folder, station, instrument, 'L2')
+        os.makedirs(l2_dir, exist_ok=True)
+        filename = os.path.join(l2_dir, f"{instrument}_{station}_L2_{product}p1-8.txt")
+        synthetic_pandora_file(filename, nrows=nrows, lon=-77.0 + 0.1*k, lat=39.0, seed=seed + k)
+        files.append(filename)
+    return files
+
+
+class _PGNHandler(http.server.SimpleHTTPRequestHandler):
+    # serves a PGN tree like the PGN data server: directory listings, ETag/Last-Modified
+    # validators, conditional and Range requests; the bodies of the paths in interrupt are
+    # cut after the given number of bytes, once, to simulate interrupted downloads
+    interrupt = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().do_GET()
+        st = os.stat(path)
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        last_modified = self.date_time_string(st.st_mtime)
+        if 'If-None-Match' in self.headers:
+            unchanged = self.headers['If-None-Match'] == etag
+        elif 'If-Modified-Since' in self.headers:
+            since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+            unchanged = int(st.st_mtime) <= since.timestamp()
+        else:
+            unchanged = False
+        if unchanged:
+            self.send_response(304)
+            self.end_headers()
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range', etag) in (etag, last_modified):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        if start:
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+        cut = self.interrupt.pop(self.path, None)
+        self.wfile.write(body[start:] if cut is None else body[start:start + cut])
+        if cut is not None:
+            self.close_connection = True
+
+
+@contextlib.contextmanager
+def pgn_server(folder: str):
+    '''
+        serves a local PGN tree (see synthetic_pgn_tree) on a free localhost port
+        Output [tuple]: the base url and the interrupt dict of the server (url path: number of
+                        bytes sent before the connection is dropped, used once)
+    '''
+    handler = type('PGNHandler', (_PGNHandler,), {'interrupt': {}})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=folder))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/", handler.interrupt
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _legacy_ray_tracing_scd(pandora_data, ctm_data, ds=5.0, max_dist=100000.0, alt0=2.0):
+    # the original per-step marching loop, kept as the reference for benchmarks
+    time_ctm = np.concatenate([np.array([t.year * 10000 + t.month * 100 + t.day +
+                                         t.hour / 24.0 + t.minute / (60.0 * 24.0)
+                                         for t in g.time]) for g in ctm_data])
+    time_pandora = np.array([t.year * 10000 + t.month * 100 + t.day +
+                             t.hour / 24.0 + t.minute / (60.0 * 24.0) for t in pandora_data.time])
+    ctm_lon = ctm_data[0].longitude
+    ctm_lat = ctm_data[0].latitude
+    ctm_toa = np.max(ctm_data[0].Z.flatten())
+    geod = Geod(ellps='WGS84')
+    scd = []
+    for t1 in range(np.size(time_pandora)):
+        closest_index = np.argmin(np.abs(time_pandora[t1] - time_ctm))
+        day = int(np.floor(closest_index / 25.0))
+        hour = int(closest_index % 25)
+        ctm_partial_col_dens = ctm_data[day].partial_col_density[hour, ...]
+        ctm_Z = ctm_data[day].Z[hour, ...]
+        s = np.arange(0, max_dist, ds)
+        zen = pandora_data.sza[t1]
+        x = s * np.sin(np.radians(zen))
+        y = s * np.cos(np.radians(zen))
+        lons, lats, alts = (np.zeros_like(s) for _ in range(3))
+        for i in range(0, np.size(s)):
+            lons[i], lats[i], _ = geod.fwd(pandora_data.longitude, pandora_data.latitude,
+                                           pandora_data.saa[t1], x[i])
+            alts[i] = alt0 + y[i]
+            if alts[i] > ctm_toa:
+                break
+        ctm_lon_flat = ctm_lon.flatten()
+        ctm_lat_flat = ctm_lat.flatten()
+        scd_temp = 0.0
+        for lon, lat, alt in zip(lons, lats, alts):
+            if (lon == 0.0) | (lat == 0.0) | (alt == 0.0):
+                continue
+            idx_flat = np.argmin(np.sqrt((ctm_lon_flat - lon) ** 2 + (ctm_lat_flat - lat) ** 2))
+            i, j = np.unravel_index(idx_flat, ctm_lon.shape)
+            k = np.argmin(np.abs(ctm_Z[:, i, j] - alt))
+            scd_temp += float(ctm_partial_col_dens[k, i, j]) * ds
+        scd.append(scd_temp*1e-15)
+    return np.array(scd)
+
+
+def _legacy_pandora_reader(filename, YYYYMMDD1, YYYYMMDD2, lat_ctm, lon_ctm, grouping='10min'):
+    # the original reader (two header scans, all 54 columns parsed), kept as the reference for benchmarks
+    header_end_line = None
+    dash_count = 0
+    with open(filename, encoding="latin1") as f:
+        for i, line in enumerate(f):
+            if line.strip().startswith('---'):
+                dash_count += 1
+            if dash_count == 2:
+                header_end_line = i
+                break
+    with open(filename, encoding="latin1") as f:
+        for line in f:
+            if line.startswith("Location latitude"):
+                lat = float(line.split(":")[1].strip())
+            elif line.startswith("Location longitude"):
+                lon = float(line.split(":")[1].strip())
+    if not ((np.nanmin(lat_ctm) <= lat <= np.nanmax(lat_ctm)) and (np.nanmin(lon_ctm) <= lon <= np.nanmax(lon_ctm))):
+        return None
+    data = pd.read_csv(filename, skiprows=header_end_line+1, header=None, names=RNVS3_COLUMNS, delimiter=' ',
+                       encoding='latin1')
+    data = data.loc[(data['L2_NO2_quality_flag'] <= 1.0) & (data['solar_zenith_deg'] < 65.0)]
+    start_dt = pd.to_datetime(YYYYMMDD1, format='%Y%m%d', utc=True)
+    end_dt = pd.to_datetime(YYYYMMDD2, format='%Y%m%d', utc=True)
+    data = data.loc[data['time'] != -999]
+    data['time'] = pd.to_datetime(data['time'], format="%Y%m%dT%H%M%S.%fZ", utc=True)
+    data = data.groupby(pd.Grouper(key='time', freq=grouping)).mean().reset_index()
+    data = data.loc[(data['time'] >= start_dt) & (data['time'] < end_dt)]
+    if data.empty:
+        return None
+    return pandora(data['time'], lat, lon, np.array(data['NO2_column_mol_m2'])*6.022e23/1e4*1e-15,
+                   np.array(data['NO2_column_uncert_total'])*6.022e23/1e4*1e-15,
+                   np.array(data['NO2_air_mass_factor_direct']),
+                   np.array(data['solar_zenith_deg']), np.array(data['solar_azimuth_deg']))
+
+
+def bench_ray_tracing(nsamples=10, ds=5.0, max_dist=100000.0):
+    '''
+        compares the batched ray-tracing engine against the per-step marching loop
+        Output [dict]: timings (s), speedup and max relative difference of ctm_SCD
+    '''
+    ctm_data = synthetic_ctm()
+    pandora_data = synthetic_pandora(nsamples)
+    t0 = time.perf_counter()
+    scd_legacy = _legacy_ray_tracing_scd(pandora_data, ctm_data, ds=ds, max_dist=max_dist)
+    t_legacy = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    output = collocate(pandora_data, ctm_data, ds=ds, max_dist=max_dist, ray_tracing=True)
+    t_batched = time.perf_counter() - t0
+    return {"samples": nsamples, "legacy_s": t_legacy, "batched_s": t_batched,
+            "speedup": t_legacy/t_batched,
+            "max_rel_diff": float(np.max(np.abs(output["ctm_SCD"] - scd_legacy)/np.abs(scd_legacy)))}
+
+
+def bench_integration(nsamples=30, ds_list=(50.0, 5.0)):
+    '''
+        compares the fixed-step LOS integration against the exact cell-crossing integrator
+        Output [dict]: timings (s) and max relative difference of ctm_SCD for each step size
+    '''
+    ctm_data = synthetic_ctm()
+    pandora_data = synthetic_pandora(nsamples)
+    t0 = time.perf_counter()
+    scd_exact = collocate(pandora_data, ctm_data, ray_tracing=True, integration='exact')["ctm_SCD"]
+    results = {"samples": nsamples, "exact_s": time.perf_counter() - t0}
+    for ds in ds_list:
+        t0 = time.perf_counter()
+        scd_step = collocate(pandora_data, ctm_data, ds=ds, ray_tracing=True)["ctm_SCD"]
+        results[f"step_{ds:g}m_s"] = time.perf_counter() - t0
+        results[f"step_{ds:g}m_max_rel_diff"] = float(np.max(np.abs(scd_step - scd_exact)/scd_exact))
+    return results
+
+
+def bench_grid_index(nx=459, ny=299, npoints=2000, seed=0):
+    '''
+        compares the spatial index against the brute-force degree argmin on a CONUS 12 km grid
+        Output [dict]: build/query timings (s), speedup and the fraction of identical cells
+    '''
+    rng = np.random.default_rng(seed)
+    grid = synthetic_ctm(nx=nx, ny=ny, nz=1, ndays=1, nhours=1, lon_c=-97.0, lat_c=38.0)[0]
+    ctm_lon, ctm_lat = grid.longitude, grid.latitude
+    lons = rng.uniform(np.min(ctm_lon) + 1, np.max(ctm_lon) - 1, npoints)
+    lats = rng.uniform(np.min(ctm_lat) + 1, np.max(ctm_lat) - 1, npoints)
+    t0 = time.perf_counter()
+    idx_brute = np.array([np.argmin(np.sqrt((ctm_lon.flatten() - lon) ** 2 + (ctm_lat.flatten() - lat) ** 2))
+                          for lon, lat in zip(lons, lats)])
+    t_brute = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    index = GridIndex(ctm_lon, ctm_lat)
+    t_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    i, j, _ = index.query(lons, lats)
+    t_query = time.perf_counter() - t0
+    return {"grid": (ny, nx), "points": npoints, "brute_s": t_brute, "build_s": t_build,
+            "query_s": t_query, "speedup": t_brute/(t_build + t_query),
+            "same_cell": float(np.mean(np.ravel_multi_index((i, j), (ny, nx)) == idx_brute))}
+
+
+def bench_pandora_reader(nrows=200000, YYYYMMDD1='20240101', YYYYMMDD2='20240201', repeat=3):
+    '''
+        measures the throughput of pandora_reader against the original reader on a real-sized
+        (~100 MB per 200k rows) L2 file
+        Output [dict]: file size, best times (s), throughputs (MB/s), speedup and whether the
+                       samples match (the original reader also emits empty, all-NaN bins)
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'Synthetic_Pandora1s1_rnvs3p1-8.txt')
+        synthetic_pandora_file(filename, nrows=nrows)
+        size_mb = os.path.getsize(filename)/1e6
+        grid = synthetic_ctm(nx=10, ny=10, nz=1, ndays=1, nhours=1)[0]
+        timings = {}
+        outputs = {}
+        for name, reader in (("legacy", _legacy_pandora_reader), ("new", pandora_reader)):
+            timings[name] = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                outputs[name] = reader(filename, YYYYMMDD1, YYYYMMDD2, grid.latitude, grid.longitude)
+                timings[name].append(time.perf_counter() - t0)
+    legacy, new = outputs["legacy"], outputs["new"]
+    valid = ~np.isnan(legacy.column)
+    match = bool(np.array_equal(legacy.column[valid], new.column) and
+                 np.array_equal(_to_datetime64(legacy.time)[valid], _to_datetime64(new.time)))
+    return {"rows": nrows, "size_MB": size_mb, "legacy_best_s": min(timings["legacy"]),
+            "best_s": min(timings["new"]), "legacy_MB_per_s": size_mb/min(timings["legacy"]),
+            "MB_per_s": size_mb/min(timings["new"]), "speedup": min(timings["legacy"])/min(timings["new"]),
+            "match": match}
+
+
+def bench_pair_scaling(cores=(1, 2, 4), nstations=8, nsamples=200, ray_tracing=True):
+    '''
+        measures the scaling of pandoravsCTMs.pair from 1 to N cores with shared CTM arrays
+        Output [dict]: wall time (s) and speedup per core count, and whether outputs match serial
+    '''
+    pairing = pandoravsCTMs()
+    pairing.ctmdata = synthetic_ctm(nx=120, ny=100, ndays=3)
+    pairing.pandora = [synthetic_pandora(nsamples, lon=-77.0 + 0.3*k, lat=39.0 - 0.2*k, seed=k)
+                       for k in range(nstations)]
+    results = {"stations": nstations, "samples": nsamples}
+    reference = None
+    for n in cores:
+        t0 = time.perf_counter()
+        outputs = pairing.pair(num_job=n, ray_tracing=ray_tracing, output_file=None)
+        results[f"{n}_cores_s"] = time.perf_counter() - t0
+        results[f"{n}_cores_speedup"] = results[f"{cores[0]}_cores_s"]/results[f"{n}_cores_s"]
+        if reference is None:
+            reference = outputs
+        results["match_serial"] = results.get("match_serial", True) and all(
+            np.array_equal(reference[k][v], outputs[k][v]) for k in reference for v in ("ctm_SCD", "ctm_VCD_direct"))
+    return results
+
+
+def check_pair_memmap_reuse(nstations=4, nsamples=100):
+    '''
+        pairs twice in parallel with the same memmap_dir, the CTM fields being changed in between,
+        and compares each run with a serial pair of the same data
+        Output [dict]: whether both parallel runs match their serial pair
+    '''
+    pairing = pandoravsCTMs()
+    pairing.ctmdata = synthetic_ctm(nx=40, ny=30, nz=10, ndays=2)
+    pairing.pandora = [synthetic_pandora(nsamples, lon=-77.0 + 0.1*k, lat=39.0 - 0.1*k, seed=k)
+                       for k in range(nstations)]
+    results = {}
+    with tempfile.TemporaryDirectory() as memmap_dir:
+        for run in ('first', 'changed'):
+            if run == 'changed':
+                for ctm_granule in pairing.ctmdata:
+                    ctm_granule.partial_col_density = ctm_granule.partial_col_density*2.0
+            serial = pairing.pair(num_job=1)
+            parallel = pairing.pair(num_job=2, memmap_dir=memmap_dir)
+            results[f"{run}_match_serial"] = all(np.array_equal(serial[k]["ctm_VCD_direct"],
+                                                                parallel[k]["ctm_VCD_direct"]) for k in serial)
+    return results
+
+
+def bench_los_cache(ndays=30, max_sza=80.0, dsza=0.1, dsaa=0.1):
+    '''
+        measures the LOS path cache on a month of 10-min daytime samples with real sun geometry
+        Output [dict]: timings (s) without the cache, with a cold and a warm (second pass) cache,
+                       hit rates, speedups and the max relative difference of ctm_SCD
+    '''
+    ctm_data = synthetic_ctm(nx=40, ny=40, nz=20, ndays=ndays + 1, nhours=24)
+    times = pd.date_range('2024-01-01', periods=ndays*144, freq='10min', tz='UTC')
+    sza, saa = solar_angles(times, -77.0, 39.0)
+    day = sza < max_sza
+    rng = np.random.default_rng(0)
+    nsamples = int(np.sum(day))
+    pandora_data = pandora(pd.Series(times[day]), 39.0, -77.0, rng.random(nsamples)*10.0, rng.random(nsamples),
+                           1.0/np.cos(np.radians(sza[day])), sza[day], saa[day])
+    t0 = time.perf_counter()
+    scd = collocate(pandora_data, ctm_data, ray_tracing=True)["ctm_SCD"]
+    t_nocache = time.perf_counter() - t0
+    los_cache = LOSCache(dsza=dsza, dsaa=dsaa)
+    t0 = time.perf_counter()
+    scd_cold = collocate(pandora_data, ctm_data, ray_tracing=True, los_cache=los_cache)["ctm_SCD"]
+    t_cold = time.perf_counter() - t0
+    cold = los_cache.stats()
+    t0 = time.perf_counter()
+    collocate(pandora_data, ctm_data, ray_tracing=True, los_cache=los_cache)
+    t_warm = time.perf_counter() - t0
+    return {"samples": nsamples, "nocache_s": t_nocache, "cold_s": t_cold, "warm_s": t_warm,
+            "cold_hit_rate": cold["hit_rate"], "entries": cold["entries"],
+            "cold_speedup": t_nocache/t_cold, "warm_speedup": t_nocache/t_warm,
+            "max_rel_diff": float(np.max(np.abs(scd_cold - scd)/scd))}
+
+
+def bench_collocate_all(nstations=20, nsamples=1000):
+    '''
+        compares the per-station, per-sample collocate loop against the batched collocate_all
+        Output [dict]: timings (s), speedup and max relative difference of ctm_VCD_direct
+    '''
+    ctm_data = synthetic_ctm(ndays=8)
+    pandora_list = [synthetic_pandora(nsamples, lon=-77.0 + 0.1*k, lat=39.0 - 0.1*k, start='2024-01-01 00:00',
+                                      seed=k) for k in range(nstations)]
+    t0 = time.perf_counter()
+    outputs = [collocate(pandora_data, ctm_data) for pandora_data in pandora_list]
+    t_loop = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    table = collocate_all(pandora_list, ctm_data)
+    t_batched = time.perf_counter() - t0
+    vcd_loop = np.concatenate([output["ctm_VCD_direct"] for output in outputs])
+    return {"stations": nstations, "samples": nstations*nsamples, "loop_s": t_loop, "batched_s": t_batched,
+            "speedup": t_loop/t_batched,
+            "max_rel_diff": float(np.max(np.abs(table["ctm_VCD_direct"] - vcd_loop)/vcd_loop))}
+
+
+def bench_interpolation(nsamples=2000, nsamples_los=30, ds=50.0):
+    '''
+        compares the nearest-neighbour collocation against the space-time interpolation on a
+        field varying smoothly in space, height and time; the column error is measured against
+        the analytic column at the station position and sample time
+        Output [dict]: timings (s) of both paths for direct columns and ray tracing, the mean
+                       relative column error of each and the max relative difference of ctm_SCD
+    '''
+    ctm_data = synthetic_ctm(nx=40, ny=30, nz=25, ndays=3)
+    ny, nx = np.shape(ctm_data[0].latitude)
+    ii, jj = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+    start = np.datetime64('2024-01-01T00:00')
+
+    def field(i, j, hours):
+        return 1e16*(2.0 + np.sin(i/3.0)*np.cos(j/4.0) + 0.5*np.sin(2.0*np.pi*hours/24.0))
+
+    for ctm_granule in ctm_data:
+        hours = (_to_datetime64(ctm_granule.time) - start)/np.timedelta64(1, 'h')
+        ctm_granule.vcd = field(ii[np.newaxis], jj[np.newaxis], hours[:, np.newaxis, np.newaxis])
+        ctm_granule.partial_col_density = ctm_granule.partial_col_density*(
+            1.0 + 0.5*np.sin(2.0*np.pi*hours/24.0))[:, np.newaxis, np.newaxis, np.newaxis].astype('float32')
+    pandora_data = synthetic_pandora(nsamples, lon=-77.23, lat=39.17, start='2024-01-01 00:03', freq='2min')
+    y, x = station_position(ctm_data, grid_index(ctm_data), pandora_data.longitude, pandora_data.latitude)
+    truth = field(y, x, (_to_datetime64(pandora_data.time) - start)/np.timedelta64(1, 'h'))*1e-15
+    timings, errors = {}, {}
+    for interpolation in ('nearest', 'linear'):
+        t0 = time.perf_counter()
+        output = collocate(pandora_data, ctm_data, interpolation=interpolation)
+        timings[interpolation + "_s"] = time.perf_counter() - t0
+        errors[interpolation + "_mean_rel_err"] = float(np.mean(np.abs(output["ctm_VCD_direct"] - truth)/truth))
+    pandora_los = synthetic_pandora(nsamples_los, lon=-77.23, lat=39.17, start='2024-01-01 00:03', freq='7min')
+    scd = {}
+    for interpolation in ('nearest', 'linear'):
+        t0 = time.perf_counter()
+        scd[interpolation] = collocate(pandora_los, ctm_data, ds=ds, ray_tracing=True,
+                                       interpolation=interpolation)["ctm_SCD"]
+        timings[interpolation + "_ray_tracing_s"] = time.perf_counter() - t0
+    return dict(samples=nsamples, samples_ray_tracing=nsamples_los, **timings, **errors,
+                max_rel_diff_scd=float(np.max(np.abs(scd["linear"] - scd["nearest"])/scd["nearest"])))
+
+
+def check_subhourly_time_match(nsamples=500, seed=0):
+    '''
+        writes a CMAQ day file with half-hourly TFLAG steps (003000, 010000, ...), reads its times
+        and matches random sample times to them (nearest and linear, see match_ctm_time) against
+        a brute-force search
+        Output [dict]: whether the times read and both matches are right
+    '''
+    first, step = datetime.timedelta(minutes=30), datetime.timedelta(minutes=30)
+    day = datetime.date(2024, 1, 1)
+    ctm_granule = synthetic_ctm(nx=2, ny=2, nz=1, ndays=1, nhours=48)[0]
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'CCTM_CONC_v54_20240101.nc')
+        _write_ioapi(filename, day, {'NO2': np.zeros((48, 1, 2, 2))}, first=first, step=step)
+        with Dataset(filename) as nc:
+            ctm_granule.time = _cmaq_time(np.array(nc.variables['TFLAG']))
+    expected = [datetime.datetime.combine(day, datetime.time()) + first + t*step for t in range(48)]
+    time_ctm = np.array(expected, dtype='datetime64[ns]')
+    rng = np.random.default_rng(seed)
+    offsets = np.sort(rng.integers(30*60, 24*3600, nsamples))
+    time_pandora = pd.Series(pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(offsets, unit='s'))
+    samples = _to_datetime64(time_pandora)
+    # the closest step, ties going to the earlier one as argmin picks the first
+    nearest = np.argmin(np.abs(samples[:, np.newaxis] - time_ctm[np.newaxis, :]), axis=1)
+    _, hour = match_ctm_time(time_pandora, [ctm_granule])
+    lower = np.minimum((offsets - 30*60)//1800, 47)
+    _, hour0, _, hour1, weight = match_ctm_time(time_pandora, [ctm_granule], interpolate=True)
+    weight_expected = np.where(hour1 > hour0, ((offsets - 30*60) % 1800)/1800.0, 0.0)
+    return dict(times_match=ctm_granule.time == expected, nearest_match=bool(np.array_equal(hour, nearest)),
+                linear_match=bool(np.array_equal(hour0, lower) and np.allclose(weight, weight_expected)))
+
+
+def bench_downloader(nstations=3, nrows=2000):
+    '''
+        runs the downloader against a local PGN tree (see pgn_server): a first download, a
+        revalidation with nothing changed, a changed file, an interrupted refresh of a changed
+        file and an interrupted download whose file changed again before the next run
+        Output [dict]: the outcome counts of every run (see Downloader.run) and whether the
+                       local files end up identical to the served ones
+    '''
+    # requests and bs4 are dependencies of the downloader only
+    from downloader import Downloader, sanitize
+    with tempfile.TemporaryDirectory() as tmp:
+        tree, local = os.path.join(tmp, 'tree'), os.path.join(tmp, 'local')
+        files = synthetic_pgn_tree(tree, nstations=nstations, nrows=nrows)
+        paths = [os.path.relpath(f, tree).split(os.sep) for f in files]
+        outcomes = {}
+
+        def change(k, seed):
+            synthetic_pandora_file(files[k], nrows=nrows, lon=-77.0 + 0.1*k, lat=39.0, seed=seed)
+
+        with pgn_server(tree) as (base_url, interrupt):
+            def run(name):
+                outcomes[name] = Downloader(base_url, local, num_workers=4, rate=None, chunk_size=1 << 14).run()
+
+            run('first')
+            run('revalidation')
+            change(0, 100)
+            run('changed')
+            change(1, 101)
+            interrupt['/' + '/'.join(paths[1])] = os.path.getsize(files[1])//2
+            run('interrupted_refresh')
+            run('resumed')
+            change(2, 102)
+            interrupt['/' + '/'.join(paths[2])] = os.path.getsize(files[2])//2
+            run('interrupted')
+            change(2, 103)
+            run('changed_since_interrupted')
+        match = True
+        for filename, (station, instrument, _, name) in zip(files, paths):
+            with open(filename, 'rb') as f, open(os.path.join(local, f"{sanitize(station + '/')}_"
+                                                              f"{sanitize(instrument + '/')}_{sanitize(name)}"),
+                                                 'rb') as g:
+                match = match and f.read() == g.read()
+    return dict(outcomes, match=match)
+
+
+def _best_time(run, repeat):
+    # best wall time (s) of repeated runs
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - t0)
+    return min(timings)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def flag_regressions(history: list, record: dict, tolerance=0.25):
+    '''
+        compares the timings of a suite run against the earlier runs of the same configuration
+             history [list]: the earlier records of the results file
+             record [dict]: the record of this run
+             tolerance [float]: the allowed slowdown relative to the median of the earlier runs
+        Output [dict]: (time, median of earlier runs) of each stage slower than allowed
+    '''
+    earlier = [r for r in history if r['config'] == record['config']]
+    regressions = {}
+    for name, value in record['timings'].items():
+        baseline = [r['timings'][name] for r in earlier if name in r['timings']]
+        if baseline and value > (1.0 + tolerance)*np.median(baseline):
+            regressions[name] = (value, float(np.median(baseline)))
+    return regressions
+
+
+def run_suite(results_file='benchmark_results.jsonl', nx=60, ny=50, nz=35, ndays=2, nsteps=25, nstations=5,
+              nrows=20000, ds=50.0, repeat=3, tolerance=0.25, workdir=None):
+    '''
+        end-to-end benchmark on synthetic CMAQ/MCIP NetCDF and PGN L2 files; times CMAQ_reader
+        (full and vcd_only), pandora_reader, collocate (direct and ray-traced, all stations) and
+        read_data + pair, appends the run to results_file and flags the stages that got slower
+        than the earlier runs of the same configuration
+             results_file [str]: the json-lines file of the results, None to not store them
+             nx, ny, nz, ndays, nsteps [int]: the CMAQ grid, layers, days and steps per day
+             nstations, nrows [int]: the number of stations and of measurements per station
+             ds [float]: the LOS step (m) of the ray tracing
+             repeat [int]: the best of repeat runs is kept
+             tolerance [float]: see flag_regressions
+             workdir [str]: optional folder of the files, a temporary one by default
+        Output [dict]: the stored record and the flagged regressions
+    '''
+    config = dict(nx=nx, ny=ny, nz=nz, ndays=ndays, nsteps=nsteps, nstations=nstations, nrows=nrows, ds=ds)
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(workdir or tmp)
+        cmaq = (folder / 'cmaq').as_posix()
+        start = datetime.date(2024, 1, 1)
+        days = synthetic_cmaq_files(cmaq, nx=nx, ny=ny, nz=nz, ndays=ndays, nsteps=nsteps, start=start)
+        files = synthetic_pgn_files((folder / 'pgn').as_posix(), nstations=nstations, nrows=nrows, ndays=ndays,
+                                    nx=nx, ny=ny, start=start.isoformat())
+        YYYYMMDD1, YYYYMMDD2 = days[0], days[-1]
+        timings = {}
+        timings['CMAQ_reader'] = _best_time(lambda: CMAQ_reader(cmaq, cmaq, YYYYMMDD1[0:6], 'NO2'), repeat)
+        timings['CMAQ_reader_vcd_only'] = _best_time(
+            lambda: CMAQ_reader(cmaq, cmaq, YYYYMMDD1[0:6], 'NO2', vcd_only=True), repeat)
+        ctm_data = CMAQ_reader(cmaq, cmaq, YYYYMMDD1[0:6], 'NO2')
+        lat, lon = ctm_data[0].latitude, ctm_data[0].longitude
+        timings['pandora_reader'] = _best_time(
+            lambda: [pandora_reader(f, YYYYMMDD1, YYYYMMDD2, lat, lon) for f in files], repeat)
+        pandora_list = [p for p in (pandora_reader(f, YYYYMMDD1, YYYYMMDD2, lat, lon) for f in files)
+                        if p is not None]
+        timings['collocate_direct'] = _best_time(
+            lambda: [collocate(p, ctm_data) for p in pandora_list], repeat)
+        timings['collocate_ray_tracing'] = _best_time(
+            lambda: [collocate(p, ctm_data, ds=ds, ray_tracing=True) for p in pandora_list], repeat)
+
+        def end_to_end():
+            pairing = pandoravsCTMs()
+            pairing.read_data('CMAQ', folder / 'cmaq', 'NO2', folder / 'pgn', YYYYMMDD1, YYYYMMDD2,
+                              mcip_dir=folder / 'cmaq')
+            pairing.pair(output_file=(folder / 'pair.nc').as_posix())
+        timings['pair'] = _best_time(end_to_end, repeat)
+
+    record = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': _git_commit(),
+              'config': config, 'samples': int(sum(np.size(p.column) for p in pandora_list)),
+              'timings': timings}
+    history = []
+    if results_file is not None and os.path.isfile(results_file):
+        with open(results_file) as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    regressions = flag_regressions(history, record, tolerance)
+    if results_file is not None:
+        with open(results_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    record['regressions'] = regressions
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pandoravsCTMs benchmarks")
+    parser.add_argument('--suite', action='store_true',
+                        help="run only the end-to-end suite on synthetic files (see run_suite)")
+    parser.add_argument('--results', default='benchmark_results.jsonl', help="the json-lines file of the suite")
+    for name, default in [('nx', 60), ('ny', 50), ('nz', 35), ('ndays', 2), ('nstations', 5), ('nrows', 20000),
+                          ('repeat', 3)]:
+        parser.add_argument('--' + name, type=int, default=default)
+    args = parser.parse_args()
+    if args.suite:
+        record = run_suite(args.results, nx=args.nx, ny=args.ny, nz=args.nz, ndays=args.ndays,
+                           nstations=args.nstations, nrows=args.nrows, repeat=args.repeat)
+        print(json.dumps(record, indent=1))
+        # a non-zero exit status flags the regressions, e.g., in CI
+        sys.exit(1 if record['regressions'] else 0)
+    print(bench_ray_tracing())
+    print(bench_integration())
+    print(bench_grid_index())
+    print(bench_pandora_reader())
+    print(bench_pair_scaling())
+    print(check_pair_memmap_reuse())
+    print(bench_collocate_all())
+    print(bench_los_cache())
+    print(bench_interpolation())
+    print(check_subhourly_time_match())
+    print(bench_downloader())
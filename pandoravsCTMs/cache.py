@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from config import ctm_model
+
+# bump whenever the derived fields written by the readers change
+READER_VERSION = '2'
+
+_ARRAYS = ['latitude', 'longitude', 'partial_col_density', 'Z', 'DZ', 'vcd']
+
+
+def cache_key(files: list, gasname: str, window=None, options=None):
+    '''
+        builds the cache key of a derived ctm granule
+             files [list]: the source files the granule is derived from
+             gasname [str]: the name of the gas
+             window [tuple]: optional (i0, i1, j0, j1) grid window
+             options: any other reader options changing the derived fields
+        Output [str]: a hex digest that changes with paths, mtimes, sizes, gas, window, options
+                      and reader version
+    '''
+    h = hashlib.sha1()
+    h.update(f"{READER_VERSION}|{gasname}|{window}|{options}".encode())
+    for f in files:
+        st = os.stat(f)
+        h.update(f"|{os.path.abspath(f)}|{st.st_mtime_ns}|{st.st_size}".encode())
+    return h.hexdigest()
+
+
+def load_granule(cache_dir: str, key: str):
+    '''
+        maps a cached granule into memory
+        Output [ctm_model]: the granule with memory-mapped arrays, or None if it is not cached
+    '''
+    folder = os.path.join(cache_dir, key)
+    if not os.path.isfile(os.path.join(folder, 'meta.json')):
+        return None
+    with open(os.path.join(folder, 'meta.json')) as f:
+        meta = json.load(f)
+    # fields missing from a granule (e.g., 3-D fields of column-only reads) are not stored
+    arrays = {name: None for name in _ARRAYS}
+    for name in meta['arrays']:
+        arrays[name] = np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+    layers = None
+    if meta['layers'] is not None:
+        layers = {name: np.load(os.path.join(folder, 'layer_' + name + '.npy'), mmap_mode='r')
+                  for name in meta['layers']}
+    time = np.load(os.path.join(folder, 'time.npy')).astype('datetime64[us]').tolist()
+    window = None if meta['window'] is None else tuple(meta['window'])
+    return ctm_model(arrays['latitude'], arrays['longitude'], time, arrays['partial_col_density'],
+                     arrays['Z'], arrays['DZ'], meta['ctmtype'], window=window, vcd=arrays['vcd'],
+                     vcd_layers=layers)
+
+
+def save_granule(cache_dir: str, key: str, granule):
+    '''
+        writes a granule to the cache (atomically) and returns its memory-mapped copy
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    folder = os.path.join(cache_dir, key)
+    if not os.path.isdir(folder):
+        tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp_')
+        arrays = [name for name in _ARRAYS if getattr(granule, name) is not None]
+        for name in arrays:
+            np.save(os.path.join(tmp, name + '.npy'), np.asarray(getattr(granule, name)))
+        layers = None
+        if granule.vcd_layers is not None:
+            layers = list(granule.vcd_layers)
+            for name in layers:
+                np.save(os.path.join(tmp, 'layer_' + name + '.npy'), np.asarray(granule.vcd_layers[name]))
+        np.save(os.path.join(tmp, 'time.npy'), np.array(granule.time, dtype='datetime64[us]'))
+        # meta.json is written last and marks a complete entry
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'ctmtype': granule.ctmtype, 'window': granule.window, 'arrays': arrays,
+                       'layers': layers, 'version': READER_VERSION}, f)
+        try:
+            os.replace(tmp, folder)
+        except OSError:
+            # another process cached the same granule first
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+    return load_granule(cache_dir, key)
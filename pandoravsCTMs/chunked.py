@@ -0,0 +1,177 @@
+import numpy as np
+import dask
+import dask.array as da
+from netCDF4 import Dataset
+from config import ctm_model
+from reader import NC_LOCK, CMAQ_files, calculate_molec_density, pandora_reader, _cmaq_time, _read_nc, _read_nc_vars
+from collocate import match_ctm_time, _to_datetime64
+from spatial import grid_index
+
+# the 3-D fields a column is derived from
+_FIELDS = ['gas', 'PRES', 'TA', 'ZH', 'ZF']
+# rough number of (level, y, x) float32 fields alive at once while a chunk is reduced to a column
+_FIELDS_IN_FLIGHT = 12
+
+
+class _NCDays(object):
+    '''
+        array-like proxy of a (TSTEP, ...) netCDF variable spread over day files, with the days
+        concatenated along time; every read opens the files it needs so that the proxy is
+        cheap to pickle to worker processes
+    '''
+
+    def __init__(self, filenames: list, var: str) -> None:
+        self.filenames = filenames
+        self.var = var
+        self.steps = []
+        with NC_LOCK:
+            for filename in filenames:
+                nc_fid = Dataset(filename, 'r')
+                self.steps.append(nc_fid.variables[var].shape[0])
+                shape = tuple(nc_fid.variables[var].shape[1:])
+                self.dtype = np.dtype(nc_fid.variables[var].dtype)
+                nc_fid.close()
+        self.offsets = np.cumsum([0] + self.steps)
+        self.shape = (int(self.offsets[-1]),) + shape
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        t0, t1, _ = key[0].indices(self.shape[0])
+        outs = []
+        with NC_LOCK:
+            for n, filename in enumerate(self.filenames):
+                start, stop = max(t0, self.offsets[n]), min(t1, self.offsets[n + 1])
+                if start >= stop:
+                    continue
+                nc_fid = Dataset(filename, 'r')
+                outs.append(np.array(nc_fid.variables[self.var][(slice(start - self.offsets[n],
+                                                                     stop - self.offsets[n]),) + key[1:]]))
+                nc_fid.close()
+        return np.concatenate(outs, axis=0)
+
+
+def chunk_shape(shape: tuple, memory_limit=2e9, num_workers=1):
+    '''
+        picks (time, level, row, col) chunks of a CMAQ variable so that the fields of all
+        workers fit in memory_limit; whole levels and columns are kept in a chunk so that
+        the column integration never crosses chunks
+             shape [tuple]: the (TSTEP, LAY, ROW, COL) shape of a day file
+             memory_limit [float]: the memory budget (bytes) of all workers together
+             num_workers [int]: the number of workers
+        Output [tuple]: the chunk shape
+    '''
+    nsteps, nlevels, ny, nx = shape
+    budget = memory_limit/num_workers
+    step_bytes = _FIELDS_IN_FLIGHT*nlevels*ny*nx*4.0
+    if step_bytes <= budget:
+        return (int(min(nsteps, budget//step_bytes)), nlevels, ny, nx)
+    # a time step does not fit so the rows are split
+    return (1, nlevels, int(max(1, ny*budget//step_bytes)), nx)
+
+
+def lazy_cmaq(dir_mcip: str, dir_cmaq: str, YYYYMM: str, gasname: str, days=None, memory_limit=2e9,
+              num_workers=1, chunks=None):
+    '''
+        exposes the cmaq conc and mcip fields of many days as chunked dask arrays; nothing is
+        read until the arrays are computed, and then only the chunks that are needed
+             dir_mcip [str]: the folder containing the mcip outputs
+             dir_cmaq [str]: the folder containing the cmaq conc outputs
+             YYYYMM [str]: the target month and year, e.g., 202005 (May 2020)
+             gasname [str]: the name of the gas to read
+             days [list]: optional YYYYMMDD days to read instead of the whole month (see CMAQ_files)
+             memory_limit [float], num_workers [int]: used to pick the chunks (see chunk_shape)
+             chunks [tuple]: optional (time, level, row, col) chunks instead
+        Output [tuple]: 2-D lat and lon, the list of times of each day and a dict of
+                        (time, level, y, x) arrays 'gas', 'PRES', 'TA', 'ZH', 'ZF' with the days concatenated
+    '''
+    cmaq_target_files, _, met_files_3d, grd_files_2d = CMAQ_files(dir_mcip, dir_cmaq, YYYYMM, days)
+    if len(cmaq_target_files) != len(met_files_3d):
+        raise Exception(
+            "the data are not consistent")
+    if not cmaq_target_files:
+        raise Exception("no cmaq day file was found")
+    if gasname == 'HCHO':
+        gasname = 'FORM'
+    lat, lon = _read_nc_vars(grd_files_2d[0], ['LAT', 'LON'])
+    times = [_cmaq_time(_read_nc(cmaq_target_file, 'TFLAG')) for cmaq_target_file in cmaq_target_files]
+    arrays = {}
+    for name, filenames, var in zip(_FIELDS, [cmaq_target_files] + [met_files_3d]*4,
+                                    [gasname, 'PRES', 'TA', 'ZH', 'ZF']):
+        variable = _NCDays(filenames, var)
+        if chunks is None:
+            chunks = chunk_shape((max(variable.steps),) + variable.shape[1:], memory_limit, num_workers)
+        # time chunks never straddle two days so that a chunk is read from one file
+        time_chunks = tuple(min(chunks[0], steps - t) for steps in variable.steps
+                            for t in range(0, steps, chunks[0]))
+        # the proxy is inlined in the read tasks so that reads fuse with the column integration
+        arrays[name] = da.from_array(variable, chunks=(time_chunks,) + tuple(chunks[1:]), lock=False,
+                                     inline_array=True, meta=np.array((), dtype=variable.dtype))
+    return lat, lon, times, arrays
+
+
+def lazy_columns(arrays: dict):
+    '''
+        builds the task graph of the vertical columns from the lazy fields of lazy_cmaq;
+        each chunk is converted to molecular density and integrated on its own
+        Output [dask.array.Array]: the (time, y, x) column
+    '''
+    prs = arrays['PRES'].astype('float32')/100.0  # hPa
+    ZH = arrays['ZH'].astype('float32')
+    ZF = arrays['ZF'].astype('float32')
+    DZ = (ZF-ZH)*2.0
+    gas = calculate_molec_density(arrays['gas'].astype('float32'), prs, arrays['TA'].astype('float32'))
+    return da.nansum(gas*DZ, axis=1)
+
+
+def collocate_chunked(pandora_list, lat, lon, times, vcd, scheduler='processes', num_workers=1):
+    '''
+        collocates the samples of all stations against a lazy column (see lazy_columns);
+        only the column chunks holding a station cell at a matched hour are computed
+             pandora_list [list]: pandora objects (None entries are skipped)
+             lat, lon [np.ndarray]: the 2-D grid, times [list]: the times of each day (see lazy_cmaq)
+             vcd [dask.array.Array]: the (time, y, x) column with the days concatenated
+             scheduler [str]: the dask scheduler, 'processes', 'threads' or 'synchronous'
+             num_workers [int]: the number of workers of the scheduler
+        Output [dict]: the columnar table of collocate_all
+    '''
+    stations = [k for k, p in enumerate(pandora_list) if p is not None and np.size(p.column) > 0]
+    if not stations:
+        return None
+    sizes = [np.size(pandora_list[k].column) for k in stations]
+    station = np.repeat(stations, sizes)
+    time_all = np.concatenate([_to_datetime64(pandora_list[k].time) for k in stations])
+    column = np.concatenate([pandora_list[k].column for k in stations])
+    amf = np.concatenate([pandora_list[k].amf for k in stations])
+
+    # time matching and grid cells only need the times and the grid
+    ctm_data = [ctm_model(lat, lon, t, None, None, None, 'CMAQ') for t in times]
+    granule, hour = match_ctm_time(time_all, ctm_data)
+    index = grid_index(ctm_data)
+    cells = np.array([index.station_cell(pandora_list[k].longitude, pandora_list[k].latitude) for k in stations])
+    i = np.repeat(cells[:, 0], sizes)
+    j = np.repeat(cells[:, 1], sizes)
+    offsets = np.cumsum([0] + [len(t) for t in times])
+    ctm_VCD_direct = vcd.vindex[offsets[granule] + hour, i, j].compute(scheduler=scheduler,
+                                                                     num_workers=num_workers)
+
+    return {
+        "station": station,
+        "time": time_all.astype('int64') / 1e9 / 86400 + 719529,
+        "lat": np.repeat([pandora_list[k].latitude for k in stations], sizes),
+        "lon": np.repeat([pandora_list[k].longitude for k in stations], sizes),
+        "ctm_VCD_direct": np.asarray(ctm_VCD_direct, dtype=float)*1e-15,
+        "pandora_VCD": column,
+        "pandora_VCD_err": np.concatenate([pandora_list[k].uncertainty for k in stations]),
+        "pandora_SCD": column*amf
+    }
+
+
+def read_pandora_chunked(files: list, YYYYMMDD1: str, YYYYMMDD2: str, lat_ctm, lon_ctm, scheduler='processes',
+                         num_workers=1):
+    '''
+        parses the L2 files as tasks of the same scheduler (see reader.pandora_reader)
+        Output [list]: a pandora @dataclass per file, None if outside the domain or without data
+    '''
+    tasks = [dask.delayed(pandora_reader)(filename, YYYYMMDD1, YYYYMMDD2, lat_ctm, lon_ctm) for filename in files]
+    return list(dask.compute(*tasks, scheduler=scheduler, num_workers=num_workers))
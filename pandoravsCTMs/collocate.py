@@ -1,9 +1,78 @@
+import logging
 from pathlib import Path
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator
-from pyproj import Geod
+from raytracing import ray_trace_scd, exact_trace_scd, interp_trace_scd, local_grid_frame
+from los_cache import cached_trace_scd
+from spatial import grid_index, bilinear
+from profiling import stage, count
 
-def collocate(pandora_data, ctm_data, ds=5.0, max_dist=100000.0, alt0=2.0, ray_tracing=False):
+logger = logging.getLogger('pandoravsCTMs.collocate')
+
+
+def _to_datetime64(times):
+    # pandas Series (possibly tz-aware UTC) or a sequence of datetime objects to naive datetime64[ns]
+    if hasattr(times, 'dt'):
+        if times.dt.tz is not None:
+            times = times.dt.tz_convert(None)
+        return times.to_numpy(dtype='datetime64[ns]')
+    return np.array(times, dtype='datetime64[ns]')
+
+
+def match_ctm_time(pandora_time, ctm_data, interpolate=False):
+    """
+    Matches all Pandora timestamps to CTM (granule, hour) pairs with a sorted search.
+
+    Granule boundaries come from the cumulative number of steps in each ctm_model.time,
+    so granules with 24 or 25 steps, or sub-hourly output, are all addressed correctly.
+
+    Args:
+        pandora_time: pandas Series or sequence of datetimes of the Pandora samples
+        ctm_data: List of ctm_model granules
+        interpolate (bool): Whether to return the bracketing CTM steps and linear weights
+
+    Returns:
+        tuple: (granule, hour) index arrays of the closest CTM step, or if interpolate is True,
+               (granule0, hour0, granule1, hour1, weight1) where the value at the sample time is
+               (1 - weight1) * value[granule0, hour0] + weight1 * value[granule1, hour1]
+    """
+    with stage('time_match'):
+        return _match_ctm_time(pandora_time, ctm_data, interpolate)
+
+
+def _match_ctm_time(pandora_time, ctm_data, interpolate):
+    time_ctm = [_to_datetime64(ctm_granule.time) for ctm_granule in ctm_data]
+    offsets = np.cumsum([0] + [np.size(t) for t in time_ctm])
+    time_ctm = np.concatenate(time_ctm).astype('int64')
+    order = np.argsort(time_ctm, kind='stable')
+    time_sorted = time_ctm[order]
+    time_pandora = _to_datetime64(pandora_time).astype('int64')
+
+    def to_granule_hour(pos):
+        # repeated steps (e.g. hour 24 of a day and hour 0 of the next) map to the first granule
+        pos = np.searchsorted(time_sorted, time_sorted[pos], side='left')
+        global_index = order[pos]
+        granule = np.searchsorted(offsets, global_index, side='right') - 1
+        return granule, global_index - offsets[granule]
+
+    right = np.clip(np.searchsorted(time_sorted, time_pandora, side='left'), 0, np.size(time_sorted) - 1)
+    left = np.clip(right - 1, 0, None)
+    if interpolate == False:
+        # ties go to the earlier step
+        closer_left = (time_pandora - time_sorted[left]) <= np.abs(time_sorted[right] - time_pandora)
+        return to_granule_hour(np.where(closer_left, left, right))
+    # bracketing steps; samples outside the CTM period take the edge step
+    lower = np.where(time_sorted[right] <= time_pandora, right, left)
+    upper = np.where(time_sorted[right] >= time_pandora, right, lower)
+    span = (time_sorted[upper] - time_sorted[lower]).astype(float)
+    weight = np.zeros(np.size(time_pandora))
+    np.divide((time_pandora - time_sorted[lower]).astype(float), span, out=weight, where=span > 0)
+    granule0, hour0 = to_granule_hour(lower)
+    granule1, hour1 = to_granule_hour(upper)
+    return granule0, hour0, granule1, hour1, weight
+
+
+def collocate(pandora_data, ctm_data, ds=5.0, max_dist=100000.0, alt0=2.0, ray_tracing=False, integration='step',
+              los_cache=None, interpolation='nearest'):
     """
     Efficiently collocates Pandora and CTM datasets by synchronizing time and performing ray-tracing.
 
@@ -13,6 +82,15 @@ def collocate(pandora_data, ctm_data, ds=5.0, max_dist=100000.0, alt0=2.0, ray_t
         ds (float): Step size in meters along LOS
         max_dist (float): Maximum distance along LOS in meters
         alt0 (float): Initial altitude in meters
+        ray_tracing (bool): Whether to compute the slant column along the sun LOS
+        integration (str): LOS integration method, 'step' for fixed ds steps or
+                           'exact' for exact path lengths in each crossed CTM cell (ds is ignored)
+        los_cache (LOSCache): optional cache of LOS paths reused across samples with the same
+                              (snapped) sun geometry, for the 'step' integration only
+        interpolation (str): 'nearest' to take the CTM cell and step closest to each sample, or
+                             'linear' to interpolate bilinearly in the horizontal, in height along Z
+                             (ray tracing) and linearly in time between the bracketing CTM steps;
+                             'linear' ray tracing uses the 'step' integration without los_cache
 
     Returns:
         dict: Collocated results with keys 'ctm_SCD', 'ctm_VCD', 'pandora_VCD', 'pandora_VCD_err', 'pandora_SCD'
@@ -20,102 +98,246 @@ def collocate(pandora_data, ctm_data, ds=5.0, max_dist=100000.0, alt0=2.0, ray_t
     if pandora_data is None:
        return None
 
-    print('Colocating Pandora and CTM...')
-    # Prepare CTM time arrays for efficient lookup
-    time_ctm = []
-    time_ctm_datetype = []
-    for ctm_granule in ctm_data:
-        times = np.array([t.year * 10000 + t.month * 100 + t.day +
-                          t.hour / 24.0 + t.minute / (60.0 * 24.0) + t.second / (3600.0 * 24.0)
-                          for t in ctm_granule.time])
-        time_ctm.append(times)
-        time_ctm_datetype.append(ctm_granule.time)
-    time_ctm = np.concatenate(time_ctm)
-
-    # Pandora time to comparable numeric format
-    time_pandora = np.array([t.year * 10000 + t.month * 100 + t.day +
-                             t.hour / 24.0 + t.minute / (60.0 * 24.0) + t.second / (3600.0 * 24.0)
-                             for t in pandora_data.time])
-
-    # Precompute CTM latitude/longitude arrays for NN matching
-    ctm_lon = ctm_data[0].longitude
-    ctm_lat = ctm_data[0].latitude
-    ctm_toa = np.max(ctm_data[0].Z.flatten())
-    geod = Geod(ellps='WGS84')
-    # Arrays to collect results
-    ctm_SCD, ctm_VCD_direct, ctm_VCD_raytracing, pandora_VCD, pandora_VCD_err, pandora_SCD, lat_pandora, lon_pandora = [], [], [], [], [], [], [], []
-
-    for t1, pandora_time in enumerate(pandora_data.time):
-        # Find closest CTM time
-        closest_index = np.argmin(np.abs(time_pandora[t1] - time_ctm))
-        closest_index_day = int(np.floor(closest_index / 25.0))
-        closest_index_hour = int(closest_index % 25)
-        print(f"Closest CTM file for Pandora at {pandora_time} is {time_ctm_datetype[closest_index_day][closest_index_hour]}.")
-        ctm_partial_col_dens = ctm_data[closest_index_day].partial_col_density[closest_index_hour, ...]
-        ctm_DZ = ctm_data[closest_index_day].DZ[closest_index_hour, ...]
-        ctm_Z = ctm_data[closest_index_day].Z[closest_index_hour, ...]
-        if ray_tracing == True:
-           # LOS points
-           s = np.arange(0, max_dist, ds)
-           azi = pandora_data.saa[t1]
-           zen = pandora_data.sza[t1]
-           lon0 = pandora_data.longitude
-           lat0 = pandora_data.latitude
-           # Compute LOS coordinates (vectorized)
-           x = s * np.sin(np.radians(zen))
-           y = s * np.cos(np.radians(zen))
-           lons, lats, alts = (np.zeros_like(s) for _ in range(3))
-           for i in range(0,np.size(s)):
-              lons[i], lats[i], _ = geod.fwd(lon0, lat0, azi, x[i])
-              alts[i] = alt0 + y[i]
-              if alts[i] > ctm_toa:
-                 break
-           # Find nearest CTM grid points (vectorized)
-           # Flatten CTM grid for fast search
-           ctm_lon_flat = ctm_lon.flatten()
-           ctm_lat_flat = ctm_lat.flatten()
-
-           ctm_SCD_temp = 0.0
-           for lon, lat, alt in zip(lons, lats, alts):
-              if (lon == 0.0) | (lat == 0.0) | (alt==0.0):
-                 continue
-              # Find closest grid point index using KDTree for speed (if available)
-              distances = np.sqrt((ctm_lon_flat - lon) ** 2 + (ctm_lat_flat - lat) ** 2)
-              idx_flat = np.argmin(distances)
-              i, j = np.unravel_index(idx_flat, ctm_lon.shape)
-              # Find closest altitude index
-              z_cost = np.abs(ctm_Z[:, i, j] - alt)
-              k = np.argmin(z_cost)
-              #print(f"the altitude is at {alt} and the model alt is at {ctm_Z[k,i,j]}")
-              # Integrate partial column density
-              ctm_SCD_temp += ctm_partial_col_dens[k, i, j] * ds
+    if ray_tracing == True and ctm_data[0].partial_col_density is None:
+        raise Exception("ray tracing needs the 3-D CTM fields; read the CTM without vcd_only")
+    if interpolation not in ('nearest', 'linear'):
+        raise Exception("the interpolation should be 'nearest' or 'linear'")
+    if interpolation == 'linear' and ray_tracing == True and (integration != 'step' or los_cache is not None):
+        raise Exception("linear interpolation traces the LOS with the 'step' integration and no los_cache")
+    if ray_tracing == True and integration == 'exact' and los_cache is not None:
+        raise Exception("the los_cache only holds 'step' LOS paths; trace the 'exact' integration without it")
+
+    lon0 = pandora_data.longitude
+    lat0 = pandora_data.latitude
+    nsamples = np.size(pandora_data.column)
+    logger.info(f"Colocating {nsamples} Pandora samples at ({lon0}, {lat0}) and CTM...")
+    count('samples', nsamples)
+    # the station cell never changes within a file
+    with stage('grid_lookup'):
+        index = grid_index(ctm_data)
+        i, j = index.station_cell(lon0, lat0)
+
+    # Find closest CTM time of all samples at once
+    if interpolation == 'linear':
+        granule0, hour0, granule1, hour1, weight = match_ctm_time(pandora_data.time, ctm_data, interpolate=True)
+        # ties go to the earlier step as in the nearest matching
+        closest_index_day_all = np.where(weight > 0.5, granule1, granule0)
+        closest_index_hour_all = np.where(weight > 0.5, hour1, hour0)
+    else:
+        closest_index_day_all, closest_index_hour_all = match_ctm_time(pandora_data.time, ctm_data)
+    if logger.isEnabledFor(logging.DEBUG):
+        # per-sample messages only at the debug level
+        for pandora_time, closest_index_day, closest_index_hour in zip(pandora_data.time, closest_index_day_all,
+                                                                       closest_index_hour_all):
+            logger.debug(f"Closest CTM file for Pandora at {pandora_time} is "
+                         f"{ctm_data[closest_index_day].time[closest_index_hour]}.")
+
+    with stage('integration'):
+        ctm_SCD_raytracing = np.zeros(nsamples)
+        if ray_tracing == True and interpolation == 'linear':
+            ctm_toa = np.max(ctm_data[0].Z.flatten())
+            ctm_SCD_raytracing = interp_trace_scd(lon0, lat0,
+                                                  pandora_data.sza, pandora_data.saa,
+                                                  granule0, hour0, granule1, hour1, weight, ctm_data,
+                                                  index, ds=ds, max_dist=max_dist,
+                                                  alt0=alt0, toa=ctm_toa)
+        elif ray_tracing == True and integration == 'exact':
+            ctm_SCD_raytracing = exact_trace_scd(lon0, lat0,
+                                                 pandora_data.sza, pandora_data.saa,
+                                                 closest_index_day_all, closest_index_hour_all, ctm_data,
+                                                 index, max_dist=max_dist, alt0=alt0)
+        elif ray_tracing == True and los_cache is not None:
+            ctm_toa = np.max(ctm_data[0].Z.flatten())
+            ctm_SCD_raytracing = cached_trace_scd(lon0, lat0,
+                                                  pandora_data.sza, pandora_data.saa,
+                                                  closest_index_day_all, closest_index_hour_all, ctm_data,
+                                                  index, los_cache, ds=ds, max_dist=max_dist,
+                                                  alt0=alt0, toa=ctm_toa)
+        elif ray_tracing == True:
+            # LOS of all samples are traced in batches
+            ctm_toa = np.max(ctm_data[0].Z.flatten())
+            ctm_SCD_raytracing = ray_trace_scd(lon0, lat0,
+                                               pandora_data.sza, pandora_data.saa,
+                                               closest_index_day_all, closest_index_hour_all, ctm_data,
+                                               index, ds=ds, max_dist=max_dist,
+                                               alt0=alt0, toa=ctm_toa)
+
+        # the 2-D column field is integrated once per granule (or read as such with vcd_only)
+        station_i = np.full(nsamples, i)
+        station_j = np.full(nsamples, j)
+        if interpolation == 'linear':
+            y, x = station_position(ctm_data, index, lon0, lat0)
+            CMAQ_VC = interpolate_columns(ctm_data, column_density, granule0, hour0, granule1, hour1, weight, y, x)
+            layers = {}
+            if ctm_data[0].vcd_layers is not None:
+                for name in ctm_data[0].vcd_layers:
+                    layers["ctm_VCD_" + name] = interpolate_columns(
+                        ctm_data, lambda ctm_granule: ctm_granule.vcd_layers[name],
+                        granule0, hour0, granule1, hour1, weight, y, x)*1e-15
         else:
-           ctm_SCD_temp = 0.0
-           ctm_lon_flat = ctm_lon.flatten()
-           ctm_lat_flat = ctm_lat.flatten()
-           lon0 = pandora_data.longitude
-           lat0 = pandora_data.latitude
-
-        distances = np.sqrt((ctm_lon_flat - lon0) ** 2 + (ctm_lat_flat - lat0) ** 2)
-        idx_flat = np.argmin(distances)
-        i, j = np.unravel_index(idx_flat, ctm_lon.shape)
-        CMAQ_VC = np.nansum(ctm_partial_col_dens[:,i,j]*ctm_DZ[:, i, j])
-        amf = pandora_data.amf[t1]
-        pandora_VCD.append(pandora_data.column[t1])
-        pandora_VCD_err.append(pandora_data.uncertainty[t1])
-        pandora_SCD.append(pandora_data.column[t1] * amf)
-        ctm_SCD.append(ctm_SCD_temp*1e-15)
-        ctm_VCD_direct.append(CMAQ_VC*1e-15)
-        ctm_VCD_raytracing.append(ctm_SCD_temp*1e-15 / amf if amf != 0 else np.nan)
-
-    return {
-        "ctm_SCD": np.array(ctm_SCD),
-        "ctm_VCD_direct": np.array(ctm_VCD_direct),
-        "ctm_VCD_raytracing": np.array(ctm_VCD_raytracing),
-        "pandora_VCD": np.array(pandora_VCD),
-        "pandora_VCD_err": np.array(pandora_VCD_err),
-        "pandora_SCD": np.array(pandora_SCD),
+            CMAQ_VC = gather_columns(ctm_data, column_density, closest_index_day_all, closest_index_hour_all,
+                                     station_i, station_j)
+            layers = partial_columns(ctm_data, closest_index_day_all, closest_index_hour_all, station_i, station_j)
+    amf = np.asarray(pandora_data.amf)
+    column = np.asarray(pandora_data.column)
+    ctm_SCD = ctm_SCD_raytracing*1e-15
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ctm_VCD_raytracing = np.where(amf != 0, ctm_SCD / amf, np.nan)
+
+    output = {
+        "ctm_SCD": ctm_SCD,
+        "ctm_VCD_direct": CMAQ_VC*1e-15,
+        "ctm_VCD_raytracing": ctm_VCD_raytracing,
+        "pandora_VCD": column,
+        "pandora_VCD_err": np.asarray(pandora_data.uncertainty),
+        "pandora_SCD": column * amf,
         "time":   np.array(pandora_data.time.view('int64') / 1e9 / 86400  + 719529),
         "lat": lat0,
         "lon": lon0
     }
+    output.update(layers)
+    return output
+
+
+def station_position(ctm_data, index, lon0: float, lat0: float):
+    """
+    Returns the fractional (row, col) grid indices of a station, from the local grid frame of its cell.
+    """
+    i, j = index.station_cell(lon0, lat0)
+    p0, _ = local_grid_frame(ctm_data[0].longitude, ctm_data[0].latitude, i, j, lon0, lat0)
+    return np.clip(p0[0], 0, index.shape[0] - 1), np.clip(p0[1], 0, index.shape[1] - 1)
+
+
+def gather_columns(ctm_data, field, granule, hour, i, j):
+    """
+    Gathers a (time, y, x) field of the granules, e.g., column_density, at many (granule, hour, i, j).
+    """
+    values = np.full(np.size(granule), np.nan)
+    for g in np.unique(granule):
+        sel = granule == g
+        values[sel] = field(ctm_data[g])[hour[sel], i[sel], j[sel]]
+    return values
+
+
+def interpolate_columns(ctm_data, field, granule0, hour0, granule1, hour1, weight, y, x):
+    """
+    Interpolates a (time, y, x) field of the granules, e.g., column_density, at many samples:
+    bilinearly at the fractional grid indices (y, x) and linearly in time between the
+    bracketing steps found by match_ctm_time(interpolate=True).
+    """
+    values = np.zeros(np.size(weight))
+    y = np.broadcast_to(y, np.shape(weight))
+    x = np.broadcast_to(x, np.shape(weight))
+    for granule, hour, w in ((granule0, hour0, 1.0 - weight), (granule1, hour1, weight)):
+        for g in np.unique(granule[w > 0]):
+            sel = (granule == g) & (w > 0)
+            # the interpolator runs over the grid and returns every step of the granule at each sample
+            steps = bilinear(field(ctm_data[g]), y[sel], x[sel])
+            values[sel] += w[sel]*steps[np.arange(np.count_nonzero(sel)), hour[sel]]
+    return values
+
+
+class _ColumnField(object):
+    """
+    The vertical column field (time, y, x) of a granule with 3-D fields, integrated over the levels
+    of the indexed cells only, e.g., the station cells, so that the whole domain is never integrated
+    and only the pages of memory-mapped fields holding these cells are read.
+    """
+
+    def __init__(self, ctm_granule) -> None:
+        self.ctm_granule = ctm_granule
+        shape = np.shape(ctm_granule.partial_col_density)
+        self.shape = (shape[0],) + tuple(shape[2:])
+
+    def __getitem__(self, key):
+        # (hour, i, j) index arrays as in gather_columns or (..., rows, cols) slices as in bilinear
+        hour, i, j = (slice(None),) + key[1:] if key[0] is Ellipsis else key
+        cells = (hour, slice(None), i, j)
+        layers = self.ctm_granule.partial_col_density[cells]*self.ctm_granule.DZ[cells]
+        if isinstance(i, np.ndarray):
+            # index arrays put the gathered cells first; levels are moved back in front so that
+            # they are summed in the same order as over the whole field
+            return np.nansum(np.ascontiguousarray(np.moveaxis(layers, -1, 0)), axis=0)
+        return np.nansum(layers, axis=1)
+
+
+def column_density(ctm_granule):
+    """
+    Returns the vertical column field (time, y, x) of a granule: the one kept by the reader
+    (vcd_only) or one integrated on demand at the cells it is indexed with (see _ColumnField).
+    """
+    if ctm_granule.vcd is None:
+        return _ColumnField(ctm_granule)
+    return ctm_granule.vcd
+
+
+def partial_columns(ctm_data, granule, hour, i, j):
+    """
+    Gathers the partial columns (e.g., 'pbl', 'above_pbl') kept by the reader at many samples.
+
+    Returns:
+        dict: 'ctm_VCD_<layer>' arrays, empty if the granules have no partial columns
+    """
+    if ctm_data[0].vcd_layers is None:
+        return {}
+    outputs = {}
+    for name in ctm_data[0].vcd_layers:
+        values = gather_columns(ctm_data, lambda ctm_granule: ctm_granule.vcd_layers[name], granule, hour, i, j)
+        outputs["ctm_VCD_" + name] = values*1e-15
+    return outputs
+
+
+def collocate_all(pandora_list, ctm_data):
+    """
+    Collocates the samples of all stations in a single vectorized pass (no ray tracing).
+    Works on column-only (vcd_only) reads as well.
+
+    All samples are concatenated into flat arrays tagged with a station id; time matching,
+    grid cells and ctm_VCD_direct are found with array operations, the latter by gathering
+    the precomputed column field of each granule.
+
+    Args:
+        pandora_list: List of pandora objects (None entries are skipped)
+        ctm_data: List of ctm_model granules
+
+    Returns:
+        dict: One columnar table with a row per sample and keys 'station' (index in pandora_list),
+              'time', 'lat', 'lon', 'ctm_VCD_direct', 'pandora_VCD', 'pandora_VCD_err', 'pandora_SCD'
+              and 'ctm_VCD_<layer>' if the reader kept partial columns
+    """
+    stations = [k for k, p in enumerate(pandora_list) if p is not None and np.size(p.column) > 0]
+    if not stations:
+        return None
+    sizes = [np.size(pandora_list[k].column) for k in stations]
+    station = np.repeat(stations, sizes)
+    time_all = np.concatenate([_to_datetime64(pandora_list[k].time) for k in stations])
+    lat = np.repeat([pandora_list[k].latitude for k in stations], sizes)
+    lon = np.repeat([pandora_list[k].longitude for k in stations], sizes)
+    column = np.concatenate([pandora_list[k].column for k in stations])
+    uncertainty = np.concatenate([pandora_list[k].uncertainty for k in stations])
+    amf = np.concatenate([pandora_list[k].amf for k in stations])
+
+    count('samples', np.size(column))
+    granule, hour = match_ctm_time(time_all, ctm_data)
+    with stage('grid_lookup'):
+        index = grid_index(ctm_data)
+        cells = np.array([index.station_cell(pandora_list[k].longitude, pandora_list[k].latitude)
+                          for k in stations])
+    i = np.repeat(cells[:, 0], sizes)
+    j = np.repeat(cells[:, 1], sizes)
+    with stage('integration'):
+        ctm_VCD_direct = gather_columns(ctm_data, column_density, granule, hour, i, j)
+        layers = partial_columns(ctm_data, granule, hour, i, j)
+
+    output = {
+        "station": station,
+        "time": time_all.astype('int64') / 1e9 / 86400 + 719529,
+        "lat": lat,
+        "lon": lon,
+        "ctm_VCD_direct": ctm_VCD_direct*1e-15,
+        "pandora_VCD": column,
+        "pandora_VCD_err": uncertainty,
+        "pandora_SCD": column*amf
+    }
+    output.update(layers)
+    return output
@@ -24,6 +24,10 @@ class ctm_model:
     Z: np.ndarray
     DZ: np.ndarray
     ctmtype: str
+    grid_index: object = None
+    window: tuple = None
+    vcd: np.ndarray = None
+    vcd_layers: dict = None
 
 @dataclass
 class paired_data:
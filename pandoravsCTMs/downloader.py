@@ -1,53 +1,258 @@
 import os
+import json
 import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
+from email.utils import formatdate
 
 BASE_URL = "https://data.hetzner.pandonia-global-network.org/"
 LOCAL_DIR = "PGN_rnvs3_L2_files"  # all files will go here
-SLEEP_BETWEEN_REQUESTS = 1  # polite delay
+REQUESTS_PER_SECOND = 2.0  # polite rate shared by all workers
+
+logger = logging.getLogger('pandoravsCTMs.downloader')
 
-os.makedirs(LOCAL_DIR, exist_ok=True)
 
 def sanitize(s: str) -> str:
     return s.replace('/', '_').replace('\\', '_').replace(' ', '_').replace('.', '_')
 
-def get_links(url):
-    r = requests.get(url)
-    r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
-    hrefs = []
-    for link in soup.find_all('a'):
-        href = link.get('href')
-        if href and not href.startswith('?') and not href.startswith('/'):
-            hrefs.append(href)
-    return hrefs
-
-stations = [h for h in get_links(BASE_URL) if h.endswith('/')]
-
-for station in stations:
-    station_url = urljoin(BASE_URL, station)
-    instruments = [h for h in get_links(station_url) if h.endswith('/')]
-
-    for instrument in instruments:
-        instrument_url = urljoin(station_url, instrument)
-        l2_url = urljoin(instrument_url, "L2/")
+
+class RateLimiter(object):
+    '''
+        spaces requests of all threads at least 1/rate seconds apart
+    '''
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 0.0 if not rate else 1.0/rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Manifest(object):
+    '''
+        persisted validators (ETag/Last-Modified) of the listings and files already fetched,
+        used for conditional requests so that unchanged pages and files are not transferred again;
+        while a file is partially downloaded its entry keeps the validators of the part file
+        under 'part', apart from the ones of the complete file
+    '''
+
+    def __init__(self, manifest_file: str, save_interval=5.0) -> None:
+        '''
+            Input:
+                manifest_file [str]: the json file of the manifest
+                save_interval [float]: the min number of seconds between two saves (see flush)
+        '''
+        self.manifest_file = manifest_file
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.last_save = time.monotonic()
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                self.entries = json.load(f)
+
+    def get(self, url: str):
+        with self.lock:
+            return self.entries.get(url)
+
+    def set(self, url: str, entry: dict):
+        with self.lock:
+            self.entries[url] = entry
+            if time.monotonic() - self.last_save > self.save_interval:
+                self._save()
+
+    def flush(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.manifest_file)
+        self.last_save = time.monotonic()
+
+
+def _validators(resp):
+    return {'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified')}
+
+
+def _conditional_headers(entry):
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+class Downloader(object):
+    '''
+        concurrent, resumable downloader of PGN L2 files
+    '''
+
+    def __init__(self, base_url=BASE_URL, local_dir=LOCAL_DIR, product='rnvs3', num_workers=8,
+                 rate=REQUESTS_PER_SECOND, manifest_file=None, timeout=60, chunk_size=1 << 20) -> None:
+        '''
+            Input:
+                base_url [str]: the root of the PGN data tree (station/instrument/L2/ listings)
+                local_dir [str]: the folder the files are written to
+                product [str]: the L2 product in the file names, e.g., 'rnvs3'
+                num_workers [int]: the number of concurrent requests
+                rate [float]: the max number of requests per second of all workers, None for no limit
+                manifest_file [str]: the json manifest of validators; <local_dir>/manifest.json by default
+                timeout [float]: the connect/read timeout of a request in seconds
+                chunk_size [int]: the number of bytes written at a time
+        '''
+        self.base_url = base_url
+        self.local_dir = local_dir
+        self.product = product
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        os.makedirs(local_dir, exist_ok=True)
+        if manifest_file is None:
+            manifest_file = os.path.join(local_dir, 'manifest.json')
+        self.manifest = Manifest(manifest_file)
+        self.limiter = RateLimiter(rate)
+        self.local = threading.local()
+
+    def session(self):
+        '''
+            returns the pooled keep-alive session of the calling thread
+        '''
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            retry = Retry(total=5, backoff_factor=1.0, status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=['GET', 'HEAD'])
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.num_workers, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return self.local.session
+
+    def get_links(self, url: str):
+        '''
+            lists the links of a directory page, revalidating the listing saved in the manifest
+        '''
+        entry = self.manifest.get(url)
+        self.limiter.wait()
+        r = self.session().get(url, headers=_conditional_headers(entry), timeout=self.timeout)
+        if r.status_code == 304:
+            return entry['links']
+        r.raise_for_status()
+        soup = BeautifulSoup(r.text, "html.parser")
+        hrefs = []
+        for link in soup.find_all('a'):
+            href = link.get('href')
+            if href and not href.startswith('?') and not href.startswith('/'):
+                hrefs.append(href)
+        self.manifest.set(url, dict(_validators(r), links=hrefs))
+        return hrefs
+
+    def list_files(self):
+        '''
+            crawls the station and instrument listings concurrently
+            Output [list]: (file url, local file) of every L2 file of the product
+        '''
+        stations = [h for h in self.get_links(self.base_url) if h.endswith('/')]
+
+        def instruments_of(station):
+            station_url = urljoin(self.base_url, station)
+            return [(station, h) for h in self.get_links(station_url) if h.endswith('/')]
+
+        def files_of(station, instrument):
+            l2_url = urljoin(urljoin(self.base_url, station), instrument + "L2/")
+            try:
+                links = self.get_links(l2_url)
+            except Exception as e:
+                logger.warning(f"Skipping {l2_url} because {e}")
+                return []
+            return [(urljoin(l2_url, f), os.path.join(self.local_dir,
+                                                      f"{sanitize(station)}_{sanitize(instrument)}_{sanitize(f)}"))
+                    for f in links if self.product in f and f.endswith(".txt")]
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            instruments = [pair for pairs in pool.map(instruments_of, stations) for pair in pairs]
+            return [f for files in pool.map(lambda pair: files_of(*pair), instruments) for f in files]
+
+    def download(self, file_url: str, local_file: str):
+        '''
+            streams a file to disk; an unchanged file is skipped after revalidation and an
+            interrupted download is resumed with a Range request
+            Output [str]: 'unchanged', 'resumed' or 'downloaded'
+        '''
+        entry = self.manifest.get(file_url)
+        part_file = local_file + '.part'
+        headers = {}
+        if entry is not None and entry.get('partial'):
+            # an interrupted download is resumed only if the file has not changed since; its
+            # validators are kept apart from the ones of the complete file on disk, so the
+            # complete file is never revalidated against a body that was not fully received
+            part = entry.get('part', entry)
+            validator = part.get('etag') or part.get('last_modified')
+            if os.path.isfile(part_file) and validator:
+                headers = {'Range': f"bytes={os.path.getsize(part_file)}-", 'If-Range': validator}
+        elif os.path.isfile(local_file):
+            headers = _conditional_headers(entry)
+            if not headers:
+                # files fetched before the manifest existed are revalidated by their mtime
+                headers = {'If-Modified-Since': formatdate(os.path.getmtime(local_file), usegmt=True)}
+        self.limiter.wait()
+        with self.session().get(file_url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 304:
+                return 'unchanged'
+            r.raise_for_status()
+            resumed = r.status_code == 206
+            complete = {} if entry is None else {k: v for k, v in entry.items() if k != 'part'}
+            self.manifest.set(file_url, dict(complete, partial=True, part=_validators(r)))
+            logger.info(f"Downloading {file_url}")
+            with open(part_file, 'ab' if resumed else 'wb') as out:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    out.write(chunk)
+        # the complete file replaces the old one at once
+        os.replace(part_file, local_file)
+        self.manifest.set(file_url, dict(_validators(r), partial=False, size=os.path.getsize(local_file)))
+        return 'resumed' if resumed else 'downloaded'
+
+    def run(self):
+        '''
+            downloads every new, changed or incomplete L2 file
+            Output [dict]: the number of files per outcome ('unchanged', 'resumed', 'downloaded', 'failed')
+        '''
+        def fetch(item):
+            try:
+                return self.download(*item)
+            except Exception as e:
+                logger.warning(f"Failed {item[0]} because {e}")
+                return 'failed'
+
+        counts = {'unchanged': 0, 'resumed': 0, 'downloaded': 0, 'failed': 0}
         try:
-            files = get_links(l2_url)
-        except Exception as e:
-            print("Skipping", l2_url, "because", e)
-            continue
-
-        for f in files:
-            if "rnvs3" in f and f.endswith(".txt"):
-                file_url = urljoin(l2_url, f)
-                safe_name = f"{sanitize(station)}_{sanitize(instrument)}_{sanitize(f)}"
-                local_file = os.path.join(LOCAL_DIR, safe_name)
-                if not os.path.exists(local_file):
-                    print("Downloading", file_url)
-                    resp = requests.get(file_url)
-                    resp.raise_for_status()
-                    with open(local_file, "wb") as out:
-                        out.write(resp.content)
-                    time.sleep(SLEEP_BETWEEN_REQUESTS)
+            files = self.list_files()
+            with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+                for outcome in pool.map(fetch, files):
+                    counts[outcome] += 1
+        finally:
+            self.manifest.flush()
+        return counts
+
+
+if __name__ == "__main__":
+    from profiling import set_log_level
+    set_log_level()
+    print(Downloader().run())
@@ -1,65 +1,494 @@
 from joblib import Parallel, delayed
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 import numpy as np
-from reader import readers
-from collocate import collocate
+import pandas as pd
+import os
+import logging
+from reader import readers, date_range, CMAQ_files
+from collocate import collocate, collocate_all, _to_datetime64
+from config import pandora
+from output_store import OutputStore, to_mat
 from scipy.io import savemat
+from cache import save_granule, cache_key
+from ledger import PairingLedger
+import tempfile
+import profiling
+from profiling import stage, count, remote, collect
+
+logger = logging.getLogger('pandoravsCTMs.driver')
+
+
+def time_windows(YYYYMMDD1: str, YYYYMMDD2: str, window='month'):
+    '''
+        splits a period into CTM windows
+             YYYYMMDD1 [str]: the starting date
+             YYYYMMDD2 [str]: the ending date (not included)
+             window [str]: 'day', 'week' (7 days from YYYYMMDD1) or 'month' (calendar months)
+        Output [list]: (YYYYMMDD_start, YYYYMMDD_end) of each window, the end not included
+    '''
+    start = datetime.datetime.strptime(YYYYMMDD1, '%Y%m%d')
+    end = datetime.datetime.strptime(YYYYMMDD2, '%Y%m%d')
+    windows = []
+    while start < end:
+        if window == 'day':
+            stop = start + datetime.timedelta(days=1)
+        elif window == 'week':
+            stop = start + datetime.timedelta(days=7)
+        elif window == 'month':
+            stop = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        else:
+            raise Exception("the window should be 'day', 'week' or 'month'")
+        stop = min(stop, end)
+        windows.append((start.strftime('%Y%m%d'), stop.strftime('%Y%m%d')))
+        start = stop
+    return windows
+
+
+def _subset_pandora(pandora_data, mask):
+    # the samples of a pandora @dataclass selected by mask, None if there is none
+    if not np.any(mask):
+        return None
+    return pandora(pandora_data.time[mask].reset_index(drop=True), pandora_data.latitude, pandora_data.longitude,
+                   pandora_data.column[mask], pandora_data.uncertainty[mask], pandora_data.amf[mask],
+                   pandora_data.sza[mask], pandora_data.saa[mask])
+
+
+def _concat_pandora(first, second):
+    # joins the samples of two pandora @dataclass of the same station
+    if first is None or second is None:
+        return second if first is None else first
+    return pandora(pd.concat([first.time, second.time], ignore_index=True), first.latitude, first.longitude,
+                   np.concatenate((first.column, second.column)),
+                   np.concatenate((first.uncertainty, second.uncertainty)),
+                   np.concatenate((first.amf, second.amf)), np.concatenate((first.sza, second.sza)),
+                   np.concatenate((first.saa, second.saa)))
+
+
+def _share_ctm(ctm_data, folder, prefix):
+    # moves the CTM arrays into memory-mapped files once; joblib then hands workers
+    # references to these files instead of pickling the arrays for every task
+    if isinstance(ctm_data[0].latitude, np.memmap):
+        return ctm_data
+    shared = [save_granule(folder, f"{prefix}_{n}", ctm_granule) for n, ctm_granule in enumerate(ctm_data)]
+    for ctm_granule in shared:
+        ctm_granule.grid_index = ctm_data[0].grid_index
+    return shared
 
 
 class pandoravsCTMs(object):
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, profile=False, trace_memory=False) -> None:
+        '''
+            profile [bool]: time the stages of the run (CTM read, Pandora parse, time match, grid lookup,
+                            integration and write) and count the samples, skipped stations and LOS steps;
+                            the json report is written by pair, stream or update (see profile_file)
+            trace_memory [bool]: also report the peak of the allocations, which slows them down
+        '''
+        self.ctm_window = None
+        if profile:
+            profiling.enable(trace_memory)
 
-    def read_data(self, ctm_type: str, ctm_path: Path, gas: str, pandora_path: Path, YYYYMMDD1: str,
-                  YYYYMMDD2: str, mcip_dir=None, num_job=1):
+    def read_data(self, ctm_type: str, ctm_path: Path, gas, pandora_path: Path, YYYYMMDD1: str,
+                  YYYYMMDD2: str, mcip_dir=None, num_job=1, windowed=False, halo=0.0, cache_dir=None,
+                  pandora_store_dir=None, pandora_index_file=None, vcd_only=False, partial_columns=False):
         """
         Reads CTMs and Pandora.
 
         Parameters:
         ctm_type (str): Type of CTM data.
-        gas (str): targeted compounds e.g. NO2 or HCHO
+        gas (str or list): targeted compounds e.g. NO2 or HCHO, or a list of them read in one pass
+                           over the CTM met fields and over the Pandora files of each product
+                           (see reader.PANDORA_PRODUCTS); pandora and ctmdata are then dicts keyed by gas
         ctm_path (Path): Path to CTM data.
         pandora_path (Path): Path to pandora files
         YYYYMMDD1 (str): Starting year and month and day in YYYYMMDD format.
         YYYYMMDD2 (str): Ending year and month and day in YYYYMMDD format.   
         mcip_dir (Path): optional mcip dir for cmaq        
+        num_job (int): the number of jobs for parallel reading of CTM days and Pandora files
+        windowed (bool): read only the CTM grid windows around the Pandora stations
+        halo (float): extra distance (m) read around each station in windowed mode
+        cache_dir (Path): optional folder of memory-mapped derived CTM fields reused across runs
+        pandora_store_dir (Path): optional parquet store of parsed Pandora records reused across runs
+        pandora_index_file (Path): optional station index used to skip irrelevant Pandora files unopened
+        vcd_only (bool): read only the CTM vertical columns, streamed level by level (no ray tracing)
+        partial_columns (bool): also pair the CTM columns below/above the boundary layer height
         """
         reader_obj = readers()
 
+        # all CTM days of the period, plus the ending day whose first hours are the
+        # closest ones to the last Pandora samples
+        days = date_range(YYYYMMDD1, (datetime.datetime.strptime(YYYYMMDD2, '%Y%m%d') +
+                                      datetime.timedelta(days=1)).strftime('%Y%m%d'))
+
         # Initialize and read CTM data
         reader_obj.add_ctm_data(ctm_type, ctm_path, mcip_dir=mcip_dir)
-        reader_obj.read_ctm_data(YYYYMMDD1[0:6], gas)
-        self.ctmdata = reader_obj.ctm_data
+        if windowed:
+            # stations must be known before the CTM windows can be read
+            reader_obj.read_ctm_grid(YYYYMMDD1[0:6])
+        else:
+            reader_obj.read_ctm_data(YYYYMMDD1[0:6], gas, num_job=num_job, cache_dir=cache_dir,
+                                     vcd_only=vcd_only, partial_columns=partial_columns, days=days)
 
-        # Process NO2 data
+        # Process Pandora data; with several gases each one is read from the L2 files of its product
         reader_obj.add_pandora_data("rnvs3", pandora_path)
-        reader_obj.read_pandora_data(YYYYMMDD1, YYYYMMDD2, num_job=num_job)
+        reader_obj.read_pandora_data(YYYYMMDD1, YYYYMMDD2, num_job=num_job, store_dir=pandora_store_dir,
+                                     index_file=pandora_index_file, gases=None if isinstance(gas, str) else gas)
         self.pandora = reader_obj.pandora_data
 
+        if windowed:
+            reader_obj.read_ctm_data(YYYYMMDD1[0:6], gas, windowed=True, halo=halo, num_job=num_job,
+                                     cache_dir=cache_dir, vcd_only=vcd_only, partial_columns=partial_columns,
+                                     days=days)
+        self.ctmdata = reader_obj.ctm_data
+        self.ctm_window = reader_obj.ctm_window
+
         # Clear temporary data
         reader_obj = []
 
-    def pair(self):
+    def pair(self, num_job=1, ray_tracing=False, integration='step', memmap_dir=None, output_file=None,
+             mat_file=None, store=None, los_cache=None, interpolation='nearest', profile_file=None):
         '''
            pair pandora and the ctm
+             num_job [int]: the number of stations paired in parallel; the CTM arrays are
+                            memory-mapped once and workers get zero-copy views of them
+             ray_tracing [bool], integration [str], interpolation [str]: see collocate
+             memmap_dir [Path]: folder in which the shared CTM arrays of a call are written to a
+                                temporary subfolder, removed at the end (the system one by default)
+             output_file [str]: optional NetCDF4 output store to write (see output_store), nothing is
+                                written by default; each station is written in the background as soon as it is paired
+             mat_file [str]: optional MATLAB file exported once all stations are paired
+             store [OutputStore]: an open output store to append to instead of output_file
+             los_cache [LOSCache]: optional cache of LOS paths (see los_cache); with num_job > 1 each
+                                   worker traces into its own copy and the cache is not updated
+             profile_file [str]: the json profile report written at the end if profiling (see __init__)
+           Output [dict]: the paired outputs of each station, in station order; with several gases
+                          (see read_data) the stations of each gas are named "{gas}_pandora_{i}"
         '''
 
         all_outputs = {}
 
-        #outputs = Parallel(n_jobs=1)(delayed(collocate)(
-        #        self.pandora[k], self.ctmdata) for k in range(len(self.pandora)))
+        # every gas is paired against the same grid index and station windows
+        if isinstance(self.ctmdata, dict):
+            species = [(f"{gas}_", self.pandora[gas], self.ctmdata[gas]) for gas in self.ctmdata]
+        else:
+            species = [("", self.pandora, self.ctmdata)]
+        tmp_dir = None
+        if num_job != 1:
+            # a fresh folder per call, so that a reused memmap_dir never hands workers older arrays
+            if memmap_dir is not None:
+                os.makedirs(memmap_dir, exist_ok=True)
+            tmp_dir = tempfile.TemporaryDirectory(dir=memmap_dir)
+            memmap_dir = tmp_dir.name
+        tasks = []
+        for prefix, pandora_list, ctmdata in species:
+            ctm_lists = [ctmdata] if self.ctm_window is None else ctmdata
+            station_ctm = [0]*len(pandora_list) if self.ctm_window is None else self.ctm_window
+            if num_job != 1:
+                ctm_lists = [_share_ctm(ctm_data, memmap_dir, f"{prefix}window{w}")
+                             for w, ctm_data in enumerate(ctm_lists)]
+            paired = [(f"{prefix}pandora_{i}", pandora_data, ctm_lists[station_ctm[i]])
+                      for i, pandora_data in enumerate(pandora_list)
+                      if pandora_data is not None and station_ctm[i] is not None]
+            # stations outside the domain or without data in the period
+            count('stations_skipped', len(pandora_list) - len(paired))
+            tasks += paired
+        own_store = store is None and output_file is not None
+        if own_store:
+            store = OutputStore(output_file)
+        # Parallel hands the outputs over in the station order as soon as they are ready
+        outputs = collect(Parallel(n_jobs=num_job, return_as='generator')(delayed(remote(collocate))(
+            pandora_data, ctm_data, ray_tracing=ray_tracing, integration=integration, los_cache=los_cache,
+            interpolation=interpolation)
+            for _, pandora_data, ctm_data in tasks))
 
-        for i,pandora_data in enumerate(self.pandora):
-            output = collocate(pandora_data, self.ctmdata)
+        for (name, pandora_data, _), output in zip(tasks, outputs):
             if output is None:
                continue
-            print(np.size(pandora_data.column))
+            logger.info(f"{name}: {np.size(pandora_data.column)} samples paired")
             # give each sub-dict a unique name
-            all_outputs[f"pandora_{i}"] = output
+            all_outputs[name] = output
+            if store is not None:
+                with stage('write'):
+                    store.write(name, output)
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+        with stage('write'):
+            if own_store:
+                store.close()
+            if mat_file is not None:
+                if own_store:
+                    to_mat(output_file, mat_file)
+                else:
+                    savemat(mat_file, all_outputs)
+        if profile_file is not None and profiling.PROFILER.enabled:
+            profiling.save(profile_file)
+        return all_outputs
+
+    def stream(self, ctm_type: str, ctm_path: Path, gas: str, pandora_path: Path, YYYYMMDD1: str,
+               YYYYMMDD2: str, window='month', mcip_dir=None, num_job=1, ray_tracing=False, integration='step',
+               cache_dir=None, pandora_store_dir=None, pandora_index_file=None, vcd_only=False,
+               partial_columns=False, output_file=None, mat_file=None, interpolation='nearest', profile_file=None):
+        '''
+           reads and pairs a long period one CTM window at a time, so that at most two windows
+           of CTM data (the one being paired and the next one, read in the background) are in memory
+             window [str]: the CTM window, 'day', 'week' or 'month' (see time_windows)
+             output_file [str]: optional NetCDF4 output store the windows are appended to
+             mat_file [str]: optional MATLAB file exported from output_file at the end
+             profile_file [str]: the json profile report of all windows written at the end (see pair)
+             the other arguments are the ones of read_data and pair; for short windows
+             pandora_store_dir and pandora_index_file avoid re-parsing every L2 file per window;
+             each window is paired with the last CTM day of the previous one too, so that samples
+             at window edges are matched to the same steps as in a single read_data over the period
+             (e.g., samples just after midnight to the last step of the earlier window)
+           Output [generator]: yields (YYYYMMDD_start, YYYYMMDD_end, outputs) for each window, outputs
+                               being the per-station dict of pair with keys "pandora_{i}" where i is
+                               the index of the L2 file (stable across windows)
+        '''
+        if not isinstance(gas, str):
+            raise Exception("stream pairs one gas at a time")
+        reader_obj = readers()
+        reader_obj.add_ctm_data(ctm_type, ctm_path, mcip_dir=mcip_dir)
+        reader_obj.read_ctm_grid(YYYYMMDD1[0:6])
+        reader_obj.add_pandora_data("rnvs3", pandora_path)
+        files = reader_obj.pandora_files()
+        file_index = {filename: k for k, filename in enumerate(files)}
+        periods = time_windows(YYYYMMDD1, YYYYMMDD2, window)
+
+        def read_ctm(n):
+            ctm_reader = readers()
+            ctm_reader.add_ctm_data(ctm_type, ctm_path, mcip_dir=mcip_dir)
+            days = date_range(*periods[n])
+            if n == len(periods) - 1:
+                # as in read_data, the ending day is read for the last Pandora samples
+                days = days + [periods[n][1]]
+            ctm_reader.read_ctm_data(periods[n][0][0:6], gas, num_job=num_job, cache_dir=cache_dir,
+                                     vcd_only=vcd_only, partial_columns=partial_columns, days=days)
+            return ctm_reader.ctm_data
+
+        store = None if output_file is None else OutputStore(output_file)
+        try:
+            # samples closer to the first hour of the next window than to this window's last hour
+            carry = [None]*len(files)
+            # the last day of the previous window, whose last step may be the closest one (or the
+            # lower bracket with linear interpolation) to the first samples of a window
+            previous = []
+            with ThreadPoolExecutor(max_workers=1) as prefetch:
+                future = prefetch.submit(read_ctm, 0)
+                for n, period in enumerate(periods):
+                    ctm_data = future.result()
+                    if n + 1 < len(periods):
+                        future = prefetch.submit(read_ctm, n + 1)
+                    reader_obj.read_pandora_data(period[0], period[1], num_job=num_job, store_dir=pandora_store_dir,
+                                                 index_file=pandora_index_file)
+                    pandora_list = carry
+                    for filename, pandora_data in zip(reader_obj.pandora_data_files, reader_obj.pandora_data):
+                        k = file_index[filename]
+                        pandora_list[k] = _concat_pandora(pandora_list[k], pandora_data)
+                    carry = [None]*len(files)
+                    if not ctm_data:
+                        # no CTM day in this window; its samples cannot be paired
+                        previous = []
+                        yield period[0], period[1], {}
+                        continue
+                    if n + 1 < len(periods):
+                        time_ctm = _to_datetime64(ctm_data[-1].time)
+                        step = time_ctm[-1] - time_ctm[-2] if np.size(time_ctm) > 1 else np.timedelta64(1, 'h')
+                        # ties go to the earlier step (see match_ctm_time); with linear interpolation
+                        # the samples past the last step need the next window as the upper bracket
+                        cutoff = time_ctm[-1] + step/2 if interpolation == 'nearest' else time_ctm[-1]
+                        for k, pandora_data in enumerate(pandora_list):
+                            if pandora_data is None:
+                                continue
+                            later = _to_datetime64(pandora_data.time) > cutoff
+                            carry[k] = _subset_pandora(pandora_data, later)
+                            pandora_list[k] = _subset_pandora(pandora_data, ~later)
+                    ctm_data, previous = previous + ctm_data, ctm_data[-1:]
+                    self.pandora, self.ctmdata, self.ctm_window = pandora_list, ctm_data, None
+                    yield period[0], period[1], self.pair(num_job=num_job, ray_tracing=ray_tracing,
+                                                          integration=integration, output_file=None, store=store,
+                                                          interpolation=interpolation)
+        finally:
+            if store is not None:
+                with stage('write'):
+                    store.close()
+        if output_file is not None and mat_file is not None:
+            with stage('write'):
+                to_mat(output_file, mat_file)
+        if profile_file is not None and profiling.PROFILER.enabled:
+            profiling.save(profile_file)
+
+    def update(self, ctm_type: str, ctm_path: Path, gas: str, pandora_path: Path, YYYYMMDD1: str, YYYYMMDD2: str,
+               ledger_file: Path, output_file: str, mcip_dir=None, num_job=1, ray_tracing=False, integration='step',
+               cache_dir=None, pandora_store_dir=None, pandora_index_file=None, vcd_only=False,
+               partial_columns=False, interpolation='nearest', profile_file=None):
+        '''
+           incremental pairing for operations: only the Pandora samples not paired by a previous run
+           are read and paired, and only with the CTM days they need; the outputs are appended to
+           the output store
+             ledger_file [Path]: the json record of what has been paired (see ledger.PairingLedger);
+                                 unchanged L2 files are not even opened unless new CTM days arrived
+             output_file [str]: the NetCDF4 output store, created on the first run; station groups
+                                are named pandora_{i} with i the station id kept in the ledger
+             profile_file [str]: the json profile report written at the end (see pair)
+             the other arguments are the ones of read_data and pair; the samples of a CTM day whose
+             files changed (and of the days next to it) are paired again: their new rows are appended
+             and the old ones are flagged with superseded = 1; samples past the last step of the last
+             available CTM day wait for the next day
+           Output [dict]: the newly paired outputs of each station
+        '''
+        if not isinstance(gas, str):
+            raise Exception("update pairs one gas at a time")
+        ledger = PairingLedger(ledger_file)
+        reader_obj = readers()
+        reader_obj.add_ctm_data(ctm_type, ctm_path, mcip_dir=mcip_dir)
+        reader_obj.add_pandora_data("rnvs3", pandora_path)
+
+        # the available CTM days, plus the ending day for the last samples as in read_data
+        fingerprints = {}
+        for day in date_range(YYYYMMDD1, (datetime.datetime.strptime(YYYYMMDD2, '%Y%m%d') +
+                                          datetime.timedelta(days=1)).strftime('%Y%m%d')):
+            conc, met_2d, met_3d, _ = CMAQ_files(mcip_dir.as_posix(), ctm_path.as_posix(), day[0:6], [day])
+            if conc:
+                fingerprints[day] = cache_key(conc + met_3d + (met_2d if partial_columns else []), gas,
+                                              options=(vcd_only, partial_columns))
+        new_days = ledger.new_ctm_days(fingerprints)
+        files = reader_obj.pandora_files()
+        files = files if new_days else ledger.changed_files(files)
+        if not fingerprints or not files:
+            logger.info("Nothing new to pair")
+            return {}
+
+        reader_obj.read_ctm_grid(YYYYMMDD1[0:6])
+        reader_obj.read_pandora_data(YYYYMMDD1, YYYYMMDD2, num_job=num_job, store_dir=pandora_store_dir,
+                                     index_file=pandora_index_file, files=files)
+        new_samples = {}
+        for filename, pandora_data in zip(reader_obj.pandora_data_files, reader_obj.pandora_data):
+            if pandora_data is None:
+                continue
+            # samples are paired once, and only when their CTM day is available
+            keep = ledger.unpaired(filename, pandora_data.time) & \
+                np.array(pandora_data.time.dt.strftime('%Y%m%d').isin(list(fingerprints)))
+            pandora_data = _subset_pandora(pandora_data, keep)
+            if pandora_data is not None:
+                new_samples[filename] = pandora_data
+        days = set()
+        for pandora_data in new_samples.values():
+            for day in pandora_data.time.dt.strftime('%Y%m%d').unique():
+                date = datetime.datetime.strptime(day, '%Y%m%d')
+                # the first samples of a day may be closest to the last step of the day before,
+                # as in a single read_data over the period
+                days.update((date + datetime.timedelta(days=delta)).strftime('%Y%m%d') for delta in (-1, 0, 1))
+        days = sorted(days.intersection(fingerprints))
+
+        outputs = {}
+        if days:
+            reader_obj.read_ctm_data(days[0][0:6], gas, num_job=num_job, cache_dir=cache_dir, vcd_only=vcd_only,
+                                     partial_columns=partial_columns, days=days)
+            # as stream carries samples over, the samples past the last step of a day whose next day
+            # is not available yet wait for it, as they may be closer to its first step
+            for ctm_granule in reader_obj.ctm_data:
+                time_ctm = _to_datetime64(ctm_granule.time)
+                day = pd.Timestamp(time_ctm[0]).strftime('%Y%m%d')
+                next_day = (datetime.datetime.strptime(day, '%Y%m%d') +
+                            datetime.timedelta(days=1)).strftime('%Y%m%d')
+                if next_day in fingerprints:
+                    continue
+                step = time_ctm[-1] - time_ctm[-2] if np.size(time_ctm) > 1 else np.timedelta64(1, 'h')
+                # ties go to the earlier step (see match_ctm_time); with linear interpolation
+                # the samples past the last step need the next day as the upper bracket
+                cutoff = time_ctm[-1] + step/2 if interpolation == 'nearest' else time_ctm[-1]
+                for filename, pandora_data in list(new_samples.items()):
+                    later = (_to_datetime64(pandora_data.time) > cutoff) & \
+                        np.array(pandora_data.time.dt.strftime('%Y%m%d') == day)
+                    pandora_data = _subset_pandora(pandora_data, ~later)
+                    if pandora_data is None:
+                        del new_samples[filename]
+                    else:
+                        new_samples[filename] = pandora_data
+        if new_samples:
+            ids = {filename: ledger.station_id(filename) for filename in new_samples}
+            self.pandora = [None]*(max(ids.values()) + 1)
+            for filename, pandora_data in new_samples.items():
+                self.pandora[ids[filename]] = pandora_data
+            self.ctmdata = reader_obj.ctm_data
+            self.ctm_window = None
+            store = OutputStore(output_file, mode='a' if os.path.isfile(output_file) else 'w', supersede=True)
+            try:
+                outputs = self.pair(num_job=num_job, ray_tracing=ray_tracing, integration=integration,
+                                    output_file=None, store=store, interpolation=interpolation)
+            finally:
+                with stage('write'):
+                    store.close()
+            for filename, pandora_data in new_samples.items():
+                ledger.record(filename, pandora_data.time)
+        for filename in files:
+            ledger.record_file(filename)
+        ledger.record_ctm_days(fingerprints)
+        ledger.save()
+        if profile_file is not None and profiling.PROFILER.enabled:
+            profiling.save(profile_file)
+        return outputs
+
+    def pair_out_of_core(self, ctm_type: str, ctm_path: Path, gas: str, pandora_path: Path, YYYYMMDD1: str,
+                         YYYYMMDD2: str, mcip_dir=None, num_workers=1, memory_limit=2e9, scheduler='processes',
+                         chunks=None):
+        '''
+           reads and pairs a long period out-of-core (direct columns, no ray tracing): the CTM fields
+           are chunked dask arrays, the column integration and the gather at the station cells
+           are a task graph run by a local scheduler, so only chunks holding a station are ever
+           read and at most num_workers chunks are in memory (requires dask, see chunked)
+             num_workers [int]: the number of worker processes
+             memory_limit [float]: the memory budget (bytes) of all workers, used to pick the chunks
+             scheduler [str]: the dask scheduler, 'processes', 'threads' or 'synchronous'
+             chunks [tuple]: optional (time, level, row, col) chunks instead of memory_limit
+             the other arguments are the ones of read_data
+           Output [dict]: one columnar table with a row per sample, see collocate_all
+        '''
+        if ctm_type != 'CMAQ':
+            raise Exception("the out-of-core backend only reads CMAQ")
+        # dask is an optional dependency of the out-of-core backend only
+        from chunked import lazy_cmaq, lazy_columns, collocate_chunked, read_pandora_chunked
+        # as in read_data, the ending day is read for the last Pandora samples
+        days = date_range(YYYYMMDD1, (datetime.datetime.strptime(YYYYMMDD2, '%Y%m%d') +
+                                      datetime.timedelta(days=1)).strftime('%Y%m%d'))
+        lat, lon, times, arrays = lazy_cmaq(mcip_dir.as_posix(), ctm_path.as_posix(), YYYYMMDD1[0:6], gas,
+                                            days=days, memory_limit=memory_limit, num_workers=num_workers,
+                                            chunks=chunks)
+        reader_obj = readers()
+        reader_obj.add_pandora_data("rnvs3", pandora_path)
+        self.pandora = read_pandora_chunked(reader_obj.pandora_files(), YYYYMMDD1, YYYYMMDD2, lat, lon,
+                                            scheduler=scheduler, num_workers=num_workers)
+        return collocate_chunked(self.pandora, lat, lon, times, lazy_columns(arrays), scheduler=scheduler,
+                                 num_workers=num_workers)
+
+    def pair_batched(self):
+        '''
+           pair all pandora stations and the ctm in one vectorized pass (no ray tracing)
+           Output [dict]: one columnar table with a row per sample, see collocate_all;
+                          a dict of tables keyed by gas with several gases (see read_data)
+        '''
+        if isinstance(self.ctmdata, dict):
+            return {gas: self._pair_batched(self.pandora[gas], self.ctmdata[gas]) for gas in self.ctmdata}
+        return self._pair_batched(self.pandora, self.ctmdata)
 
-        # write all at once
-        savemat('test.mat', all_outputs)
+    def _pair_batched(self, pandora_list, ctmdata):
+        if self.ctm_window is None:
+            return collocate_all(pandora_list, ctmdata)
+        # windows have their own grids so stations are batched per window
+        tables = []
+        for w, ctm_data in enumerate(ctmdata):
+            window_list = [p if self.ctm_window[i] == w else None for i, p in enumerate(pandora_list)]
+            table = collocate_all(window_list, ctm_data)
+            if table is not None:
+                tables.append(table)
+        if not tables:
+            return None
+        table = {key: np.concatenate([t[key] for t in tables]) for key in tables[0]}
+        order = np.argsort(table["station"], kind='stable')
+        return {key: value[order] for key, value in table.items()}
 
 
 # testing
@@ -71,4 +500,4 @@ if __name__ == "__main__":
                           '20240101', '20240201', Path(
                               './cmaq_test/'),
                           num_job=12)
-    pandora_obj.pair()
+    pandora_obj.pair(output_file='test.nc', mat_file='test.mat')
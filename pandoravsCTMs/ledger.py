@@ -0,0 +1,118 @@
+import os
+import json
+import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+class PairingLedger(object):
+    '''
+        persistent record of what has already been paired, used for incremental updates:
+        the source fingerprint of every paired CTM day and, for every Pandora L2 file,
+        its fingerprint, a stable station id and the time of its last paired sample on each CTM day
+    '''
+
+    def __init__(self, ledger_file: Path) -> None:
+        '''
+            Input:
+                ledger_file [Path]: the json file of the ledger
+        '''
+        self.ledger_file = Path(ledger_file)
+        self.ledger = {'ctm_days': {}, 'stations': {}}
+        if self.ledger_file.is_file():
+            with open(self.ledger_file) as f:
+                self.ledger = json.load(f)
+
+    def save(self):
+        self.ledger_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.ledger_file.with_suffix('.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.ledger, f, indent=1)
+        os.replace(tmp, self.ledger_file)
+
+    def _station(self, filename: str):
+        key = os.path.abspath(filename)
+        if key not in self.ledger['stations']:
+            self.ledger['stations'][key] = {'id': len(self.ledger['stations']), 'fingerprint': None,
+                                            'paired_until': {}}
+        return self.ledger['stations'][key]
+
+    def station_id(self, filename: str):
+        '''
+            returns the stable id of a station (the i of its pandora_{i} output group)
+        '''
+        return self._station(filename)['id']
+
+    def new_ctm_days(self, fingerprints: dict):
+        '''
+            finds the CTM days not paired yet or whose files changed since;
+            the paired samples of changed days, and of the days before and after them
+            (whose first and last samples may be matched with their steps), are forgotten
+            so that they get paired again
+            Input:
+                fingerprints [dict]: the fingerprint of each available CTM day (YYYYMMDD)
+            Output [list]: the new or changed days
+        '''
+        days = []
+        for day, fingerprint in sorted(fingerprints.items()):
+            if self.ledger['ctm_days'].get(day) == fingerprint:
+                continue
+            if day in self.ledger['ctm_days']:
+                date = datetime.datetime.strptime(day, '%Y%m%d')
+                for delta in (-1, 0, 1):
+                    forgotten = (date + datetime.timedelta(days=delta)).strftime('%Y%m%d')
+                    for entry in self.ledger['stations'].values():
+                        entry['paired_until'].pop(forgotten, None)
+            days.append(day)
+        return days
+
+    def changed_files(self, files: list):
+        '''
+            returns the L2 files that are new or changed since they were last paired
+        '''
+        changed = []
+        for filename in files:
+            st = os.stat(filename)
+            if self._station(filename)['fingerprint'] != [st.st_size, st.st_mtime_ns]:
+                changed.append(filename)
+        return changed
+
+    def unpaired(self, filename: str, time):
+        '''
+            flags the samples of a station not paired yet
+            Input:
+                filename [str]: the L2 file
+                time [pd.Series]: the (UTC) sample times
+            Output [np.ndarray]: a boolean mask
+        '''
+        paired_until = self._station(filename)['paired_until']
+        days = time.dt.strftime('%Y%m%d')
+        last = pd.to_datetime(days.map(paired_until), utc=True)
+        return np.array(last.isna() | (time > last))
+
+    def record(self, filename: str, time):
+        '''
+            records the paired samples of a station
+            Input:
+                filename [str]: the L2 file
+                time [pd.Series]: the (UTC) times of the paired samples
+        '''
+        entry = self._station(filename)
+        for day, last in time.groupby(time.dt.strftime('%Y%m%d')).max().items():
+            if day in entry['paired_until']:
+                last = max(last, pd.Timestamp(entry['paired_until'][day]))
+            entry['paired_until'][day] = last.isoformat()
+
+    def record_ctm_days(self, fingerprints: dict):
+        '''
+            stores the fingerprints of the CTM days once every available sample is paired with them
+        '''
+        self.ledger['ctm_days'].update(fingerprints)
+
+    def record_file(self, filename: str):
+        '''
+            stores the current fingerprint of an L2 file once its new samples are paired
+        '''
+        st = os.stat(filename)
+        self._station(filename)['fingerprint'] = [st.st_size, st.st_mtime_ns]
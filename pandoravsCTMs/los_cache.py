@@ -0,0 +1,155 @@
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from pyproj import Geod
+from raytracing import los_points
+
+
+def _count_below(b, n0, n1, base, step):
+    # number of LOS steps n0 <= n < n1 whose altitude base + n*step is at or below b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (b - base)/step
+        up = np.clip(np.floor(x) + 1, n0, n1) - n0
+        down = n1 - np.clip(np.ceil(x), n0, n1)
+    flat = np.where(base <= b, n1 - n0, 0)
+    return np.where(step > 0, up, np.where(step < 0, down, flat))
+
+
+class LOSCache(object):
+    '''
+        LRU cache of the sun LOS paths of the fixed-step ray tracing, keyed by station and solar
+        angles snapped to an angular grid; a path is stored as runs of consecutive steps in the
+        same CTM cell, so the slant column of any hour becomes a gather of that hour's fields
+        at the crossed cells and a dot product with the number of steps per level
+    '''
+
+    def __init__(self, dsza=0.1, dsaa=0.1, max_entries=200000, cache_file=None) -> None:
+        '''
+            Input:
+                dsza, dsaa [float]: the angular grid (deg); paths are traced at the grid angles closest
+                                    to the sample angles, None to trace the exact angles
+                max_entries [int]: the number of paths kept before the least recently used is evicted
+                cache_file [str]: optional file the paths are loaded from and saved to (see save)
+        '''
+        self.dsza = dsza
+        self.dsaa = dsaa
+        self.max_entries = max_entries
+        self.cache_file = cache_file
+        self.paths = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as f:
+                saved = pickle.load(f)
+            if saved['grid'] == (dsza, dsaa):
+                self.paths.update(saved['paths'])
+
+    def save(self):
+        '''
+            writes the paths to cache_file (atomically)
+        '''
+        folder = os.path.dirname(os.path.abspath(self.cache_file))
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp_')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'grid': (self.dsza, self.dsaa), 'paths': self.paths}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.cache_file)
+
+    def stats(self):
+        '''
+            Output [dict]: the number of hits, misses, stored paths and the hit rate
+        '''
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.paths),
+                "hit_rate": self.hits/lookups if lookups else 0.0}
+
+    def _snap(self, angle, step):
+        if step is None:
+            return np.asarray(angle, dtype=float)
+        return np.round(np.asarray(angle, dtype=float)/step)*step
+
+    def _trace(self, lon0, lat0, sza, saa, index, ds, max_dist, alt0, toa):
+        # traces the missing paths and splits them into runs of steps inside one cell
+        owner, lons, lats, alts = los_points(lon0, lat0, sza, saa, ds=ds, max_dist=max_dist, alt0=alt0, toa=toa,
+                                             geod=Geod(ellps='WGS84'))
+        n = np.arange(np.size(owner)) - np.searchsorted(owner, owner, side='left')
+        # unfilled points of the original marching loop were skipped
+        valid = (lons != 0.0) & (lats != 0.0) & (alts != 0.0)
+        owner, lons, lats, n = owner[valid], lons[valid], lats[valid], n[valid]
+        i, j, _ = index.query(lons, lats)
+        new_run = np.ones(np.size(owner), dtype=bool)
+        new_run[1:] = (owner[1:] != owner[:-1]) | (i[1:] != i[:-1]) | (j[1:] != j[:-1]) | (n[1:] != n[:-1] + 1)
+        first = np.where(new_run)[0]
+        last = np.append(first[1:], np.size(owner)) - 1
+        paths = []
+        for m in range(np.size(sza)):
+            runs = (owner[first] == m)
+            paths.append((i[first][runs].astype(np.int32), j[first][runs].astype(np.int32),
+                          n[first][runs].astype(np.int32), n[last][runs].astype(np.int32) + 1))
+        return paths
+
+    def lookup(self, lon0: float, lat0: float, sza, saa, index, ds=5.0, max_dist=100000.0, alt0=2.0,
+               toa=np.inf, chunk_points=2000000):
+        '''
+            returns the cached paths of many samples, tracing the missing ones in batches
+             chunk_points [int]: max number of LOS points held in memory at once
+            Output [tuple]: the path (i, j, first step, end step of each run) of each sample and
+                            the zenith angle (deg) it was traced at
+        '''
+        sza = self._snap(np.atleast_1d(sza), self.dsza)
+        saa = self._snap(np.atleast_1d(saa), self.dsaa) % 360.0
+        setup = (index.digest, float(lon0), float(lat0), float(ds), float(max_dist), float(alt0), float(toa))
+        keys = [setup + (float(z), float(a)) for z, a in zip(sza, saa)]
+        missing = {}
+        for n, key in enumerate(keys):
+            if key in self.paths:
+                self.paths.move_to_end(key)
+                self.hits += 1
+            elif key in missing:
+                self.hits += 1
+            else:
+                missing[key] = n
+                self.misses += 1
+        missing_keys = list(missing)
+        missing = np.array(list(missing.values()), dtype=int)
+        chunk = max(1, int(chunk_points // np.size(np.arange(0, max_dist, ds))))
+        for c0 in range(0, np.size(missing), chunk):
+            sel = missing[c0:c0 + chunk]
+            traced = self._trace(lon0, lat0, sza[sel], saa[sel], index, ds, max_dist, alt0, toa)
+            for key, path in zip(missing_keys[c0:c0 + chunk], traced):
+                self.paths[key] = path
+        paths = [self.paths[key] for key in keys]
+        while len(self.paths) > self.max_entries:
+            self.paths.popitem(last=False)
+        return paths, sza
+
+
+def cached_trace_scd(lon0: float, lat0: float, sza, saa, day_index, hour_index, ctm_data, index, los_cache,
+                     ds=5.0, max_dist=100000.0, alt0=2.0, toa=np.inf):
+    '''
+        fixed-step ray tracing of CTM slant columns using cached LOS paths (see ray_trace_scd)
+             los_cache [LOSCache]: the cache of LOS paths
+        Output [np.ndarray]: slant column of each sample (molec/cm2 * m)
+    '''
+    day_index = np.atleast_1d(day_index)
+    hour_index = np.atleast_1d(hour_index)
+    paths, sza = los_cache.lookup(lon0, lat0, sza, saa, index, ds=ds, max_dist=max_dist, alt0=alt0, toa=toa)
+    scd = np.zeros(len(paths))
+    keys = day_index*100000 + hour_index
+    for key in np.unique(keys):
+        group = np.where(keys == key)[0]
+        day, hour = day_index[group[0]], hour_index[group[0]]
+        pcd = ctm_data[day].partial_col_density[hour, ...]
+        Z = ctm_data[day].Z[hour, ...]
+        nruns = [np.size(paths[g][0]) for g in group]
+        owner = np.repeat(np.arange(np.size(group)), nruns)
+        i, j, n0, n1 = (np.concatenate([paths[g][c] for g in group]) for c in range(4))
+        step = np.repeat(ds*np.cos(np.radians(sza[group])), nruns)
+        # the closest level of a point changes half-way between level heights
+        Zc = Z[:, i, j]
+        counts = _count_below(0.5*(Zc[1:] + Zc[:-1]), n0, n1, alt0, step)
+        weights = np.diff(np.vstack((np.zeros(np.size(n0)), counts, n1 - n0)), axis=0)*ds
+        column = np.sum(np.where(weights > 0, pcd[:, i, j]*weights, 0.0), axis=0)
+        scd[group] = np.bincount(owner, weights=column, minlength=np.size(group))
+    return scd
@@ -0,0 +1,129 @@
+import queue
+import threading
+import numpy as np
+from netCDF4 import Dataset
+from scipy.io import savemat
+from reader import NC_LOCK
+
+
+class OutputStore(object):
+    '''
+        streams paired outputs to a chunked, compressed NetCDF4 file with one group per station
+        and an unlimited 'sample' dimension; writes run in a background thread so that they
+        overlap with the pairing, and each station is on disk as soon as it is written
+    '''
+
+    def __init__(self, filename: str, mode='w', complevel=4, chunk_size=4096, max_pending=8,
+                 supersede=False) -> None:
+        '''
+            Input:
+                filename [str]: the NetCDF4 file
+                mode [str]: 'w' to start a new file, 'a' to append to an existing one
+                supersede [bool]: keep a 'superseded' flag per sample: the rows of a station whose
+                                  time is written again are flagged with 1 and the new rows with 0
+                complevel [int]: the zlib compression level
+                chunk_size [int]: the number of samples per chunk
+                max_pending [int]: the number of outputs queued before write blocks
+        '''
+        self.filename = filename
+        self.complevel = complevel
+        self.chunk_size = chunk_size
+        self.supersede = supersede
+        with NC_LOCK:
+            self.nc = Dataset(filename, mode, format='NETCDF4')
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self._append(*item)
+                except Exception as error:
+                    self.error = error
+
+    def _append(self, station: str, output: dict):
+        with NC_LOCK:
+            if station in self.nc.groups:
+                group = self.nc.groups[station]
+            else:
+                group = self.nc.createGroup(station)
+                group.createDimension('sample', None)
+            n0 = group.dimensions['sample'].size
+            if self.supersede and 'time' in output:
+                output = dict(output, superseded=np.zeros(np.size(output['time']), dtype=np.int8))
+                if 'superseded' not in group.variables:
+                    group.createVariable('superseded', np.int8, ('sample',), zlib=True,
+                                         complevel=self.complevel, chunksizes=(self.chunk_size,))
+                    group.variables['superseded'][0:n0] = 0
+                if n0 > 0:
+                    old = np.isin(np.array(group.variables['time'][0:n0]), np.asarray(output['time']))
+                    if np.any(old):
+                        group.variables['superseded'][np.flatnonzero(old)] = 1
+            for key, value in output.items():
+                value = np.asarray(value)
+                if value.ndim == 0:
+                    # per-station scalars (e.g., lat/lon)
+                    group.setncattr(key, value)
+                    continue
+                if key not in group.variables:
+                    group.createVariable(key, value.dtype, ('sample',), zlib=True, complevel=self.complevel,
+                                         chunksizes=(self.chunk_size,))
+                group.variables[key][n0:n0 + np.size(value)] = value
+            self.nc.sync()
+
+    def write(self, station: str, output: dict):
+        '''
+            queues the outputs of a station to be appended to its group
+            Input:
+                station [str]: the group name, e.g., pandora_0
+                output [dict]: 1-D arrays of equal length (appended) and scalars (stored as attributes)
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((station, output))
+
+    def close(self):
+        '''
+            waits for the queued outputs to be written and closes the file
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        with NC_LOCK:
+            self.nc.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_outputs(filename: str):
+    '''
+        reads a whole output store
+        Output [dict]: the outputs of each station keyed by group name
+    '''
+    outputs = {}
+    with NC_LOCK:
+        nc = Dataset(filename, 'r')
+        for station, group in nc.groups.items():
+            outputs[station] = {key: np.array(var[:]) for key, var in group.variables.items()}
+            for key in group.ncattrs():
+                outputs[station][key] = group.getncattr(key)
+        nc.close()
+    return outputs
+
+
+def to_mat(filename: str, mat_file: str):
+    '''
+        exports an output store to a MATLAB file with one struct per station
+    '''
+    savemat(mat_file, read_outputs(filename))
@@ -0,0 +1,140 @@
+import os
+import json
+import shutil
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from reader import _read_pandora_header, _read_pandora_records, _to_pandora
+from profiling import stage, remote, collect
+
+logger = logging.getLogger('pandoravsCTMs.pandora_store')
+
+
+def _parse_file(filename: str, grouping: str, gases=None):
+    # parses a whole L2 file (no date window, no domain check)
+    with stage('pandora_parse'), open(filename, encoding="latin1") as f:
+        descriptions = {}
+        lat, lon = _read_pandora_header(f, descriptions=descriptions)
+        data = _read_pandora_records(f, grouping=grouping, gases=gases, descriptions=descriptions)
+    return lat, lon, data
+
+
+def _records_file(gas=None):
+    # the partition file of a gas; NO2-only stores keep the original name
+    return 'records.parquet' if gas is None else f"records_{gas}.parquet"
+
+
+class PandoraStore(object):
+    '''
+        persistent columnar store of quality-filtered, time-grouped Pandora records
+        laid out as <root>/station=<file stem>/month=<YYYYMM>/records.parquet, or one
+        records_<gas>.parquet per gas for multi-gas stores (requires a parquet engine such as pyarrow)
+    '''
+
+    def __init__(self, root: Path, grouping='10min', gases=None) -> None:
+        '''
+            Input:
+                root [Path]: the folder of the store
+                grouping [str]: the time grouping of the stored records
+                gases [list]: optional gases parsed together (see reader.pandora_reader), NO2 only if None
+        '''
+        self.root = Path(root)
+        self.grouping = grouping
+        self.gases = None if gases is None else list(gases)
+        self.manifest_file = self.root / 'manifest.json'
+        self.manifest = {}
+        if self.manifest_file.is_file():
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+
+    def _fingerprint(self, filename: str):
+        st = os.stat(filename)
+        fingerprint = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'grouping': self.grouping}
+        if self.gases is not None:
+            fingerprint['gases'] = self.gases
+        return fingerprint
+
+    def _save_manifest(self):
+        tmp = self.manifest_file.with_suffix('.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, self.manifest_file)
+
+    def update(self, files: list, num_job=1):
+        '''
+            parses only the new or changed L2 files and (re)writes their partitions
+            Input:
+                files [list]: the L2 files
+                num_job [int]: the number of jobs for parallel parsing
+            Output [int]: the number of parsed files
+        '''
+        stale = []
+        for filename in files:
+            entry = self.manifest.get(os.path.abspath(filename))
+            if entry is None or entry['fingerprint'] != self._fingerprint(filename):
+                stale.append(filename)
+        if not stale:
+            return 0
+        logger.info(f"Parsing {len(stale)} new or changed Pandora files")
+        results = collect(Parallel(n_jobs=num_job)(delayed(remote(_parse_file))(
+            filename, self.grouping, self.gases) for filename in stale))
+        for filename, (lat, lon, data) in zip(stale, results):
+            station = Path(filename).stem
+            station_dir = self.root / f"station={station}"
+            shutil.rmtree(station_dir, ignore_errors=True)
+            months = set()
+            for gas, records in ({None: data} if self.gases is None else data).items():
+                if records.empty:
+                    continue
+                month_key = records['time'].dt.strftime('%Y%m')
+                for month, month_records in records.groupby(month_key):
+                    month_dir = station_dir / f"month={month}"
+                    month_dir.mkdir(parents=True, exist_ok=True)
+                    month_records.to_parquet(month_dir / _records_file(gas), index=False)
+                    months.add(month)
+            months = sorted(months)
+            self.manifest[os.path.abspath(filename)] = {
+                'fingerprint': self._fingerprint(filename), 'station': station,
+                'latitude': lat, 'longitude': lon, 'months': months}
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._save_manifest()
+        return len(stale)
+
+    def read(self, files: list, YYYYMMDD1: str, YYYYMMDD2: str, lat_ctm=None, lon_ctm=None, gas=None):
+        '''
+            reads stored records of a date window using only the overlapping month partitions
+            Input:
+                files [list]: the L2 files (must be in the store, see update)
+                YYYYMMDD1 [str]: the starting date
+                YYYYMMDD2 [str]: the ending date (not included)
+                lat_ctm, lon_ctm [np.ndarray]: optional CTM grid to skip out-of-domain stations
+                gas [str]: the gas to read from a multi-gas store
+            Output [list]: a pandora @dataclass per file, None if outside the domain or without data
+        '''
+        start_dt = pd.to_datetime(YYYYMMDD1, format='%Y%m%d', utc=True)
+        end_dt = pd.to_datetime(YYYYMMDD2, format='%Y%m%d', utc=True)
+        months = set(pd.period_range(start_dt.tz_localize(None), end_dt.tz_localize(None) - pd.Timedelta('1ns'),
+                                     freq='M').strftime('%Y%m'))
+        outputs = []
+        with stage('pandora_read'):
+            for filename in files:
+                entry = self.manifest[os.path.abspath(filename)]
+                lat, lon = entry['latitude'], entry['longitude']
+                if lat_ctm is not None and not ((np.nanmin(lat_ctm) <= lat <= np.nanmax(lat_ctm)) and
+                                                (np.nanmin(lon_ctm) <= lon <= np.nanmax(lon_ctm))):
+                    outputs.append(None)
+                    continue
+                parts = [self.root / f"station={entry['station']}" / f"month={month}" / _records_file(gas)
+                         for month in sorted(months.intersection(entry['months']))]
+                # a gas may be missing from some months
+                parts = [part for part in parts if part.is_file()]
+                if not parts:
+                    outputs.append(None)
+                    continue
+                data = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+                data['time'] = data['time'].astype('datetime64[ns, UTC]')
+                data = data.loc[(data['time'] >= start_dt) & (data['time'] < end_dt)].reset_index(drop=True)
+                outputs.append(None if data.empty else _to_pandora(data, lat, lon, 'NO2' if gas is None else gas))
+        return outputs
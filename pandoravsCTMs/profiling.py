@@ -0,0 +1,226 @@
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+import tracemalloc
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# the parent of the loggers of all modules, e.g., pandoravsCTMs.reader
+logger = logging.getLogger('pandoravsCTMs')
+
+# shared by all disabled stages so that they cost a flag check
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def _peak_rss_mb():
+    # peak resident memory of the process (kB on Linux, bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1e6 if sys.platform == 'darwin' else peak/1e3
+
+
+class Profiler(object):
+    '''
+        stage timers, counters and peak memory of a run; every call is a flag check
+        while disabled
+    '''
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.trace_memory = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+            forgets the stages and counters gathered so far
+        '''
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.worker_rss_mb = None
+            self.start = time.perf_counter()
+
+    def enable(self, trace_memory=False):
+        '''
+            Input:
+                trace_memory [bool]: also trace the peak of the allocations (tracemalloc); this
+                                     slows allocations down so it is off by default and only the
+                                     peak resident memory of the process is reported
+        '''
+        self.reset()
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.trace_memory = False
+
+    def stage(self, name: str):
+        '''
+            times a block, e.g., with PROFILER.stage('ctm_read'): ...; nested stages are
+            timed inclusively
+        '''
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t0
+            with self.lock:
+                entry = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+                entry['calls'] += 1
+                entry['seconds'] += seconds
+
+    def count(self, name: str, n=1):
+        '''
+            adds n to a counter, e.g., the number of samples paired
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def merge(self, report: dict):
+        '''
+            adds the stages and counters of a report, e.g., of a worker process
+        '''
+        with self.lock:
+            for name, value in report['stages'].items():
+                entry = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+                entry['calls'] += value['calls']
+                entry['seconds'] += value['seconds']
+            for name, value in report['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            peaks = [p for p in (self.worker_rss_mb, report['peak_rss_MB'], report.get('peak_worker_rss_MB'))
+                     if p is not None]
+            self.worker_rss_mb = max(peaks) if peaks else None
+
+    def report(self):
+        '''
+            Output [dict]: the wall time (s) since enabled, the calls and seconds of each stage,
+                           the counters and the peak memory (MB) of this process and its workers
+        '''
+        with self.lock:
+            output = {'wall_s': time.perf_counter() - self.start,
+                      'stages': {name: dict(value) for name, value in self.stages.items()},
+                      'counters': dict(self.counters),
+                      'peak_rss_MB': _peak_rss_mb(),
+                      'peak_worker_rss_MB': self.worker_rss_mb}
+        if self.trace_memory and tracemalloc.is_tracing():
+            output['peak_traced_MB'] = tracemalloc.get_traced_memory()[1]/1e6
+        return output
+
+    def save(self, filename: str):
+        '''
+            writes the report as json
+        '''
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+# the profiler of the process
+PROFILER = Profiler()
+
+
+def enable(trace_memory=False):
+    '''
+        starts profiling the run (see Profiler.enable)
+    '''
+    PROFILER.enable(trace_memory)
+
+
+def disable():
+    PROFILER.disable()
+
+
+def stage(name: str):
+    return PROFILER.stage(name)
+
+
+def count(name: str, n=1):
+    PROFILER.count(name, n)
+
+
+def report():
+    return PROFILER.report()
+
+
+def save(filename: str):
+    PROFILER.save(filename)
+
+
+def set_log_level(level=logging.INFO):
+    '''
+        prints the messages of all modules at or above level (e.g., logging.DEBUG for the
+        matched CTM step of every sample) on stderr
+    '''
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+class _Remote(object):
+    # runs a function in a worker process under its own profiler and returns its report too
+    def __init__(self, function, trace_memory: bool, level: int) -> None:
+        self.function = function
+        self.trace_memory = trace_memory
+        self.level = level
+
+    def __call__(self, *args, **kwargs):
+        if PROFILER.enabled:
+            # the worker shares the profiler of the parent (e.g., a single job or threads)
+            return self.function(*args, **kwargs), None
+        # worker processes import the modules afresh, without the log level of the parent
+        logger.setLevel(self.level)
+        PROFILER.enable(self.trace_memory)
+        try:
+            output = self.function(*args, **kwargs)
+            return output, PROFILER.report()
+        finally:
+            PROFILER.disable()
+
+
+def remote(function):
+    '''
+        wraps a function run by joblib workers so that their stages and counters reach this
+        process; the outputs must go through collect. A no-op while disabled
+    '''
+    if not PROFILER.enabled:
+        return function
+    return _Remote(function, PROFILER.trace_memory, logger.getEffectiveLevel())
+
+
+def collect(outputs):
+    '''
+        merges the reports of the outputs of a remote function (a list or a generator of
+        outputs, as returned by joblib) and returns the bare outputs in the same form
+    '''
+    if not PROFILER.enabled:
+        return outputs
+
+    def unwrap(output):
+        output, worker_report = output
+        if worker_report is not None:
+            PROFILER.merge(worker_report)
+        return output
+    if isinstance(outputs, list):
+        return [unwrap(output) for output in outputs]
+    return (unwrap(output) for output in outputs)
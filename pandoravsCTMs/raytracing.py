@@ -0,0 +1,341 @@
+import numpy as np
+from pyproj import Geod
+from spatial import bilinear
+from profiling import count
+
+
+def los_npoints(s: np.ndarray, cos_zen, alt0=2.0, toa=np.inf):
+    '''
+        number of points of each LOS along the steps s: all of them, or up to and including
+        the first point above toa
+             s [np.ndarray]: the distances (m) of the steps along LOS, np.arange(0, max_dist, ds)
+             cos_zen [np.ndarray]: cosine of the solar zenith angle of each sample
+        Output [np.ndarray]: the number of points of each sample
+    '''
+    cos_zen = np.atleast_1d(np.asarray(cos_zen, dtype=float))
+    nsteps = np.size(s)
+    if nsteps == 0:
+        return np.zeros(np.size(cos_zen), dtype=np.int64)
+    ds = s[1] - s[0] if nsteps > 1 else 1.0
+    rising = cos_zen > 0
+    # closed form of the first step above toa, alt0 + n*ds*cos_zen > toa
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        first = np.floor((toa - alt0)/(ds*np.where(rising, cos_zen, 1.0))) + 1
+    first = np.clip(np.nan_to_num(first, nan=nsteps, posinf=nsteps, neginf=0), 0, nsteps).astype(np.int64)
+
+    def above(n):
+        return alt0 + s[np.minimum(n, nsteps - 1)]*cos_zen > toa
+    # rounding of the division is corrected against the altitudes of the points themselves
+    first = np.where((first > 0) & above(first - 1), first - 1, first)
+    first = np.where((first < nsteps) & ~above(first), first + 1, first)
+    # a flat or descending LOS is either above toa from its first point or never
+    first = np.where(rising, first, np.where(alt0 > toa, 0, nsteps))
+    return np.minimum(first + 1, nsteps)
+
+
+def los_points(lon0: float, lat0: float, sza, saa, ds=5.0, max_dist=100000.0, alt0=2.0, toa=np.inf, geod=None):
+    '''
+        computes the sun line-of-sight (LOS) points for many samples at once
+             lon0, lat0 [float]: the station location
+             sza, saa [np.ndarray]: solar zenith/azimuth angles (deg) of each sample
+             ds [float]: step size in meters along LOS
+             max_dist [float]: maximum distance along LOS in meters
+             alt0 [float]: initial altitude in meters
+             toa [float]: the top of the model; a LOS stops at its first point above it
+        Output [tuple]: owner (sample index of each point), lons, lats, alts as flat arrays
+    '''
+    if geod is None:
+        geod = Geod(ellps='WGS84')
+    sza = np.atleast_1d(np.asarray(sza, dtype=float))
+    saa = np.atleast_1d(np.asarray(saa, dtype=float))
+    s = np.arange(0, max_dist, ds)
+    # number of points per sample; the first point above toa is kept
+    npoints = los_npoints(s, np.cos(np.radians(sza)), alt0, toa)
+    owner = np.repeat(np.arange(np.size(sza)), npoints)
+    count('los_steps', np.size(owner))
+    # position of each point along its own LOS
+    start = np.cumsum(npoints) - npoints
+    step = np.arange(np.size(owner)) - np.repeat(start, npoints)
+    zen = np.radians(sza[owner])
+    x = s[step]*np.sin(zen)
+    y = s[step]*np.cos(zen)
+    lons, lats, _ = geod.fwd(np.full(np.size(owner), lon0), np.full(np.size(owner), lat0),
+                             saa[owner], x)
+    alts = alt0 + y
+    return owner, np.asarray(lons), np.asarray(lats), alts
+
+
+def integrate_step(owner, i, j, alts, partial_col_dens, Z, ds, nsamples):
+    '''
+        integrates partial column densities along LOS points using fixed steps
+             owner [np.ndarray]: sample index of each point
+             i, j [np.ndarray]: CTM cell of each point
+             alts [np.ndarray]: altitude of each point
+             partial_col_dens, Z [np.ndarray]: the 3-D (level, y, x) CTM fields at one hour
+             nsamples [int]: number of samples
+        Output [np.ndarray]: slant column of each sample
+    '''
+    k = np.argmin(np.abs(Z[:, i, j] - alts[np.newaxis, :]), axis=0)
+    return np.bincount(owner, weights=partial_col_dens[k, i, j]*ds, minlength=nsamples)
+
+
+def ray_trace_scd(lon0: float, lat0: float, sza, saa, day_index, hour_index, ctm_data, index,
+                  ds=5.0, max_dist=100000.0, alt0=2.0, toa=np.inf, chunk_points=2000000):
+    '''
+        batched ray tracing of CTM slant columns for all samples of a station
+             lon0, lat0 [float]: the station location
+             sza, saa [np.ndarray]: solar zenith/azimuth angles (deg)
+             day_index, hour_index [np.ndarray]: matched CTM granule and hour of each sample
+             ctm_data [list]: list of ctm_model granules
+             index [GridIndex]: the spatial index of the CTM grid
+             chunk_points [int]: max number of LOS points held in memory at once
+        Output [np.ndarray]: slant column of each sample (molec/cm2 * m)
+    '''
+    geod = Geod(ellps='WGS84')
+    sza = np.atleast_1d(sza)
+    saa = np.atleast_1d(saa)
+    day_index = np.atleast_1d(day_index)
+    hour_index = np.atleast_1d(hour_index)
+    nsamples = np.size(sza)
+    scd = np.zeros(nsamples)
+    # chunk samples so that LOS points fit in memory
+    chunk = max(1, int(chunk_points // np.size(np.arange(0, max_dist, ds))))
+    for c0 in range(0, nsamples, chunk):
+        sel = np.arange(c0, min(c0 + chunk, nsamples))
+        owner, lons, lats, alts = los_points(lon0, lat0, sza[sel], saa[sel], ds=ds,
+                                             max_dist=max_dist, alt0=alt0, toa=toa, geod=geod)
+        # unfilled points of the original marching loop were skipped
+        valid = (lons != 0.0) & (lats != 0.0) & (alts != 0.0)
+        owner, lons, lats, alts = owner[valid], lons[valid], lats[valid], alts[valid]
+        i, j, _ = index.query(lons, lats)
+        # group samples sharing the same CTM hour
+        keys = day_index[sel]*100000 + hour_index[sel]
+        for key in np.unique(keys):
+            group = np.where(keys == key)[0]
+            points = np.isin(owner, group)
+            day = day_index[sel][group[0]]
+            hour = hour_index[sel][group[0]]
+            scd_group = integrate_step(owner[points], i[points], j[points], alts[points],
+                                       ctm_data[day].partial_col_density[hour, ...],
+                                       ctm_data[day].Z[hour, ...], ds, np.size(sel))
+            scd[sel[group]] = scd_group[group]
+    return scd
+
+
+def integrate_interp(owner, fi, fj, alts, partial_col_dens, Z, ds, nsamples, batch_points=100000):
+    '''
+        integrates partial column densities interpolated at the LOS points using fixed steps:
+        bilinear in the horizontal and linear in height between the Z of the levels
+        (constant beyond the lowest and highest level)
+             owner [np.ndarray]: sample index of each point
+             fi, fj [np.ndarray]: fractional CTM grid indices of each point
+             alts [np.ndarray]: altitude of each point
+             partial_col_dens, Z [np.ndarray]: the 3-D (level, y, x) CTM fields at one hour
+             nsamples [int]: number of samples
+             batch_points [int]: number of points whose profiles are held in memory at once
+        Output [np.ndarray]: slant column of each sample
+    '''
+    nlevels = np.shape(Z)[0]
+    density = np.zeros(np.size(owner))
+    for b0 in range(0, np.size(owner), batch_points):
+        sel = slice(b0, b0 + batch_points)
+        # density and height profiles at each point
+        dens = bilinear(partial_col_dens, fi[sel], fj[sel])
+        if nlevels == 1:
+            density[sel] = dens[:, 0]
+            continue
+        height = bilinear(Z, fi[sel], fj[sel])
+        points = np.arange(np.shape(dens)[0])
+        k = np.clip(np.sum(height <= alts[sel, np.newaxis], axis=1) - 1, 0, nlevels - 2)
+        z0, z1 = height[points, k], height[points, k + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip(np.where(z1 > z0, (alts[sel] - z0)/(z1 - z0), 0.0), 0.0, 1.0)
+        density[sel] = dens[points, k] + t*(dens[points, k + 1] - dens[points, k])
+    return np.bincount(owner, weights=density*ds, minlength=nsamples)
+
+
+def interp_trace_scd(lon0: float, lat0: float, sza, saa, granule0, hour0, granule1, hour1, weight, ctm_data,
+                     index, ds=5.0, max_dist=100000.0, alt0=2.0, toa=np.inf, chunk_points=2000000):
+    '''
+        batched ray tracing of CTM slant columns interpolated in space and time for all samples
+        of a station (see integrate_interp); the slant columns at the two CTM steps bracketing a
+        sample are blended linearly in time
+             lon0, lat0 [float]: the station location
+             sza, saa [np.ndarray]: solar zenith/azimuth angles (deg)
+             granule0, hour0, granule1, hour1, weight [np.ndarray]: the bracketing CTM steps and the
+                                                                   weight of the later one (see match_ctm_time)
+             ctm_data [list]: list of ctm_model granules
+             index [GridIndex]: the spatial index of the CTM grid
+             chunk_points [int]: max number of LOS points held in memory at once
+        Output [np.ndarray]: slant column of each sample (molec/cm2 * m)
+    '''
+    sza = np.atleast_1d(np.asarray(sza, dtype=float))
+    saa = np.atleast_1d(np.asarray(saa, dtype=float))
+    weight = np.atleast_1d(weight)
+    steps = [(np.atleast_1d(granule0), np.atleast_1d(hour0), 1.0 - weight),
+             (np.atleast_1d(granule1), np.atleast_1d(hour1), weight)]
+    ctm_lon = ctm_data[0].longitude
+    shape = np.shape(ctm_lon)
+    i0, j0 = index.station_cell(lon0, lat0)
+    # LOS points are placed in the local grid frame of the station (see local_grid_frame)
+    p0, jinv = local_grid_frame(ctm_lon, ctm_data[0].latitude, i0, j0, lon0, lat0)
+    s = np.arange(0, max_dist, ds)
+    nsamples = np.size(sza)
+    scd = np.zeros(nsamples)
+    chunk = max(1, int(chunk_points // np.size(s)))
+    for c0 in range(0, nsamples, chunk):
+        sel = np.arange(c0, min(c0 + chunk, nsamples))
+        cos_zen = np.cos(np.radians(sza[sel]))
+        # as in los_points, a LOS stops at its first point above toa
+        npoints = los_npoints(s, cos_zen, alt0, toa)
+        owner = np.repeat(np.arange(np.size(sel)), npoints)
+        count('los_steps', np.size(owner))
+        step = np.arange(np.size(owner)) - np.repeat(np.cumsum(npoints) - npoints, npoints)
+        horizontal = s[step]*np.sin(np.radians(sza[sel]))[owner]
+        east = horizontal*np.sin(np.radians(saa[sel]))[owner]
+        north = horizontal*np.cos(np.radians(saa[sel]))[owner]
+        fi = np.clip(p0[0] + jinv[0, 0]*east + jinv[0, 1]*north, 0, shape[0] - 1)
+        fj = np.clip(p0[1] + jinv[1, 0]*east + jinv[1, 1]*north, 0, shape[1] - 1)
+        alts = alt0 + s[step]*cos_zen[owner]
+        for granule, hour, w in steps:
+            # group samples sharing the same CTM step; steps without weight are skipped
+            keys = granule[sel]*100000 + hour[sel]
+            used = w[sel] > 0
+            for key in np.unique(keys[used]):
+                group = np.where((keys == key) & used)[0]
+                points = np.isin(owner, group)
+                day, hr = granule[sel][group[0]], hour[sel][group[0]]
+                scd_group = integrate_interp(owner[points], fi[points], fj[points], alts[points],
+                                             ctm_data[day].partial_col_density[hr, ...],
+                                             ctm_data[day].Z[hr, ...], ds, np.size(sel))
+                scd[sel[group]] += w[sel][group]*scd_group[group]
+    return scd
+
+
+def local_grid_frame(ctm_lon: np.ndarray, ctm_lat: np.ndarray, i0: int, j0: int, lon0: float, lat0: float,
+                     geod=None):
+    '''
+        linearizes the CTM grid around cell (i0,j0) to map east/north meters to grid indices
+             ctm_lon, ctm_lat [np.ndarray]: the 2-D grid centers
+             i0, j0 [int]: the cell containing the station
+             lon0, lat0 [float]: the station location
+        Output [tuple]: p0 the fractional (i,j) of the station and
+                        jinv the (2,2) matrix mapping (east, north) meters to (di, dj)
+    '''
+    if geod is None:
+        geod = Geod(ellps='WGS84')
+    ny, nx = np.shape(ctm_lon)
+
+    def east_north(lon, lat):
+        az, _, dist = geod.inv(ctm_lon[i0, j0], ctm_lat[i0, j0], lon, lat)
+        return np.array([dist*np.sin(np.radians(az)), dist*np.cos(np.radians(az))])
+
+    # centered differences where possible, one-sided at the domain edges
+    ia, ib = max(i0 - 1, 0), min(i0 + 1, ny - 1)
+    ja, jb = max(j0 - 1, 0), min(j0 + 1, nx - 1)
+    d_di = (east_north(ctm_lon[ib, j0], ctm_lat[ib, j0]) -
+            east_north(ctm_lon[ia, j0], ctm_lat[ia, j0]))/float(ib - ia)
+    d_dj = (east_north(ctm_lon[i0, jb], ctm_lat[i0, jb]) -
+            east_north(ctm_lon[i0, ja], ctm_lat[i0, ja]))/float(jb - ja)
+    jinv = np.linalg.inv(np.column_stack((d_di, d_dj)))
+    p0 = np.array([i0, j0], dtype=float) + jinv @ east_north(lon0, lat0)
+    return p0, jinv
+
+
+def los_segments(p0, jinv, shape, sza: float, saa: float, max_dist=100000.0, alt0=2.0, toa=np.inf):
+    '''
+        walks the LOS through the horizontal grid and returns the pieces inside each cell
+             p0, jinv: the local grid frame from local_grid_frame
+             shape [tuple]: (ny, nx) of the CTM grid
+             sza, saa [float]: solar zenith/azimuth angles (deg)
+             max_dist [float]: maximum distance along LOS in meters
+             alt0 [float]: initial altitude in meters
+             toa [float]: the top of the model (interface height) in meters
+        Output [tuple]: s_start, s_end (slant distance in meters), i, j of each crossed cell
+    '''
+    zen = np.radians(sza)
+    sin_zen, cos_zen = np.sin(zen), np.cos(zen)
+    s_top = max_dist
+    if cos_zen > 0:
+        s_top = min(max_dist, max(toa - alt0, 0.0)/cos_zen)
+    # index-space velocity per meter of slant path
+    v = jinv @ np.array([np.sin(np.radians(saa)), np.cos(np.radians(saa))])*sin_zen
+    for axis in range(2):
+        if v[axis] == 0.0:
+            continue
+        # the path leaves the domain at the outer edge of the grid
+        edge = (shape[axis] - 0.5) if v[axis] > 0 else -0.5
+        s_top = min(s_top, max((edge - p0[axis])/v[axis], 0.0))
+    cuts = [np.array([0.0, s_top])]
+    for axis in range(2):
+        if v[axis] == 0.0:
+            continue
+        lo, hi = sorted((p0[axis], p0[axis] + v[axis]*s_top))
+        # cell faces sit at half-integer indices
+        faces = np.arange(np.ceil(lo - 0.5), np.floor(hi - 0.5) + 1) + 0.5
+        cuts.append((faces - p0[axis])/v[axis])
+    s = np.unique(np.clip(np.concatenate(cuts), 0.0, s_top))
+    if np.size(s) < 2:
+        empty = np.zeros(0)
+        return empty, empty, empty.astype(int), empty.astype(int)
+    mid = 0.5*(s[1:] + s[:-1])
+    i = np.clip(np.floor(p0[0] + v[0]*mid + 0.5).astype(int), 0, shape[0] - 1)
+    j = np.clip(np.floor(p0[1] + v[1]*mid + 0.5).astype(int), 0, shape[1] - 1)
+    return s[:-1], s[1:], i, j
+
+
+def integrate_exact(s_start, s_end, i, j, sza: float, partial_col_dens, Z, DZ, alt0=2.0):
+    '''
+        sums the exact path length in every (level, y, x) cell crossed by the LOS
+             s_start, s_end, i, j: the horizontal segments from los_segments
+             sza [float]: solar zenith angle (deg)
+             partial_col_dens, Z, DZ [np.ndarray]: the 3-D (level, y, x) CTM fields at one hour
+             alt0 [float]: initial altitude in meters
+        Output [float]: the slant column (molec/cm2 * m)
+    '''
+    cos_zen = np.cos(np.radians(sza))
+    # layer tops (ZF) recovered from ZH and DZ = (ZF-ZH)*2
+    tops = Z[:, i, j] + DZ[:, i, j]/2.0
+    scd = 0.0
+    for n in range(np.size(s_start)):
+        s = np.array([s_start[n], s_end[n]])
+        if cos_zen != 0.0:
+            # vertical faces crossed inside this column
+            s_faces = (tops[:, n] - alt0)/cos_zen
+            s = np.concatenate((s, s_faces[(s_faces > s[0]) & (s_faces < s[1])]))
+            s.sort()
+        alt_mid = alt0 + 0.5*(s[1:] + s[:-1])*cos_zen
+        k = np.searchsorted(tops[:, n], alt_mid, side='right')
+        inside = k < np.size(tops[:, n])
+        scd += np.sum(partial_col_dens[k[inside], i[n], j[n]]*np.diff(s)[inside])
+    return scd
+
+
+def exact_trace_scd(lon0: float, lat0: float, sza, saa, day_index, hour_index, ctm_data, index,
+                    max_dist=100000.0, alt0=2.0):
+    '''
+        ray tracing of CTM slant columns with exact cell-crossing path lengths
+             lon0, lat0 [float]: the station location
+             sza, saa [np.ndarray]: solar zenith/azimuth angles (deg)
+             day_index, hour_index [np.ndarray]: matched CTM granule and hour of each sample
+             ctm_data [list]: list of ctm_model granules
+             index [GridIndex]: the spatial index of the CTM grid
+        Output [np.ndarray]: slant column of each sample (molec/cm2 * m)
+    '''
+    sza = np.atleast_1d(sza)
+    saa = np.atleast_1d(saa)
+    ctm_lon = ctm_data[0].longitude
+    shape = np.shape(ctm_lon)
+    i0, j0 = index.station_cell(lon0, lat0)
+    p0, jinv = local_grid_frame(ctm_lon, ctm_data[0].latitude, i0, j0, lon0, lat0)
+    toa = np.max(ctm_data[0].Z[0, ...] + ctm_data[0].DZ[0, ...]/2.0)
+    scd = np.zeros(np.size(sza))
+    for n in range(np.size(sza)):
+        day, hour = day_index[n], hour_index[n]
+        s_start, s_end, i, j = los_segments(p0, jinv, shape, sza[n], saa[n],
+                                            max_dist=max_dist, alt0=alt0, toa=toa)
+        count('los_segments', np.size(s_start))
+        scd[n] = integrate_exact(s_start, s_end, i, j, sza[n],
+                                 ctm_data[day].partial_col_density[hour, ...],
+                                 ctm_data[day].Z[hour, ...], ctm_data[day].DZ[hour, ...], alt0=alt0)
+    return scd
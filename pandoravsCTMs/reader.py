@@ -1,23 +1,49 @@
+import os
 import numpy as np
 from pathlib import Path
 import datetime
 import glob
+import threading
+import logging
 from joblib import Parallel, delayed
 from netCDF4 import Dataset
 from config import pandora, ctm_model
+from spatial import grid_index, station_windows
+from cache import cache_key, load_granule, save_granule
+from profiling import stage, count, remote, collect
 import warnings
 import pandas as pd
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
+# the netCDF/HDF5 libraries are not thread-safe; threads of one process (e.g., the
+# output store writer and a prefetching reader) take turns through this lock
+NC_LOCK = threading.RLock()
 
-def _read_nc(filename, var):
+logger = logging.getLogger('pandoravsCTMs.reader')
+
+
+def _read_nc_vars(filename, varnames, window=None):
+    # reading several variables from nc files without a group through one open handle
+    # window (i0, i1, j0, j1) reads only a hyperslab of the (ROW, COL) dimensions;
+    # variables without them (e.g., TFLAG) are read whole
+    outs = []
+    with NC_LOCK:
+        nc_fid = Dataset(filename, 'r')
+        for var in varnames:
+            if window is None or nc_fid.variables[var].dimensions[-2:] != ('ROW', 'COL'):
+                outs.append(np.squeeze(np.array(nc_fid.variables[var])))
+            else:
+                out = np.array(nc_fid.variables[var][..., window[0]:window[1], window[2]:window[3]])
+                # (row, col) are kept even for narrow windows
+                outs.append(np.squeeze(out, axis=tuple(a for a in range(out.ndim - 2) if out.shape[a] == 1)))
+        nc_fid.close()
+    return outs
+
+
+def _read_nc(filename, var, window=None):
     # reading nc files without a group
-    nc_f = filename
-    nc_fid = Dataset(nc_f, 'r')
-    out = np.array(nc_fid.variables[var])
-    nc_fid.close()
-    return np.squeeze(out)
+    return _read_nc_vars(filename, [var], window)[0]
 
 
 def calculate_molec_density(gas, prs, TA):
@@ -25,199 +51,497 @@ def calculate_molec_density(gas, prs, TA):
     return gas*prs*100.0/TA*7.243e12
 
 
-def CMAQ_reader(dir_mcip: str, dir_cmaq: str, YYYYMM: str, gasname: str):
+def _cmaq_time(time_var):
+    # populating cmaq time from TFLAG (YYYYDDD, HHMMSS)
+    time = []
+    for t in range(0, np.shape(time_var)[0]):
+        cmaq_date = datetime.datetime.strptime(
+            str(time_var[t, 0, 0]), '%Y%j').date()
+        hhmmss = int(time_var[t, 0, 1])
+        time.append(datetime.datetime(int(cmaq_date.strftime('%Y')), int(cmaq_date.strftime('%m')),
+                                      int(cmaq_date.strftime('%d')), hhmmss // 10000, (hhmmss // 100) % 100,
+                                      hhmmss % 100))
+    return time
+
+
+def _read_nc_level(nc_var, k, window=None):
+    # reads level k of a (TSTEP, LAY, ROW, COL) variable as (TSTEP, ROW, COL)
+    if window is None:
+        return np.array(nc_var[:, k, :, :])
+    return np.array(nc_var[:, k, window[0]:window[1], window[2]:window[3]])
+
+
+def _pbl_fraction(bottom, top, PBL):
+    # fraction of the layer [bottom, top] (m above ground) lying below the boundary layer height
+    return np.clip((PBL - bottom)/(top - bottom), 0.0, 1.0)
+
+
+def cmaq_column_reader(cmaq_target_file: str, met_file_3d_file: str, met_file_2d_file: str, gasname,
+                       window=None, partial_columns=False):
+    '''
+        reduces one cmaq day file to vertical columns while streaming through its levels,
+        so no 3-D field is ever held in memory
+             cmaq_target_file [str]: the cmaq conc file
+             met_file_3d_file, met_file_2d_file [str]: the matching mcip files
+             gasname [str or list]: the name of the gas to read, or a list of gases reduced
+                                    with one read of the met fields
+             window [tuple]: optional (i0, i1, j0, j1) grid window
+             partial_columns [bool]: also split the column at the boundary layer height (PBL)
+        Output [tuple]: time, the (time, y, x) column and a dict of partial columns
+                        ('pbl', 'above_pbl') or None; columns and partial columns are
+                        dicts keyed by gas if gasname is a list
+    '''
+    gases = [gasname] if isinstance(gasname, str) else list(gasname)
+    variables = ['FORM' if gas == 'HCHO' else gas for gas in gases]
+    with NC_LOCK:
+        conc = Dataset(cmaq_target_file, 'r')
+        met3d = Dataset(met_file_3d_file, 'r')
+        time = _cmaq_time(np.array(conc.variables['TFLAG']))
+        nlevels = conc.variables[variables[0]].shape[1]
+        PBL = None
+        if partial_columns:
+            met2d = Dataset(met_file_2d_file, 'r')
+            PBL = _read_nc_level(met2d.variables['PBL'], 0, window).astype('float32')
+            met2d.close()
+    vcd = {gas: None for gas in gases}
+    vcd_pbl = {gas: None for gas in gases}
+    bottom = 0.0
+    for k in range(nlevels):
+        # the lock is only held while reading so other threads can use the library in between
+        with NC_LOCK:
+            levels = [_read_nc_level(conc.variables[var], k, window).astype('float32') for var in variables]
+            prs = _read_nc_level(met3d.variables['PRES'], k, window).astype('float32')/100.0  # hPa
+            TA = _read_nc_level(met3d.variables['TA'], k, window).astype('float32')
+            ZH = _read_nc_level(met3d.variables['ZH'], k, window).astype('float32')
+            ZF = _read_nc_level(met3d.variables['ZF'], k, window).astype('float32')
+        if PBL is not None:
+            fraction = _pbl_fraction(bottom, ZF, PBL)
+            bottom = ZF
+        for gas, level in zip(gases, levels):
+            # nansum over levels
+            layer = np.nan_to_num(calculate_molec_density(level, prs, TA)*(ZF-ZH)*2.0)
+            vcd[gas] = layer if vcd[gas] is None else vcd[gas] + layer
+            if PBL is not None:
+                layer = layer*fraction
+                vcd_pbl[gas] = layer if vcd_pbl[gas] is None else vcd_pbl[gas] + layer
+    with NC_LOCK:
+        conc.close()
+        met3d.close()
+    layers = {gas: None for gas in gases}
+    if PBL is not None:
+        layers = {gas: {'pbl': vcd_pbl[gas], 'above_pbl': vcd[gas] - vcd_pbl[gas]} for gas in gases}
+    if isinstance(gasname, str):
+        return time, vcd[gasname], layers[gasname]
+    return time, vcd, layers
+
+
+def CMAQ_grid(dir_mcip: str, YYYYMM: str):
+    '''
+        reads the static cmaq grid
+             dir_mcip [str]: the folder containing the mcip outputs
+             YYYYMM [str]: the target month and year, e.g., 202005 (May 2020)
+        Output [tuple]: the 2-D lat and lon of the grid centers
+    '''
+    # the grid is static so any month's grid file serves
+    grd_file_2d_file = (sorted(glob.glob(dir_mcip + "/GRIDCRO2D_*" + YYYYMM + "*")) or
+                        sorted(glob.glob(dir_mcip + "/GRIDCRO2D_*")))[0]
+    lat, lon = _read_nc_vars(grd_file_2d_file, ['LAT', 'LON'])
+    return lat, lon
+
+
+def date_range(YYYYMMDD1: str, YYYYMMDD2: str):
+    '''
+        lists the days from YYYYMMDD1 up to YYYYMMDD2 (not included) as YYYYMMDD strings
+    '''
+    day = datetime.datetime.strptime(YYYYMMDD1, '%Y%m%d')
+    end = datetime.datetime.strptime(YYYYMMDD2, '%Y%m%d')
+    days = []
+    while day < end:
+        days.append(day.strftime('%Y%m%d'))
+        day += datetime.timedelta(days=1)
+    return days
+
+
+def CMAQ_files(dir_mcip: str, dir_cmaq: str, YYYYMM: str, days=None):
+    '''
+        lists the cmaq day files
+             dir_mcip [str]: the folder containing the mcip outputs
+             dir_cmaq [str]: the folder containing the cmaq conc outputs
+             YYYYMM [str]: the target month and year, e.g., 202005 (May 2020)
+             days [list]: optional YYYYMMDD days to list instead of the whole month;
+                          days without a conc file are skipped
+        Output [tuple]: the conc, METCRO2D, METCRO3D and GRIDCRO2D files
+    '''
+    if days is None:
+        cmaq_target_files = sorted(
+            glob.glob(dir_cmaq + "/CCTM_CONC_*" + YYYYMM + "*.nc"))
+        met_files_2d = sorted(
+            glob.glob(dir_mcip + "/METCRO2D_*" + YYYYMM + "*"))
+        met_files_3d = sorted(
+            glob.glob(dir_mcip + "/METCRO3D_*" + YYYYMM + "*"))
+    else:
+        cmaq_target_files, met_files_2d, met_files_3d = [], [], []
+        for day in days:
+            conc = sorted(glob.glob(dir_cmaq + "/CCTM_CONC_*" + day + "*.nc"))
+            if not conc:
+                continue
+            cmaq_target_files += conc
+            met_files_2d += sorted(glob.glob(dir_mcip + "/METCRO2D_*" + day + "*"))
+            met_files_3d += sorted(glob.glob(dir_mcip + "/METCRO3D_*" + day + "*"))
+    # the grid is static so any month's grid file serves
+    grd_files_2d = sorted(
+        glob.glob(dir_mcip + "/GRIDCRO2D_*" +
+                  YYYYMM + "*")) or sorted(glob.glob(dir_mcip + "/GRIDCRO2D_*"))
+    return cmaq_target_files, met_files_2d, met_files_3d, grd_files_2d
+
+
+def CMAQ_reader(dir_mcip: str, dir_cmaq: str, YYYYMM: str, gasname, windows=None, num_job=1,
+                cache_dir=None, vcd_only=False, partial_columns=False, days=None):
     '''
         cmaq reader core
              dir_mcip [str]: the folder containing the mcip outputs
              dir_cmaq [str]: the folder containing the cmaq conc outputs
              YYYYMM [str]: the target month and year, e.g., 202005 (May 2020)
-             gasname [str]: the name of the gas to read
-        Output [ctm_model]: the ctm @dataclass
+             gasname [str or list]: the name of the gas to read, or a list of gases read in the
+                                    same pass; the met fields are read once per day for all of them
+             windows [list]: optional (i0, i1, j0, j1) grid windows (see spatial.station_windows);
+                             only these hyperslabs are read from the files
+             num_job [int]: the number of day files read in parallel
+             cache_dir [str]: optional folder of memory-mapped derived fields; days already cached
+                              with unchanged source files are mapped instead of re-derived
+             vcd_only [bool]: keep only the (time, y, x) vertical columns, reduced level by level
+                              (see cmaq_column_reader); enough for direct VCD pairing but not for ray tracing
+             partial_columns [bool]: also keep the columns below/above the boundary layer height
+             days [list]: optional YYYYMMDD days to read instead of the whole month (may span
+                          several months); days without a conc file are skipped
+        Output [list]: the list of daily ctm @dataclass, or one such list per window if windows are given;
+                       a dict of these keyed by gas if gasname is a list (the granules of a day share
+                       their grid, time, Z and DZ)
     '''
+    gases = [gasname] if isinstance(gasname, str) else list(gasname)
+
+    def cmaq_reader_inside(cmaq_target_file, met_file_3d_file, met_file_2d_file, lat, lon, window=None):
+        with stage('ctm_read'):
+            return read_day(cmaq_target_file, met_file_3d_file, met_file_2d_file, lat, lon, window)
 
-    def cmaq_reader_inside(cmaq_target_file, met_file_3d_file, met_file_2d_file, grd_file_2d_file, gasname):
-
-        print("Currently reading: " + cmaq_target_file.split('/')[-1])
-        # reading time and coordinates
-        lat = _read_nc(grd_file_2d_file, 'LAT')
-        lon = _read_nc(grd_file_2d_file, 'LON')
-        time_var = _read_nc(cmaq_target_file, 'TFLAG')
-        # populating cmaq time
-        time = []
-        for t in range(0, np.shape(time_var)[0]):
-            cmaq_date = datetime.datetime.strptime(
-                str(time_var[t, 0, 0]), '%Y%j').date()
-            time.append(datetime.datetime(int(cmaq_date.strftime('%Y')), int(cmaq_date.strftime('%m')),
-                                          int(cmaq_date.strftime('%d')), int(time_var[t, 0, 1]/10000.0), 0, 0) +
-                        datetime.timedelta(minutes=0))
-
-        prs = _read_nc(met_file_3d_file, 'PRES').astype('float32')/100.0  # hPa
-        ZH = _read_nc(met_file_3d_file, 'ZH').astype('float32')
-        ZF =  _read_nc(met_file_3d_file, 'ZF').astype('float32')
+    def read_day(cmaq_target_file, met_file_3d_file, met_file_2d_file, lat, lon, window=None):
+
+        logger.info("Currently reading: " + cmaq_target_file.split('/')[-1])
+        count('ctm_files')
+        if vcd_only:
+            time, vcd, layers = cmaq_column_reader(cmaq_target_file, met_file_3d_file, met_file_2d_file,
+                                                   gases, window, partial_columns)
+            return [ctm_model(lat, lon, time, None, None, None, 'CMAQ', window=window, vcd=vcd[gas],
+                              vcd_layers=layers[gas]) for gas in gases]
+        # reading time and all gases in one pass over the conc file
+        time_var, *fields = _read_nc_vars(cmaq_target_file, ['TFLAG'] + ['FORM' if gas == 'HCHO' else gas
+                                                                          for gas in gases], window)
+        time = _cmaq_time(time_var)
+
+        # all met fields through one open handle
+        prs, ZH, ZF, TA = _read_nc_vars(met_file_3d_file, ['PRES', 'ZH', 'ZF', 'TA'], window)
+        prs = prs.astype('float32')/100.0  # hPa
+        ZH = ZH.astype('float32')
+        ZF = ZF.astype('float32')
         DZ = (ZF-ZH)*2.0
         #surf_prs = _read_nc(met_file_2d_file, 'PRSFC').astype('float32')/100.0
-        TA = _read_nc(met_file_3d_file, 'TA').astype('float32')
-        if gasname == 'HCHO':
-            gasname = 'FORM'
-        # read gas in ppbv
-        gas = _read_nc(cmaq_target_file, gasname)  # ppmv
-        gas = gas.astype('float32')
-        gas = calculate_molec_density(gas, prs, TA)
-        # populate cmaq_data format
-        cmaq_data = ctm_model(lat, lon, time, gas, ZH, DZ, 'CMAQ')
+        TA = TA.astype('float32')
+        if partial_columns:
+            PBL = _read_nc(met_file_2d_file, 'PBL', window).astype('float32')
+            bottom = np.concatenate((np.zeros_like(ZF[:, :1]), ZF[:, :-1]), axis=1)
+            fraction = _pbl_fraction(bottom, ZF, PBL[:, np.newaxis, ...])
+        cmaq_data = []
+        for gas in fields:
+            # gas in ppmv
+            gas = gas.astype('float32')
+            gas = calculate_molec_density(gas, prs, TA)
+            layers = None
+            if partial_columns:
+                layer = gas*DZ
+                vcd = np.nansum(layer, axis=1)
+                vcd_pbl = np.nansum(layer*fraction, axis=1)
+                layers = {'pbl': vcd_pbl, 'above_pbl': vcd - vcd_pbl}
+            # populate cmaq_data format; the met fields are shared by the gases
+            cmaq_data.append(ctm_model(lat, lon, time, gas, ZH, DZ, 'CMAQ', window=window, vcd_layers=layers))
         return cmaq_data
 
-    cmaq_target_files = sorted(
-        glob.glob(dir_cmaq + "/CCTM_CONC_*" + YYYYMM + "*.nc"))
-    grd_files_2d = sorted(
-        glob.glob(dir_mcip + "/GRIDCRO2D_*" +
-                  YYYYMM + "*"))
-    met_files_2d = sorted(
-        glob.glob(dir_mcip + "/METCRO2D_*" + YYYYMM + "*"))
-    met_files_3d = sorted(
-        glob.glob(dir_mcip + "/METCRO3D_*" + YYYYMM + "*"))
+    cmaq_target_files, met_files_2d, met_files_3d, grd_files_2d = CMAQ_files(dir_mcip, dir_cmaq, YYYYMM, days)
     if len(cmaq_target_files) != len(met_files_3d):
         raise Exception(
             "the data are not consistent")
-    outputs = []
-    for k in range(len(met_files_3d)):
-        ctm_data = cmaq_reader_inside(
-            cmaq_target_files[k], met_files_3d[k], met_files_2d[k], grd_files_2d[k], gasname)
-        outputs.append(ctm_data)
 
-    return outputs
+    def read_days(window=None):
+        ndays = len(met_files_3d)
+        keys = {gas: [None]*ndays for gas in gases}
+        if cache_dir is not None:
+            sources = [[cmaq_target_files[k], met_files_3d[k], grd_files_2d[0]] +
+                       ([met_files_2d[k]] if partial_columns else []) for k in range(ndays)]
+            keys = {gas: [cache_key(sources[k], gas, window, options=(vcd_only, partial_columns))
+                          for k in range(ndays)] for gas in gases}
+        outputs = {gas: [None if key is None else load_granule(cache_dir, key) for key in keys[gas]]
+                   for gas in gases}
+        # the met fields are shared so a day is read for all gases if any of them is missing
+        missing = [k for k in range(ndays) if any(outputs[gas][k] is None for gas in gases)]
+        if missing:
+            # the grid is static so it is read once
+            lat, lon = _read_nc_vars(grd_files_2d[0], ['LAT', 'LON'], window)
+            # Parallel keeps the days in chronological order
+            new_outputs = collect(Parallel(n_jobs=num_job)(delayed(remote(cmaq_reader_inside))(
+                cmaq_target_files[k], met_files_3d[k], met_files_2d[k], lat, lon, window)
+                for k in missing))
+            for k, ctm_granules in zip(missing, new_outputs):
+                for gas, ctm_granule in zip(gases, ctm_granules):
+                    # workers return copies of the grid; share a single one again
+                    ctm_granule.latitude, ctm_granule.longitude = lat, lon
+                    if cache_dir is not None:
+                        ctm_granule = save_granule(cache_dir, keys[gas][k], ctm_granule)
+                    outputs[gas][k] = ctm_granule
+        # one spatial index is shared by all granules of the grid
+        if ndays:
+            with stage('grid_lookup'):
+                grid_index([ctm_granule for gas in gases for ctm_granule in outputs[gas]])
+        return outputs
 
+    if windows is not None:
+        outputs = [read_days(window) for window in windows]
+        outputs = {gas: [window_outputs[gas] for window_outputs in outputs] for gas in gases}
+    else:
+        outputs = read_days()
+    return outputs[gasname] if isinstance(gasname, str) else outputs
 
-def pandora_reader(filename: str, YYYYMMDD1: str, YYYYMMDD2: str, lat_ctm, lon_ctm, grouping='10min'):
-    '''
-        pandora reader
-             dir_pandora [str]: the folder containing the pandora L2 outputs
-             YYYYMMDD1 [str]: the starting date
-             YYYYMMDD1 [str]: the ending date (not included) for instance 20230201 won't include >=20230201
-        Output [ctm_model]: the ctm @dataclass
-    '''
-    # I don't know if the header changes from one file to another
-    # so I'll find when the actual line where the data starts:
-    header_end_line = None
-    dash_count = 0
 
-    with open(filename, encoding="latin1") as f:
-        for i, line in enumerate(f):
-            if line.strip().startswith('---'):  # detects a line of dashes
-                dash_count += 1
-            if dash_count == 2:  # after second occurrence
-                header_end_line = i  # 0-based index of that line
+# the rnvs3 (NO2) L2 data columns
+RNVS3_COLUMNS = [
+    "time",                                # Column 1: UT datetime
+    "FDAY",                                # Column 2: fractional days since 2000-01-01
+    # Column 3: measurement duration [s]
+    "duration_s",
+    "solar_zenith_deg",                     # Column 4
+    "solar_azimuth_deg",                    # Column 5
+    "lunar_zenith_deg",                     # Column 6
+    "lunar_azimuth_deg",                    # Column 7
+    "rms_fit_unweighted",                   # Column 8
+    "rms_fit_normalized",                   # Column 9
+    "rms_fit_expected",                     # Column 10
+    "rms_fit_expected_norm",                # Column 11
+    "station_pressure_mbar",                # Column 12
+    "data_processing_type",                 # Column 13
+    "calibration_file_version",             # Column 14
+    "calibration_file_validity_start",     # Column 15
+    "measured_mean",                        # Column 16
+    "wavelength_effective_temp_C",          # Column 17
+    "residual_stray_light_pct",             # Column 18
+    "wavelength_shift_L1_nm",               # Column 19
+    "wavelength_shift_total_nm",            # Column 20
+    "resolution_change_pct",                # Column 21
+    "integration_time_ms",                  # Column 22
+    "num_bright_cycles",                    # Column 23
+    "filterwheel1_pos",                     # Column 24
+    "filterwheel2_pos",                     # Column 25
+    "atm_variability_pct",                  # Column 26
+    "aod_start_wl",                         # Column 27
+    "aod_center_wl",                        # Column 28
+    "aod_end_wl",                           # Column 29
+    "L1_quality_flag",                       # Column 30
+    "L1_DQ1_flag_sum",                       # Column 31
+    "L1_DQ2_flag_sum",                       # Column 32
+    "L2Fit_quality_flag",                    # Column 33
+    "L2Fit_DQ1_flag_sum",                    # Column 34
+    "L2Fit_DQ2_flag_sum",                    # Column 35
+    "L2_NO2_quality_flag",                   # Column 36
+    "L2_NO2_DQ1_flag_sum",                   # Column 37
+    "L2_NO2_DQ2_flag_sum",                   # Column 38
+    "NO2_column_mol_m2",                     # Column 39
+    "NO2_column_uncert_independent",         # Column 40
+    "NO2_column_uncert_structured",          # Column 41
+    "NO2_column_uncert_common",              # Column 42
+    "NO2_column_uncert_total",               # Column 43
+    "NO2_column_uncert_rms",                 # Column 44
+    "NO2_effective_temp_K",                  # Column 45
+    "NO2_temp_uncert_independent",           # Column 46
+    "NO2_temp_uncert_structured",            # Column 47
+    "NO2_temp_uncert_common",                # Column 48
+    "NO2_temp_uncert_total",                 # Column 49
+    "NO2_air_mass_factor_direct",            # Column 50
+    "NO2_air_mass_factor_uncert",            # Column 51
+    "NO2_diffuse_correction_pct",            # Column 52
+    "NO2_stratospheric_column_mol_m2",       # Column 53
+    "NO2_stratospheric_column_uncert"        # Column 54
+]
+
+# the long names of the gases in the "Column N: ..." descriptions of the L2 headers
+PANDORA_GASES = {'NO2': 'nitrogen dioxide', 'HCHO': 'formaldehyde', 'O3': 'ozone', 'SO2': 'sulfur dioxide'}
+# the PGN L2 product (part of the file names) carrying each gas
+PANDORA_PRODUCTS = {'NO2': 'rnvs3', 'HCHO': 'rfuh5'}
+
+
+def _pandora_product(gas: str):
+    if gas not in PANDORA_PRODUCTS:
+        raise Exception(f"no Pandora L2 product is known to carry {gas}")
+    return PANDORA_PRODUCTS[gas]
+
+
+def _pandora_station(filename: str):
+    # the station and instrument of an L2 file, shared by the files of its products
+    return os.path.basename(filename).split('_L2_')[0]
+
+
+def _gas_fields(gas: str):
+    # the record columns of a gas needed for pairing and quality filtering
+    return {'quality': f"L2_{gas}_quality_flag", 'column': f"{gas}_column_mol_m2",
+            'uncertainty': f"{gas}_column_uncert_total", 'amf': f"{gas}_air_mass_factor_direct"}
+
+
+def _pandora_gas_columns(descriptions: dict, gases: list):
+    # finds the (0-based) columns of each gas from the header descriptions; the fixed
+    # rnvs3 layout is used for NO2 if they do not describe it; gases not found are left out
+    columns = {}
+    for gas in gases:
+        name = PANDORA_GASES.get(gas, gas).lower()
+        prefixes = {'quality': 'l2 data quality flag for ' + name,
+                    'column': name + ' total vertical column amount',
+                    'uncertainty': 'total uncertainty of ' + name + ' total vertical column amount',
+                    'amf': 'direct ' + name + ' air mass factor'}
+        found = {}
+        for n, text in descriptions.items():
+            for field, prefix in prefixes.items():
+                if field not in found and text.lower().startswith(prefix):
+                    found[field] = n
+        if len(found) == len(prefixes):
+            columns[gas] = found
+        elif gas == 'NO2':
+            columns[gas] = {field: RNVS3_COLUMNS.index(col) for field, col in _gas_fields(gas).items()}
+    return columns
+
+
+def _read_pandora_header(f, meta=None, descriptions=None):
+    # single pass over the header; stops at the second dashed line so that
+    # the handle is left at the first data line
+    # meta [dict]: optionally filled with the "key: value" lines of the first header block
+    # descriptions [dict]: optionally filled with the "Column N: ..." lines keyed by N-1
+    lat, lon = None, None
+    dash_count = 0
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        if line.strip().startswith('---'):  # detects a line of dashes
+            dash_count += 1
+            if dash_count == 2:
                 break
-    # find latitude and longitude
-    with open(filename, encoding="latin1") as f:
-        for line in f:
-            if line.startswith("Location latitude"):
-                lat = float(line.split(":")[1].strip())
-            elif line.startswith("Location longitude"):
-                lon = float(line.split(":")[1].strip())
-
-    # see even if the station is within CTM to worth reading it
-
-    # filter based on CTM perimiter
-    lat_min, lat_max = np.nanmin(lat_ctm), np.nanmax(lat_ctm)
-    lon_min, lon_max = np.nanmin(lon_ctm), np.nanmax(lon_ctm)
-    inside = (lat_min <= lat <= lat_max) and \
-        (lon_min <= lon <= lon_max)
-    if inside == False:  # the station is outside of the domain
-        print("This station is outside of the domain--skipping!")
-        return None
-    else:
-        print(f"Reading {filename}")
-    # read the pandora data
-    column_names = [
-        "time",                                # Column 1: UT datetime
-        "FDAY",                                # Column 2: fractional days since 2000-01-01
-        # Column 3: measurement duration [s]
-        "duration_s",
-        "solar_zenith_deg",                     # Column 4
-        "solar_azimuth_deg",                    # Column 5
-        "lunar_zenith_deg",                     # Column 6
-        "lunar_azimuth_deg",                    # Column 7
-        "rms_fit_unweighted",                   # Column 8
-        "rms_fit_normalized",                   # Column 9
-        "rms_fit_expected",                     # Column 10
-        "rms_fit_expected_norm",                # Column 11
-        "station_pressure_mbar",                # Column 12
-        "data_processing_type",                 # Column 13
-        "calibration_file_version",             # Column 14
-        "calibration_file_validity_start",     # Column 15
-        "measured_mean",                        # Column 16
-        "wavelength_effective_temp_C",          # Column 17
-        "residual_stray_light_pct",             # Column 18
-        "wavelength_shift_L1_nm",               # Column 19
-        "wavelength_shift_total_nm",            # Column 20
-        "resolution_change_pct",                # Column 21
-        "integration_time_ms",                  # Column 22
-        "num_bright_cycles",                    # Column 23
-        "filterwheel1_pos",                     # Column 24
-        "filterwheel2_pos",                     # Column 25
-        "atm_variability_pct",                  # Column 26
-        "aod_start_wl",                         # Column 27
-        "aod_center_wl",                        # Column 28
-        "aod_end_wl",                           # Column 29
-        "L1_quality_flag",                       # Column 30
-        "L1_DQ1_flag_sum",                       # Column 31
-        "L1_DQ2_flag_sum",                       # Column 32
-        "L2Fit_quality_flag",                    # Column 33
-        "L2Fit_DQ1_flag_sum",                    # Column 34
-        "L2Fit_DQ2_flag_sum",                    # Column 35
-        "L2_NO2_quality_flag",                   # Column 36
-        "L2_NO2_DQ1_flag_sum",                   # Column 37
-        "L2_NO2_DQ2_flag_sum",                   # Column 38
-        "NO2_column_mol_m2",                     # Column 39
-        "NO2_column_uncert_independent",         # Column 40
-        "NO2_column_uncert_structured",          # Column 41
-        "NO2_column_uncert_common",              # Column 42
-        "NO2_column_uncert_total",               # Column 43
-        "NO2_column_uncert_rms",                 # Column 44
-        "NO2_effective_temp_K",                  # Column 45
-        "NO2_temp_uncert_independent",           # Column 46
-        "NO2_temp_uncert_structured",            # Column 47
-        "NO2_temp_uncert_common",                # Column 48
-        "NO2_temp_uncert_total",                 # Column 49
-        "NO2_air_mass_factor_direct",            # Column 50
-        "NO2_air_mass_factor_uncert",            # Column 51
-        "NO2_diffuse_correction_pct",            # Column 52
-        "NO2_stratospheric_column_mol_m2",       # Column 53
-        "NO2_stratospheric_column_uncert"        # Column 54
-    ]
+        elif line.startswith("Location latitude"):
+            lat = float(line.split(":")[1].strip())
+        elif line.startswith("Location longitude"):
+            lon = float(line.split(":")[1].strip())
+        elif descriptions is not None and dash_count == 1 and line.startswith("Column "):
+            number, text = line[len("Column "):].split(':', 1)
+            if number.strip().isdigit():
+                descriptions[int(number) - 1] = text.strip()
+        if meta is not None and dash_count == 0 and ':' in line:
+            key, value = line.split(':', 1)
+            meta[key.strip()] = value.strip()
+    return lat, lon
+
+
+def _read_pandora_records(f, YYYYMMDD1=None, YYYYMMDD2=None, grouping='10min', gases=None, descriptions=None):
+    # reads the data section of an open L2 file (positioned by _read_pandora_header)
+    # into quality-filtered, time-grouped records; no date window if YYYYMMDD1/2 are None
+    # gases [list]: optional gases read in the same parse (see _pandora_gas_columns), each filtered by
+    #               its own quality flag; records of NO2 only if None, a dict of records by gas otherwise
+    gas_list = ['NO2'] if gases is None else list(gases)
+    gas_columns = _pandora_gas_columns(descriptions or {}, gas_list)
+    names = {0: "time", 3: "solar_zenith_deg", 4: "solar_azimuth_deg"}
+    for gas, found in gas_columns.items():
+        fields = _gas_fields(gas)
+        names.update({n: fields[field] for field, n in found.items()})
+    # read only the needed columns of the data section
     data = pd.read_csv(
-        filename,
-        skiprows=header_end_line+1,
+        f,
         header=None,
-        names=column_names,
-        delimiter=' ',
-        encoding='latin1'
-    )
+        usecols=sorted(names),
+        dtype={0: str},
+        delimiter=' '
+    ).rename(columns=names)
     # filter bad data
-    mask = (data['L2_NO2_quality_flag'] <= 1.0) & (
-        data['solar_zenith_deg'] < 65.0)
-    data = data.loc[mask]
-    start_dt = pd.to_datetime(YYYYMMDD1, format='%Y%m%d', utc=True)
-    end_dt = pd.to_datetime(YYYYMMDD2, format='%Y%m%d', utc=True)
-    mask = data['time'] != -999
+    good = {gas: (data[_gas_fields(gas)['quality']] <= 1.0) & (data['solar_zenith_deg'] < 65.0)
+            for gas in gas_columns}
+    # filter based on time on the raw YYYYMMDDTHHMMSS.fZ strings before any conversion;
+    # 10-min bins never straddle midnight so this equals filtering the grouped bins
+    mask = data['time'] != '-999'
+    if YYYYMMDD1 is not None:
+        day = data['time'].str.slice(0, 8)
+        mask = mask & (day >= YYYYMMDD1) & (day < YYYYMMDD2)
+    mask = mask & np.logical_or.reduce([np.zeros(len(data), dtype=bool)] + list(good.values()))
     data = data.loc[mask]
     data['time'] = pd.to_datetime(
         data['time'], format="%Y%m%dT%H%M%S.%fZ", utc=True)
-    # grouping
-    data = data.groupby(pd.Grouper(key='time',freq=grouping)).mean().reset_index()
-    # filter based on time
-    mask = (data['time'] >= start_dt) & (data['time'] < end_dt)
-    data = data.loc[mask]
+    records = {}
+    for gas in gas_list:
+        fields = _gas_fields(gas)
+        columns = ["time", "solar_zenith_deg", "solar_azimuth_deg",
+                   fields['column'], fields['uncertainty'], fields['amf']]
+        if gas not in gas_columns:
+            # the file does not carry this gas
+            records[gas] = pd.DataFrame(columns=columns)
+            continue
+        # grouping; bins without any measurement are dropped
+        records[gas] = data.loc[good[gas][mask], columns].groupby(
+            pd.Grouper(key='time', freq=grouping)).mean().dropna(how='all').reset_index()
+    return records['NO2'] if gases is None else records
+
+
+def _to_pandora(data, lat: float, lon: float, gas='NO2'):
+    # grouped records to the pandora @dataclass (columns in 1e15 molec/cm2)
+    fields = _gas_fields(gas)
+    return pandora(data['time'], lat, lon, np.array(data[fields['column']])*6.022e23/1e4*1e-15,
+                   np.array(data[fields['uncertainty']]) *
+                   6.022e23/1e4*1e-15,
+                   np.array(data[fields['amf']]),
+                   np.array(data['solar_zenith_deg']), np.array(data['solar_azimuth_deg']))
+
+
+def pandora_reader(filename: str, YYYYMMDD1: str, YYYYMMDD2: str, lat_ctm, lon_ctm, grouping='10min',
+                   gases=None):
+    '''
+        pandora reader
+             dir_pandora [str]: the folder containing the pandora L2 outputs
+             YYYYMMDD1 [str]: the starting date
+             YYYYMMDD1 [str]: the ending date (not included) for instance 20230201 won't include >=20230201
+             gases [list]: optional gases read in one parse of the file, e.g., ['NO2', 'HCHO']
+        Output [ctm_model]: the ctm @dataclass, or a dict of them keyed by gas if gases are given
+                            (None for gases without data in the file)
+    '''
+    with stage('pandora_parse'):
+        return _pandora_reader(filename, YYYYMMDD1, YYYYMMDD2, lat_ctm, lon_ctm, grouping, gases)
+
+
+def _pandora_reader(filename, YYYYMMDD1, YYYYMMDD2, lat_ctm, lon_ctm, grouping, gases):
+    count('pandora_files')
+    with open(filename, encoding="latin1") as f:
+        descriptions = {}
+        lat, lon = _read_pandora_header(f, descriptions=descriptions)
+
+        # see even if the station is within CTM to worth reading it
+
+        # filter based on CTM perimiter
+        lat_min, lat_max = np.nanmin(lat_ctm), np.nanmax(lat_ctm)
+        lon_min, lon_max = np.nanmin(lon_ctm), np.nanmax(lon_ctm)
+        inside = (lat_min <= lat <= lat_max) and \
+            (lon_min <= lon <= lon_max)
+        if inside == False:  # the station is outside of the domain
+            logger.info(f"{filename} is outside of the domain--skipping!")
+            return None
+        else:
+            logger.info(f"Reading {filename}")
+        data = _read_pandora_records(f, YYYYMMDD1, YYYYMMDD2, grouping, gases, descriptions)
+    if gases is not None:
+        return {gas: None if data[gas].empty else _to_pandora(data[gas], lat, lon, gas) for gas in gases}
     if data.empty:
+        logger.info(f"{filename} has no data in the period--skipping!")
         return None
     else:
-        print("This file has legit data")
-        return pandora(data['time'], lat, lon, np.array(data['NO2_column_mol_m2'])*6.022e23/1e4*1e-15,
-                       np.array(data['NO2_column_uncert_total']) *
-                       6.022e23/1e4*1e-15,
-                       np.array(data['NO2_air_mass_factor_direct']),
-                       np.array(data['solar_zenith_deg']), np.array(data['solar_azimuth_deg']))
+        logger.debug("This file has legit data")
+        return _to_pandora(data, lat, lon)
 
 
 class readers(object):
@@ -249,40 +573,146 @@ class readers(object):
         self.ctm_product_dir = product_dir
         self.ctm_product = product_name
         self.mcip_dir = mcip_dir
+        self.ctm_window = None
+
+    def pandora_files(self, gases=None):
+        '''
+            lists all the L2 files of the pandora product, or of the products carrying the
+            gases if given (see PANDORA_PRODUCTS)
+        '''
+        products = [self.pandora_product_name] if gases is None else \
+            sorted(set(_pandora_product(gas) for gas in gases))
+        return sorted(f for product in products for f in glob.glob(self.pandora_product_dir.as_posix(
+        ) + "/*" + f"{product}" + "*"))
 
-    def read_pandora_data(self, YYYYMMDD1: str, YYYYMMDD2: str, num_job=1):
+    def read_pandora_data(self, YYYYMMDD1: str, YYYYMMDD2: str, num_job=1, store_dir=None, index_file=None,
+                          files=None, gases=None):
         '''
             read L2 spandoradata
             Input:
              YYYYMMDD1 [str]: the starting date
              YYYYMMDD1 [str]: the ending date (not included) for instance 20230201 won't include >=20230201
              num_job [int]: the number of jobs for parallel computation
+             store_dir [Path]: optional parquet store of parsed records (see pandora_store);
+                               only new or changed files are parsed, the rest is read from the store
+             index_file [Path]: optional station index (see station_index); files outside the CTM
+                                domain or without data in the date range are skipped unopened
+             files [list]: optional subset of the L2 files to read (all files of the product by default)
+             gases [list]: optional gases, each read from the files of its product (see PANDORA_PRODUCTS)
+                           in one parse per file for the gases of a product; pandora_data is then a
+                           dict of lists keyed by gas with one entry per station, and pandora_data_files
+                           holds the files of each station
         '''
-        if self.pandora_product_name == 'rnvs3':
-            files_pandora = sorted(glob.glob(self.pandora_product_dir.as_posix(
-            ) + "/*" + f"{self.pandora_product_name}" + "*"))
-            outputs = Parallel(n_jobs=num_job)(delayed(pandora_reader)(
-                files_pandora[k], YYYYMMDD1, YYYYMMDD2, self.ctm_data[0].latitude, self.ctm_data[0].longitude)
-                for k in range(len(files_pandora)))
-
-        else:
+        if self.pandora_product_name != 'rnvs3':
             raise Exception(
                 "the pandora dataproduct is not supported, come tomorrow!")
-
+        files_pandora = self.pandora_files(gases) if files is None else files
+        if gases is not None:
+            for gas in gases:
+                if not any(_pandora_product(gas) in os.path.basename(f) for f in files_pandora):
+                    raise Exception(f"no Pandora L2 file of {_pandora_product(gas)} carries {gas}")
+        if index_file is not None:
+            # imported here as the index reuses this module's header parser
+            from station_index import StationIndex
+            index = StationIndex(index_file)
+            index.update(files_pandora)
+            files_pandora = index.query(files_pandora, YYYYMMDD1, YYYYMMDD2, self.ctm_lat, self.ctm_lon)
+        if gases is None:
+            self.pandora_data = self._read_pandora_files(files_pandora, YYYYMMDD1, YYYYMMDD2, num_job, store_dir)
+            self.pandora_data_files = files_pandora
+            return
+        # the files of the products of a station are merged
+        stations = sorted(set(_pandora_station(f) for f in files_pandora))
+        outputs = {gas: [None]*len(stations) for gas in gases}
+        station_files = [[] for _ in stations]
+        for product in sorted(set(_pandora_product(gas) for gas in gases)):
+            product_gases = [gas for gas in gases if _pandora_product(gas) == product]
+            product_files = [f for f in files_pandora if product in os.path.basename(f)]
+            product_outputs = self._read_pandora_files(product_files, YYYYMMDD1, YYYYMMDD2, num_job, store_dir,
+                                                       product_gases)
+            for n, filename in enumerate(product_files):
+                k = stations.index(_pandora_station(filename))
+                station_files[k].append(filename)
+                for gas in product_gases:
+                    outputs[gas][k] = product_outputs[gas][n]
         self.pandora_data = outputs
+        self.pandora_data_files = station_files
+
+    def _read_pandora_files(self, files_pandora, YYYYMMDD1, YYYYMMDD2, num_job, store_dir, gases=None):
+        # reads L2 files of one product: a list with an entry per file, a dict of them keyed by gas
+        # if gases are given
+        if store_dir is not None:
+            # parquet is an optional dependency of the store only
+            from pandora_store import PandoraStore
+            store = PandoraStore(store_dir, gases=gases)
+            store.update(files_pandora, num_job=num_job)
+            if gases is None:
+                return store.read(files_pandora, YYYYMMDD1, YYYYMMDD2, self.ctm_lat, self.ctm_lon)
+            return {gas: store.read(files_pandora, YYYYMMDD1, YYYYMMDD2, self.ctm_lat, self.ctm_lon, gas=gas)
+                    for gas in gases}
+        outputs = collect(Parallel(n_jobs=num_job)(delayed(remote(pandora_reader))(
+            files_pandora[k], YYYYMMDD1, YYYYMMDD2, self.ctm_lat, self.ctm_lon, gases=gases)
+            for k in range(len(files_pandora))))
+        if gases is not None:
+            outputs = {gas: [None if output is None else output[gas] for output in outputs] for gas in gases}
+        return outputs
+
+    def pandora_stations(self):
+        '''
+            returns the (lon, lat) of each L2 file read, None for files without data of any gas
+        '''
+        pandora_lists = list(self.pandora_data.values()) if isinstance(self.pandora_data, dict) \
+            else [self.pandora_data]
+        stations = []
+        for pandora_files in zip(*pandora_lists):
+            p = next((p for p in pandora_files if p is not None), None)
+            stations.append(None if p is None else (p.longitude, p.latitude))
+        return stations
+
+    def read_ctm_grid(self, YYYYMM: str):
+        '''
+            read the static ctm grid only (used to filter Pandora stations before reading windows)
+            Input:
+             YYYYMM [str]: the target month and year, e.g., 202005 (May 2020)
+        '''
+        if self.ctm_product == 'CMAQ':
+            self.ctm_lat, self.ctm_lon = CMAQ_grid(self.mcip_dir.as_posix(), YYYYMM)
 
-    def read_ctm_data(self, YYYYMM: str, gas: str):
+    def read_ctm_data(self, YYYYMM: str, gas: str, windowed=False, halo=0.0, num_job=1, cache_dir=None,
+                      vcd_only=False, partial_columns=False, days=None):
         '''
             read ctm data
             Input:
              YYYYMM [str]: the target month and year, e.g., 202005 (May 2020)
-             gas [str]: name of the gas to be loaded. e.g., 'NO2'
+             gas [str or list]: name of the gas to be loaded. e.g., 'NO2', or a list of gases read
+                                with one read of the met fields; ctm_data is then a dict keyed by gas
+             windowed [bool]: read only the grid windows around the Pandora stations already
+                              read by read_pandora_data; ctm_data then holds one list of
+                              daily granules per window and ctm_window maps stations to windows
+             halo [float]: extra distance (m) read around each station, e.g., max_dist for ray tracing
+             num_job [int]: the number of day files read in parallel
+             cache_dir [Path]: optional folder of memory-mapped derived CTM fields
+             vcd_only [bool]: read only the vertical columns (no 3-D fields, no ray tracing)
+             partial_columns [bool]: also keep the columns below/above the boundary layer height
+             days [list]: optional YYYYMMDD days to read instead of the whole month YYYYMM
         '''
 
         if self.ctm_product == 'CMAQ':
             # CMAQ will be always get averaged inside the main reader because of out-of-memory issues
-            self.ctm_data = CMAQ_reader(self.mcip_dir.as_posix(
-            ), self.ctm_product_dir.as_posix(), YYYYMM, gas)
+            if windowed:
+                self.read_ctm_grid(YYYYMM)
+                stations = self.pandora_stations()
+                windows, self.ctm_window = station_windows(self.ctm_lon, self.ctm_lat, stations, halo=halo)
+                self.ctm_data = CMAQ_reader(self.mcip_dir.as_posix(
+                ), self.ctm_product_dir.as_posix(), YYYYMM, gas, windows=windows, num_job=num_job,
+                    cache_dir=cache_dir, vcd_only=vcd_only, partial_columns=partial_columns, days=days)
+            else:
+                self.ctm_data = CMAQ_reader(self.mcip_dir.as_posix(
+                ), self.ctm_product_dir.as_posix(), YYYYMM, gas, num_job=num_job, cache_dir=cache_dir,
+                    vcd_only=vcd_only, partial_columns=partial_columns, days=days)
+                ctm_data = self.ctm_data if isinstance(gas, str) else self.ctm_data[gas[0]]
+                self.ctm_lat = ctm_data[0].latitude
+                self.ctm_lon = ctm_data[0].longitude
 
 
 if __name__ == "__main__":
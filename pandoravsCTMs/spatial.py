@@ -0,0 +1,145 @@
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.interpolate import RegularGridInterpolator
+
+EARTH_RADIUS = 6371008.8  # mean earth radius in meters
+
+
+def _unit_vectors(lon, lat):
+    # points on the unit sphere; chord distances keep the great-circle ordering
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    return np.column_stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)))
+
+
+class GridIndex(object):
+    '''
+        spatial index over the 2-D CTM grid centers for nearest-cell lookups
+        using great-circle distances
+    '''
+
+    def __init__(self, ctm_lon: np.ndarray, ctm_lat: np.ndarray) -> None:
+        '''
+            Input:
+                ctm_lon [np.ndarray]: 2-D longitude of the grid centers
+                ctm_lat [np.ndarray]: 2-D latitude of the grid centers
+        '''
+        self.shape = np.shape(ctm_lon)
+        self.tree = cKDTree(_unit_vectors(np.ravel(ctm_lon), np.ravel(ctm_lat)))
+        self.station_cells = {}
+        # identifies the grid, e.g., in keys of cached LOS paths
+        self.digest = hashlib.sha1(np.ascontiguousarray(self.tree.data).tobytes()).hexdigest()
+
+    def query(self, lon, lat, k=1):
+        '''
+            finds the k nearest cells of many points at once
+            Input:
+                lon, lat [np.ndarray]: the points
+                k [int]: the number of nearest cells
+            Output [tuple]: i, j and the great-circle distance in meters,
+                            each with shape (npoints,) or (npoints, k)
+        '''
+        chord, idx_flat = self.tree.query(_unit_vectors(np.ravel(lon), np.ravel(lat)), k=k)
+        i, j = np.unravel_index(idx_flat, self.shape)
+        dist = 2.0*EARTH_RADIUS*np.arcsin(np.clip(chord/2.0, 0.0, 1.0))
+        return i, j, dist
+
+    def station_cell(self, lon: float, lat: float):
+        '''
+            returns the (i,j) of the cell containing a station; cached per station
+        '''
+        key = (float(lon), float(lat))
+        if key not in self.station_cells:
+            i, j, _ = self.query([lon], [lat])
+            self.station_cells[key] = (int(i[0]), int(j[0]))
+        return self.station_cells[key]
+
+
+def grid_index(ctm_data):
+    '''
+        returns the spatial index shared by a list of ctm_model granules,
+        building it once if the reader did not
+    '''
+    if ctm_data[0].grid_index is None:
+        index = GridIndex(ctm_data[0].longitude, ctm_data[0].latitude)
+        for ctm_granule in ctm_data:
+            ctm_granule.grid_index = index
+    return ctm_data[0].grid_index
+
+
+def bilinear(field: np.ndarray, y, x):
+    '''
+        bilinear interpolation of a (..., y, x) field at fractional grid indices
+             field [np.ndarray]: e.g., a (time, y, x) or (level, y, x) field
+             y, x [np.ndarray]: fractional row/column indices of the points, clipped to the grid
+        Output [np.ndarray]: (npoints, ...) values
+    '''
+    # the shape attribute keeps lazy fields (e.g., collocate._ColumnField) unevaluated
+    ny, nx = field.shape[-2:]
+    y = np.clip(np.asarray(y, dtype=float), 0, ny - 1)
+    x = np.clip(np.asarray(x, dtype=float), 0, nx - 1)
+    # only the cells around the points are handed to the interpolator
+    i0 = max(min(int(np.floor(np.min(y))), ny - 2), 0)
+    j0 = max(min(int(np.floor(np.min(x))), nx - 2), 0)
+    i1 = min(max(int(np.floor(np.max(y))) + 2, i0 + 2), ny)
+    j1 = min(max(int(np.floor(np.max(x))) + 2, j0 + 2), nx)
+    window = np.moveaxis(np.asarray(field[..., i0:i1, j0:j1]), (-2, -1), (0, 1))
+    for axis in range(2):
+        # the interpolator needs two nodes along each axis (e.g., one-row windows)
+        if np.shape(window)[axis] == 1:
+            window = np.repeat(window, 2, axis=axis)
+    interp = RegularGridInterpolator((np.arange(np.shape(window)[0]), np.arange(np.shape(window)[1])), window)
+    return interp(np.column_stack((y - i0, x - j0)))
+
+
+def grid_spacing(ctm_lon: np.ndarray, ctm_lat: np.ndarray):
+    '''
+        returns the median great-circle distance (m) between neighbouring grid centers
+    '''
+    xyz = _unit_vectors(np.ravel(ctm_lon), np.ravel(ctm_lat)).reshape(np.shape(ctm_lon) + (3,))
+    chords = np.concatenate((np.linalg.norm(np.diff(xyz, axis=0), axis=-1).ravel(),
+                             np.linalg.norm(np.diff(xyz, axis=1), axis=-1).ravel()))
+    return float(np.median(2.0*EARTH_RADIUS*np.arcsin(chords/2.0)))
+
+
+def station_windows(ctm_lon: np.ndarray, ctm_lat: np.ndarray, stations: list, halo=0.0):
+    '''
+        builds the grid windows needed to pair a set of stations
+             ctm_lon, ctm_lat [np.ndarray]: 2-D grid centers of the full domain
+             stations [list]: (lon, lat) of each station, None for missing ones
+             halo [float]: extra distance (m) kept around each station cell, e.g., max_dist for ray tracing
+        Output [tuple]: the list of (i0, i1, j0, j1) windows with overlapping ones merged,
+                        and the window index of each station (None for missing ones)
+    '''
+    ny, nx = np.shape(ctm_lon)
+    index = GridIndex(ctm_lon, ctm_lat)
+    # at least one neighbouring cell is kept so that the local grid geometry is defined
+    ncells = max(int(np.ceil(halo/grid_spacing(ctm_lon, ctm_lat))), 1)
+    cells = [None if station is None else index.station_cell(*station) for station in stations]
+    windows = []
+    for cell in cells:
+        if cell is None:
+            continue
+        box = [max(cell[0] - ncells, 0), min(cell[0] + ncells + 1, ny),
+               max(cell[1] - ncells, 0), min(cell[1] + ncells + 1, nx)]
+        # merge with every window it overlaps until none is left
+        merged = True
+        while merged:
+            merged = False
+            for w in windows:
+                if box[0] < w[1] and w[0] < box[1] and box[2] < w[3] and w[2] < box[3]:
+                    windows.remove(w)
+                    box = [min(box[0], w[0]), max(box[1], w[1]), min(box[2], w[2]), max(box[3], w[3])]
+                    merged = True
+                    break
+        windows.append(box)
+    windows = [tuple(w) for w in windows]
+    station_window = []
+    for cell in cells:
+        if cell is None:
+            station_window.append(None)
+            continue
+        station_window.append([n for n, w in enumerate(windows)
+                               if w[0] <= cell[0] < w[1] and w[2] <= cell[1] < w[3]][0])
+    return windows, station_window
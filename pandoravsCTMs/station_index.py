@@ -0,0 +1,106 @@
+import os
+import json
+from pathlib import Path
+import numpy as np
+from reader import _read_pandora_header
+
+
+def _last_line(filename: str, block=4096):
+    # reads the last non-empty line without scanning the file
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        tail = b''
+        while pos > 0:
+            pos = max(0, pos - block)
+            f.seek(pos)
+            tail = f.read(end - pos)
+            lines = tail.rstrip().split(b'\n')
+            if len(lines) > 1 or pos == 0:
+                return lines[-1].decode('latin1')
+    return ''
+
+
+def _scan_file(filename: str):
+    # station metadata from the header plus the first/last measurement times
+    meta = {}
+    with open(filename, encoding="latin1") as f:
+        lat, lon = _read_pandora_header(f, meta)
+        first = ''
+        for line in f:
+            if line.strip():
+                first = line.split(' ', 1)[0]
+                break
+    last = _last_line(filename).split(' ', 1)[0] if first else ''
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+            'station': meta.get('Short location name', Path(filename).stem),
+            'instrument': meta.get('Instrument name', ''),
+            'latitude': lat, 'longitude': lon, 'first': first, 'last': last}
+
+
+class StationIndex(object):
+    '''
+        lightweight index of Pandora L2 files (station, instrument, location and
+        first/last measurement time) built from the file headers and first/last data lines
+    '''
+
+    def __init__(self, index_file: Path) -> None:
+        '''
+            Input:
+                index_file [Path]: the json file holding the index
+        '''
+        self.index_file = Path(index_file)
+        self.entries = {}
+        if self.index_file.is_file():
+            with open(self.index_file) as f:
+                self.entries = json.load(f)
+
+    def update(self, files: list):
+        '''
+            adds new files and rescans the changed ones (by size/mtime)
+            Output [int]: the number of scanned files
+        '''
+        scanned = 0
+        for filename in files:
+            key = os.path.abspath(filename)
+            entry = self.entries.get(key)
+            st = os.stat(filename)
+            if entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+                self.entries[key] = _scan_file(filename)
+                scanned += 1
+        if scanned:
+            self.index_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.index_file.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp, self.index_file)
+        return scanned
+
+    def query(self, files: list, YYYYMMDD1: str, YYYYMMDD2: str, lat_ctm=None, lon_ctm=None):
+        '''
+            keeps the files inside the CTM bounding box with measurements in the date range
+            Input:
+                files [list]: the L2 files (must be in the index, see update)
+                YYYYMMDD1 [str]: the starting date
+                YYYYMMDD2 [str]: the ending date (not included)
+                lat_ctm, lon_ctm [np.ndarray]: optional CTM grid
+            Output [list]: the relevant files, in the input order
+        '''
+        if lat_ctm is not None:
+            lat_min, lat_max = np.nanmin(lat_ctm), np.nanmax(lat_ctm)
+            lon_min, lon_max = np.nanmin(lon_ctm), np.nanmax(lon_ctm)
+        relevant = []
+        for filename in files:
+            entry = self.entries[os.path.abspath(filename)]
+            if not entry['first']:
+                continue
+            # time strings start with YYYYMMDD so they compare as dates
+            if entry['first'][0:8] >= YYYYMMDD2 or entry['last'][0:8] < YYYYMMDD1:
+                continue
+            if lat_ctm is not None and not ((lat_min <= entry['latitude'] <= lat_max) and
+                                            (lon_min <= entry['longitude'] <= lon_max)):
+                continue
+            relevant.append(filename)
+        return relevant